@@ -0,0 +1,222 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+import math
+import random
+from fractions import Fraction
+
+import pytest
+
+from treetime.aggregate import (Difference, DistinctCount, DistinctSketch, ExactSum, Maximum, Mean, Minimum, Product,
+                                Quantile, QuantileSketch, Rope, Sum, Union)
+
+Values = [3, 0.1, -2, 0.2, "text", None, 5, 0, 1e300, 0.3, -7.5, ""]
+
+
+def reduce(aggregate, values):
+    state = aggregate.init()
+    for value in values:
+        state = aggregate.accumulate(state, value)
+    return state
+
+
+def same(a, b):
+    return a == b or (isinstance(a, float) and isinstance(b, float) and math.isclose(a, b))
+
+
+@pytest.mark.parametrize("aggregate", [Sum(), Mean(), Product(), Minimum(), Maximum(), Difference()])
+def testRemoveEqualsReduceWithout(aggregate):
+    state = reduce(aggregate, Values)
+    for n in range(1 if aggregate.ordered else 0, len(Values)):
+        without = reduce(aggregate, Values[:n] + Values[n + 1:])
+        if aggregate.invertible:
+            removed = aggregate.remove(aggregate.copy(state), Values[n])
+        else:
+            removed = aggregate.remove(reduce(aggregate, Values), Values[n])
+        assert same(aggregate.finalize(removed), aggregate.finalize(without))
+    assert same(aggregate.finalize(state), aggregate.finalize(reduce(aggregate, Values)))
+
+
+@pytest.mark.parametrize("aggregate", [Sum(), Mean(), Product(), Minimum(), Maximum()])
+def testMergeEqualsReduceAll(aggregate):
+    for n in range(len(Values) + 1):
+        merged = aggregate.merge(reduce(aggregate, Values[:n]), reduce(aggregate, Values[n:]))
+        assert same(aggregate.finalize(merged), aggregate.finalize(reduce(aggregate, Values)))
+
+
+def testRemovingAllValuesLeavesEmptyResult():
+    for aggregate, empty in [(Sum(), 0), (Mean(), None), (Product(), 1.0), (Minimum(), math.inf),
+                             (Maximum(), -math.inf)]:
+        state = reduce(aggregate, Values)
+        for value in Values:
+            state = aggregate.remove(state, value)
+        assert aggregate.finalize(state) == empty
+
+
+def testExactSumHasNoRoundingErrors():
+    total = ExactSum()
+    for value in (0.1, 0.2, 1e16, 0.3):
+        total.add(value)
+    total.add(1e16, -1)
+    assert total.value() == float(Fraction(0.1) + Fraction(0.2) + Fraction(0.3))
+    for value in (0.1, 0.2, 0.3):
+        total.add(value, -1)
+    assert total.value() == 0.0
+    total.add(math.inf)
+    assert total.value() == math.inf
+    total.add(math.inf, -1)
+    total.add(4)
+    assert total.value() == 4.0
+
+
+def testRopeBehavesLikeString():
+    rope = Rope(["ab", Rope(["c", "de"]), "f"])
+    assert str(rope) == "abcdef"
+    assert len(rope) == 6
+    assert rope == "abcdef" and rope == Rope(["abc", "def"])
+    assert rope != "abc" and rope != 5
+    assert hash(rope) == hash("abcdef")
+    assert "abcdee" < rope < "abcdeg"
+    assert str("x" + rope + "y") == "xabcdefy"
+    assert rope + "" is rope and "" + rope is rope
+    assert not Rope([])
+    assert sorted([Rope(["b"]), "a", Rope(["c"])]) == ["a", "b", "c"]
+
+
+def testRopeReferencesItsParts():
+    part = Rope(["child", "value"])
+    rope = Rope([part, "x"])
+    assert rope.parts[0] is part
+
+
+def testDeepRope():
+    rope = Rope(["a"])
+    for n in range(100000):
+        rope = Rope([rope, "b"])
+    assert str(rope) == "a" + "b" * 100000
+    assert len(rope) == 100001
+
+
+def testUnionRemovesCountedElements():
+    union = Union()
+    state = reduce(union, [{"a", "b"}, "b", "", None, {"c"}, "a"])
+    assert union.finalize(state) == {"a", "b", "c"}
+    state = union.remove(state, {"a", "b"})
+    assert union.finalize(state) == {"a", "b", "c"}
+    state = union.remove(state, "b")
+    assert union.finalize(state) == {"a", "c"}
+    state = union.remove(state, "a")
+    state = union.remove(state, {"c"})
+    assert union.finalize(state) == set()
+    merged = union.merge(reduce(union, ["x", {"y"}]), reduce(union, [{"x", "z"}]))
+    assert union.finalize(union.remove(merged, "x")) == {"x", "y", "z"}
+
+
+def rankError(sketch, values, q):
+    """
+    :return: The difference between q and the fraction of values below the quantile found by the sketch
+    """
+    found = sketch.quantile(q)
+    below = sum(v < found for v in values) / len(values)
+    atOrBelow = sum(v <= found for v in values) / len(values)
+    return 0 if below <= q <= atOrBelow else min(abs(below - q), abs(atOrBelow - q))
+
+
+def testQuantileSketchIsExactForFewValues():
+    values = [random.Random(1).random() for n in range(150)]
+    sketch = QuantileSketch(200)
+    for value in values:
+        sketch.add(value)
+    assert sketch.quantile(0.5) == sorted(values)[74]
+    assert sketch.quantile(0) == min(values)
+    assert sketch.quantile(1) == max(values)
+    assert QuantileSketch(200).quantile(0.5) is None
+
+
+def testQuantileSketchErrorBound():
+    generator = random.Random(2)
+    values = [generator.gauss(0, 1) for n in range(20000)]
+    sketch = QuantileSketch(200)
+    for value in values:
+        sketch.add(value)
+    assert sketch.items < 3 * 200 + 20
+    for q in (0.1, 0.5, 0.9, 0.99):
+        assert rankError(sketch, values, q) < 0.02
+
+    # merged sketches of parts of the values
+    parts = [QuantileSketch(200) for n in range(8)]
+    for n, value in enumerate(values):
+        parts[n % 8].add(value)
+    merged = Quantile(0.5).init()
+    for part in parts:
+        merged.merge(part)
+    assert merged.count == len(values)
+    for q in (0.1, 0.5, 0.9):
+        assert rankError(merged, values, q) < 0.03
+
+
+def testQuantileIgnoresOtherValues():
+    median = Quantile(0.5)
+    state = reduce(median, [3, "x", None, 1, float("nan"), 2, ""])
+    assert median.finalize(state) == 2
+    copy = median.copy(state)
+    median.accumulate(copy, 10)
+    median.accumulate(copy, 11)
+    assert median.finalize(state) == 2 and median.finalize(copy) == 3
+
+
+def testDistinctSketchIsExactForFewValues():
+    count = DistinctCount(1024)
+    state = reduce(count, ["a", "b", "a", 1, 1.0, True, {"c", "a"}, "", None])
+    assert count.finalize(state) == 4
+    assert state.registers is None
+
+
+def testDistinctSketchErrorBound():
+    sketch = DistinctSketch(1024)
+    for n in range(50000):
+        sketch.add(f"value {n % 30000}")
+    assert abs(sketch.count() - 30000) < 3 * 1.04 / math.sqrt(1024) * 30000
+
+
+def testDistinctSketchMerge():
+    whole = DistinctSketch(256)
+    parts = [DistinctSketch(256) for n in range(3)]
+    for n in range(5000):
+        whole.add(n)
+        parts[n % 3].add(n)
+    parts[0].merge(parts[1])
+    parts[0].merge(parts[2])
+    assert parts[0].registers == whole.registers
+    small = DistinctSketch(256)
+    small.add("x")
+    small.merge(whole)
+    assert abs(small.count() - whole.count()) <= 1
+
+
+def testDistinctSketchCopiesAreIndependent():
+    sketch = DistinctSketch(64)
+    copy = sketch.copy()
+    copy.add("a")
+    assert sketch.count() == 0 and copy.count() == 1
+    for n in range(100):
+        sketch.add(n)
+    copy = sketch.copy()
+    copy.add("new value")
+    assert sketch.registers is not copy.registers
@@ -0,0 +1,106 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+from treetime.tree import Forest
+import pytest
+
+from treetime.expression import Expression
+from treetime.tree import Forest
+
+
+def evaluate(text, own=None, children=None):
+    return Expression.compiled(text).evaluate(own or {}, children or {}, {}, {})
+
+
+@pytest.mark.parametrize("text", ['__import__("os")', 'x.__class__', '(lambda: 1)()', 'x[0]', '[1, 2]',
+                                  'open("file")', 'sum(x, start=1)', 'b"bytes"', '(y := 1)', 'f"{x}"'])
+def testForbiddenSyntaxIsRejected(text):
+    expression = Expression(text)
+    assert expression.error
+    assert expression.code is None
+    assert expression.evaluate({}, {}, {}, {}) is None
+
+
+def testEvaluation():
+    assert evaluate('a * 2 + sum(children("b"))', {"a": 3}, {"b": [1, 2, "x", None]}) == 9
+    assert evaluate('mean(children("b"))', children={"b": [1, 2]}) == 1.5
+    assert evaluate('a / 0', {"a": 1}) is None
+    assert evaluate('a + 1', {"a": None}) is None
+
+
+@pytest.mark.parametrize("text", ['((10**1000)**1000)**100', '"ab" * 10**9', '10**9 * "ab"', '(10**3000) * (10**3000)',
+                                  '"%0999999999d" % 1', '2 ** 10**9'])
+def testHugeResultsAreNotCalculated(text):
+    value = evaluate(text)
+    assert value is None or isinstance(value, float)
+
+
+def testSmallResultsAreExact():
+    assert evaluate('2 ** 100') == 2 ** 100
+    assert evaluate('"ab" * 3') == "ababab"
+    assert evaluate('7 % 3') == 1
+    assert evaluate('(10**100) * (10**100)') == 10 ** 200
+
+
+def testCacheIsBounded():
+    for n in range(Expression.CacheSize + 10):
+        Expression.compiled(f'a + {n}')
+    assert len(Expression.Cache) <= Expression.CacheSize
+    assert Expression.compiled('a + 1').evaluate({"a": 1}, {}, {}, {}) == 2
+
+
+def testRename():
+    assert Expression.rename('a + own("a") * b', "a", "new") == "new + own('new') * b"
+    assert Expression.rename('a + sum(children("a"))', "a", "new name") \
+        == "own('new name') + sum(children('new name'))"
+    assert Expression.rename('b + 1', "a", "c") == 'b + 1'
+
+
+def testRenamedFieldUpdatesFormula(tmp_path):
+    filename = tmp_path / "expression.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "T"\n'
+                        '    field "Total"\n'
+                        '        field-type "expression"\n'
+                        '        own-fields ["hours"]\n'
+                        '        child-fields ["Total"]\n'
+                        '        sibling-fields []\n'
+                        '        parent-fields []\n'
+                        '        expression "hours + sum(children(\\"Total\\"))"\n\n'
+                        '--item-types--\n\n'
+                        'item Entry\n'
+                        '    fields {"hours": {"type": "integer", "content": ""}}\n'
+                        '    trees [[]]\n\n'
+                        '--item-pool--\n\n'
+                        'item P\n'
+                        '    fields {"hours": {"type": "integer", "content": 1}}\n'
+                        '    trees [[0]]\n\n'
+                        'item A\n'
+                        '    fields {"hours": {"type": "integer", "content": 2}}\n'
+                        '    trees [[0, 0]]\n\n')
+    forest = Forest(str(filename))
+    tree = forest.children[0]
+    top = tree.children[0]
+    assert top.fields["Total"].getValue() == 3
+    forest.changeDataFieldName("hours", "spent")
+    assert tree.fields["Total"].expression  == "spent + sum(children('Total'))"
+    assert top.fields["Total"].getValue() == 3
+    forest.changeTreeFieldName("T", "Total", "Sum")
+    assert tree.fields["Sum"].expression  == "spent + sum(children('Sum'))"
+    assert top.fields["Sum"].getValue() == 3
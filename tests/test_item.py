@@ -0,0 +1,66 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+import copy
+
+import pytest
+
+from treetime.item import Item
+
+
+@pytest.mark.parametrize("content, value", [("", None), (None, None), ("12", 12), (" 7 ", 7), ("1.5", 1.5),
+                                            ("1e3", 1000.0), (3, 3), (2.5, 2.5), (True, 1)])
+def testNumericContent(content, value):
+    assert Item.numericContent(content) == (value, True)
+
+
+@pytest.mark.parametrize("content", ["abc", "nan", "inf", "-Infinity", "1e999", "1_000", "1_0.5", float("nan"),
+                                     float("inf"), [1], {"a": 1}])
+def testInvalidNumericContent(content):
+    assert Item.numericContent(content) == (None, False)
+
+
+def testCoerceNumbers():
+    item = Item("test", '{"a": {"type": "integer", "content": "3"}, "b": {"type": "timer", "content": NaN}, '
+                        '"c": {"type": "string", "content": "nan"}}')
+    invalid = item.coerceNumbers()
+    assert len(invalid) == 1 and invalid[0][0] == "b"
+    assert item.fields["a"]["content"] == 3
+    assert item.fields["b"]["content"] is None
+    assert item.fields["c"]["content"] == "nan"
+
+
+def testItemsHaveSlots():
+    item = Item("test", '{"a": {"type": "string", "content": "x"}}', '[[0, 1], []]')
+    assert not hasattr(item, "__dict__")
+    assert not hasattr(item.views[0], "__dict__")
+    with pytest.raises(AttributeError):
+        item.other = 1
+    assert item.paths == [(0, 1), ()]
+    assert item.trees == [(0, 1), ()]
+
+
+def testItemCopy():
+    item = Item("test", '{"a": {"type": "string", "content": "x"}}', '[[0, 1], []]')
+    item.views[0].nameChange = lambda name: None
+    duplicate = copy.deepcopy(item)
+    assert duplicate.name == "test" and duplicate.trees == [(0, 1), ()]
+    assert duplicate.fields == item.fields and duplicate.fields is not item.fields
+    assert duplicate.views[0] is not item.views[0]
+    assert duplicate.views[0].nameChange is None
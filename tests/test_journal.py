@@ -0,0 +1,156 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+import os
+
+import pytest
+
+from treetime.tree import Forest
+
+
+def journalForest(tmp_path):
+    """
+    :return: A forest with one tree of the items A, B, C, each with a number field "n"
+    """
+    filename = tmp_path / "journal.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "T"\n'
+                        '    field "Sum"\n'
+                        '        field-type "sum"\n'
+                        '        own-fields ["n"]\n'
+                        '        child-fields ["Sum"]\n'
+                        '        sibling-fields []\n'
+                        '        parent-fields []\n\n'
+                        '--item-types--\n\n'
+                        'item Entry\n'
+                        '    fields {"n": {"type": "integer", "content": ""}}\n'
+                        '    trees [[]]\n\n'
+                        '--item-pool--\n\n'
+                        + ''.join(f'item {name}\n'
+                                  f'    fields {{"n": {{"type": "integer", "content": {n}}}}}\n'
+                                  f'    trees [[{n}]]\n\n' for n, name in enumerate("ABC")))
+    return Forest(str(filename))
+
+
+def edit(forest, index, name=None, n=None):
+    item = forest.children[0].children[index].item
+    if name is not None:
+        item.changeName(name)
+        assert forest.journalChange(item)
+    if n is not None:
+        item.changeFieldContent("n", str(n))
+        assert forest.journalChange(item, "n")
+
+
+def contents(forest):
+    return [(node.name, node.item.fields["n"]["content"]) for node in forest.children[0].children]
+
+
+def testReplayAfterCrash(tmp_path):
+    forest = journalForest(tmp_path)
+    edit(forest, 0, n=10)
+    edit(forest, 1, name="Z")
+    edit(forest, 0, n=11)
+    expected = contents(forest)
+    reloaded = Forest(forest.journal.filename)
+    assert contents(reloaded) == expected
+    assert reloaded.children[0].children[0].fields["Sum"].getValue() == 11
+
+
+def testIncompleteLineIsCutOff(tmp_path):
+    forest = journalForest(tmp_path)
+    edit(forest, 2, n=7)
+    with open(forest.journal.journalName(), "a") as f:
+        f.write('{"tree": 0, "pa')
+    reloaded = Forest(forest.journal.filename)
+    assert reloaded.children[0].children[2].item.fields["n"]["content"] == 7
+    edit(reloaded, 1, n=5)
+    assert contents(Forest(forest.journal.filename)) == [("A", 0), ("B", 5), ("C", 7)]
+
+
+def testWritingEmptiesJournal(tmp_path):
+    forest = journalForest(tmp_path)
+    edit(forest, 0, n=10)
+    forest.writeToFile(forest.journal.filename)
+    assert not os.path.exists(forest.journal.journalName())
+    assert contents(Forest(forest.journal.filename))[0] == ("A", 10)
+
+
+def testJournalOfOtherVersionIsRemoved(tmp_path):
+    forest = journalForest(tmp_path)
+    edit(forest, 0, n=10)
+    with open(forest.journal.filename, "a") as f:
+        f.write("\n")
+    reloaded = Forest(forest.journal.filename)
+    assert contents(reloaded)[0] == ("A", 0)
+    assert not os.path.exists(forest.journal.journalName())
+
+
+def testChangesWhileWritingGoToNextJournal(tmp_path):
+    forest = journalForest(tmp_path)
+    journal = forest.journal
+    content = open(journal.filename).read()
+    edit(forest, 0, n=10)
+    with journal.compaction(journal.filename):
+        assert not journal.lock.locked()
+        with open(journal.filename, "w") as f:
+            f.write(content + "\n")      # a new version of the file, without the change of A
+        edit(forest, 1, n=20)
+        assert os.path.exists(journal.segmentName())
+    assert not os.path.exists(journal.segmentName())
+    assert contents(Forest(journal.filename)) == [("A", 0), ("B", 20), ("C", 2)]
+
+
+def testFailedWriteKeepsChanges(tmp_path):
+    forest = journalForest(tmp_path)
+    journal = forest.journal
+    edit(forest, 0, n=10)
+    with pytest.raises(OSError):
+        with journal.compaction(journal.filename):
+            edit(forest, 1, n=20)
+            raise OSError("disk full")
+    assert not os.path.exists(journal.segmentName())
+    edit(forest, 2, n=30)
+    assert contents(Forest(journal.filename)) == [("A", 10), ("B", 20), ("C", 30)]
+
+
+def testNextJournalIsReplayed(tmp_path):
+    forest = journalForest(tmp_path)
+    journal = forest.journal
+    edit(forest, 0, n=10)
+    with pytest.raises(OSError):
+        with journal.compaction(journal.filename):
+            edit(forest, 1, n=20)
+            os.rename(journal.segmentName(), journal.segmentName() + ".kept")
+            raise OSError("stopped")
+    os.rename(journal.segmentName() + ".kept", journal.segmentName())    # as left when the program stopped
+    reloaded = Forest(journal.filename)
+    assert contents(reloaded) == [("A", 10), ("B", 20), ("C", 2)]
+    assert not os.path.exists(journal.segmentName())
+    edit(reloaded, 2, n=30)
+    assert contents(Forest(journal.filename)) == [("A", 10), ("B", 20), ("C", 30)]
+
+
+def testSuspendedJournalRecordsNothing(tmp_path):
+    forest = journalForest(tmp_path)
+    forest.journal.suspend()
+    item = forest.children[0].children[0].item
+    assert not forest.journalChange(item, "n")
+    forest.writeToFile(forest.journal.filename)
+    assert forest.journalChange(item, "n")
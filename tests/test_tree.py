@@ -0,0 +1,798 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+import copy
+import datetime
+import io
+import json
+import math
+import os
+import random
+import time
+
+import pytest
+
+from treetime.aggregate import Aggregate
+from treetime.item import ItemPool
+from treetime.tree import BranchAggregates, Field, FieldDependencies, FileReader, Forest, Node
+
+
+def item(name, label, path):
+    return ('item ' + name + '\n'
+            '    fields {"label": {"type": "string", "content": "' + label + '"}}\n'
+            '    trees [' + str(path) + ']\n\n')
+
+
+def field(name, fieldType, own=(), child=(), sibling=(), parent=(), hidden=False):
+    return ('    field "' + name + '"\n'
+            '        field-type "' + fieldType + '"\n'
+            '        own-fields ' + json.dumps(list(own)) + '\n'
+            '        child-fields ' + json.dumps(list(child)) + '\n'
+            '        sibling-fields ' + json.dumps(list(sibling)) + '\n'
+            '        parent-fields ' + json.dumps(list(parent)) + '\n'
+            + ('        hidden\n' if hidden else ''))
+
+
+def entry(name, amount, tag, paths):
+    return ('item ' + name + '\n'
+            '    fields ' + json.dumps({"amount": {"type": "integer", "content": amount},
+                                        "tag": {"type": "string", "content": tag}}) + '\n'
+            '    trees ' + json.dumps(paths) + '\n\n')
+
+
+Entries = [("R", 1, "r", [0]), ("A", 2, "a", [0, 0]), ("A1", 3, "x", [0, 0, 0]), ("A2", 4, "y", [0, 0, 1]),
+           ("B", 5, "b", [0, 1]), ("B1", 6, "x", [0, 1, 0]), ("S", 7, "s", [1])]
+
+
+def numberForest(tmp_path, fields=None, entries=Entries):
+    """
+    :param fields: The field definitions of the tree, all aggregate types reading "amount" or "tag" if None
+    :param entries: The items, as list of (name, amount, tag, path)
+    :return: A forest with one tree: R with the children A (A1, A2) and B (B1), and S, each item with a number field
+        "amount" and a string field "tag"
+    """
+    if fields is None:
+        fields = (field("Total", "sum", ["amount"], ["Total"]) + field("Avg", "mean", ["amount"], ["amount"])
+                  + field("Lo", "min", ["amount"], ["Lo"]) + field("Hi", "max", ["amount"], ["Hi"])
+                  + field("Prod", "product", ["amount"], ["amount"])
+                  + field("Diff", "difference", ["Total", "amount"], [], ["amount"])
+                  + field("Share", "ratio-percent", ["Total"], [], ["Total"])
+                  + field("Up", "ratio", ["Total"], [], [], ["Total"])
+                  + field("Tags", "set", ["tag"], ["Tags"]) + field("Text", "string", ["tag"], ["Text"])
+                  + field("First", "min-string", ["tag"], ["First"]) + field("Last", "max-string", ["tag"], ["Last"]))
+    filename = tmp_path / "numbers.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "T"\n' + fields + '\n'
+                        '--item-types--\n\n'
+                        + entry("Entry", "", "", [[]]) +
+                        '--item-pool--\n\n'
+                        + ''.join(entry(name, amount, tag, [path]) for name, amount, tag, path in entries))
+    return Forest(str(filename))
+
+
+def findItem(forest, name):
+    return forest.children[0].findNodeByName(name).item
+
+
+def allNodes(tree):
+    """
+    :return: All nodes of a tree, without the tree itself
+    """
+    nodes = []
+    branches = list(tree.children)
+    while branches:
+        node = branches.pop()
+        nodes += [node]
+        branches += node.children
+    return nodes
+
+
+def values(forest):
+    """
+    :return: The displayed values of all fields of all nodes, by tree and node path
+    """
+    return {(tree.name, node.path): (node.name, {name: f.getString() for name, f in node.fields.items()})
+            for tree in forest.children for node in allNodes(tree)}
+
+
+def freshValues(forest, tmp_path):
+    """
+    :return: The values of the forest when it is calculated from scratch, after writing and reading it again
+    """
+    filename = tmp_path / "fresh.trt"
+    forest.writeToFile(str(filename))
+    return values(Forest(str(filename)))
+
+
+def renameForest(tmp_path):
+    """
+    :return: A forest with one tree, a node G with the child P, which has the children A, B, C, and string fields
+        joining the labels of the children ("Str") and of the siblings ("Sib") in name order
+    """
+    filename = tmp_path / "rename.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "T"\n'
+                        '    field "Str"\n'
+                        '        field-type "string"\n'
+                        '        own-fields ["label"]\n'
+                        '        child-fields ["Str"]\n'
+                        '        sibling-fields []\n'
+                        '        parent-fields []\n'
+                        '    field "Sib"\n'
+                        '        field-type "string"\n'
+                        '        own-fields ["label"]\n'
+                        '        child-fields []\n'
+                        '        sibling-fields ["label"]\n'
+                        '        parent-fields []\n\n'
+                        '--item-types--\n\n'
+                        + item("Entry", "", []) +
+                        '--item-pool--\n\n'
+                        + item("G", "", [0]) + item("P", "", [0, 0]) + item("A", "a", [0, 0, 0])
+                        + item("B", "b", [0, 0, 1]) + item("C", "c", [0, 0, 2]))
+    return Forest(str(filename))
+
+
+def testRenameReordersChildValues(tmp_path):
+    forest = renameForest(tmp_path)
+    top = forest.children[0].children[0]
+    parent = top.children[0]
+    assert parent.fields["Str"].getString() == "abc"
+    assert top.fields["Str"].getString() == "abc"
+    parent.children[0].item.changeName("Z")
+    assert parent.fields["Str"].getString() == "bca"
+    assert top.fields["Str"].getString() == "bca"
+
+
+def testRenameReordersSiblingValues(tmp_path):
+    forest = renameForest(tmp_path)
+    parent = forest.children[0].children[0].children[0]
+    assert parent.children[1].fields["Sib"].getString() == "bac"
+    parent.children[0].item.changeName("Z")
+    assert parent.children[1].fields["Sib"].getString() == "bca"
+
+
+def testNewTreeKeepsPathsOfMovedNodes(tmp_path):
+    forest = renameForest(tmp_path)
+    forest.newTree()
+    parent = forest.children[0].children[0].children[0]
+    first = parent.children[0]
+    new = forest.itemPool.copyItem(first.item)
+    new.name = "N"
+    node = parent.addItemAsChild(new)
+    parent.removeChild(first)
+    node.addNodeAsChild(first)
+    assert first.item.trees == [(0, 0, 2, 0), ()]
+    filename = tmp_path / "saved.trt"
+    forest.writeToFile(str(filename))
+    reloaded = Forest(str(filename))
+    moved = reloaded.children[0].children[0].children[0].children[2].children[0]
+    assert moved.name == first.name
+
+
+def crossForest(tmp_path):
+    """
+    :return: A forest with two trees. In the second tree, the item Y is a child of X, in the first tree both are at the
+        top, with fields showing the name and path of their parent in the second tree
+    """
+    filename = tmp_path / "cross.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "A"\n'
+                        '    field "Where"\n'
+                        '        field-type "node-name"\n'
+                        '        own-fields []\n'
+                        '        child-fields []\n'
+                        '        sibling-fields []\n'
+                        '        parent-fields [1]\n'
+                        '    field "Path"\n'
+                        '        field-type "node-path"\n'
+                        '        own-fields []\n'
+                        '        child-fields []\n'
+                        '        sibling-fields []\n'
+                        '        parent-fields [1]\n\n'
+                        'tree "B"\n\n'
+                        '--item-types--\n\n'
+                        + item("Entry", "", "[], []") +
+                        '--item-pool--\n\n'
+                        + item("X", "", "[0], [0]") + item("Y", "", "[1], [0, 0]"))
+    return Forest(str(filename))
+
+
+def testNodeNameFieldsAfterNewTree(tmp_path):
+    forest = crossForest(tmp_path)
+    node = forest.children[0].children[1]
+    assert node.fields["Where"].getString() == "X"
+    forest.newTree()
+    assert node.fields["Where"].getValueNodeName() == "X"
+    assert node.fields["Path"].getValueNodePath() == "X"
+
+
+def testNodeNameFieldsOfUnlinkedItem(tmp_path):
+    forest = crossForest(tmp_path)
+    node = forest.children[0].children[1]
+    node.item.clearCallbacks()
+    assert node.item.viewNodes == [None, None]
+    assert node.fields["Where"].getValueNodeName() == "X"
+    assert node.fields["Path"].getValueNodePath() == "X"
+
+
+def testCachedValuesMatchFreshValues(tmp_path):
+    forest = numberForest(tmp_path)
+    assert values(forest) == freshValues(forest, tmp_path)
+
+    # changes of content, a move, a new node, and a deletion
+    findItem(forest, "A1").changeFieldContent("amount", "10")
+    assert values(forest) == freshValues(forest, tmp_path)
+    findItem(forest, "B1").changeFieldContent("tag", "c")
+    assert values(forest) == freshValues(forest, tmp_path)
+    moved = findItem(forest, "B1")
+    moved.moveInTree(0, [0, 0])
+    moved.notifyFieldChange("")
+    assert values(forest) == freshValues(forest, tmp_path)
+    new = forest.itemPool.copyItem(forest.itemTypes.items[0])
+    new.name = "N"
+    new.fields["amount"]["content"] = 9
+    forest.children[0].findNodeByName("S").addItemAsChild(new)
+    assert values(forest) == freshValues(forest, tmp_path)
+    forest.itemPool.deleteItem(findItem(forest, "A2"))
+    assert values(forest) == freshValues(forest, tmp_path)
+    findItem(forest, "A").changeFieldContent("amount", "")
+    assert values(forest) == freshValues(forest, tmp_path)
+
+
+def testCachedValueIsKeptUntilChange(tmp_path):
+    forest = numberForest(tmp_path)
+    top = forest.children[0].children[0]
+    assert top.fields["Total"].getValue() == 1 + 2 + 3 + 4 + 5 + 6
+    assert not top.fields["Total"].dirty
+    findItem(forest, "A1").changeFieldContent("amount", "13")
+    assert top.fields["Total"].dirty
+    assert top.fields["Total"].getValue() == 31
+    assert forest.children[0].children[1].fields["Total"].dirty is False
+
+
+def testDependencies():
+    fields = {"Total": Field(fieldType="sum", ownFields=["amount"], childFields=["Total"]),
+              "Diff": Field(fieldType="difference", ownFields=["Total", "amount"], siblingFields=["amount"]),
+              "Share": Field(fieldType="ratio", ownFields=["Total"], siblingFields=["Total"]),
+              "Tags": Field(fieldType="set", ownFields=["tag"], childFields=["Tags"])}
+    dependencies = FieldDependencies(fields)
+    assert dependencies.affected(("amount",), 'own') == ("Total", "Diff", "Share")
+    assert dependencies.affected(("tag",), 'own') == ("Tags",)
+    assert set(dependencies.affected(("Total",), 'child')) == {"Total", "Diff", "Share"}
+    assert dependencies.affected(("amount",), 'sibling') == ("Diff",)
+    assert set(dependencies.affected(("Total",), 'sibling')) == {"Share"}
+    assert dependencies.affected(("tag",), 'parent') == ()
+    assert set(dependencies.dependents("Total")) == {"Total", "Diff", "Share"}
+    assert dependencies.cycles() == []
+
+
+def testChangeRecalculatesOnlyAffectedFields(tmp_path):
+    forest = numberForest(tmp_path)
+    values(forest)
+    top = forest.children[0].children[0]
+    findItem(forest, "A1").changeFieldContent("tag", "z")
+    assert top.fields["Tags"].dirty
+    assert not top.fields["Total"].dirty
+    assert not top.fields["Hi"].dirty
+    assert top.fields["Tags"].getString() == "a, b, r, x, y, z"
+
+
+def testIncrementalUpdatesMatchFreshValues(tmp_path):
+    forest = numberForest(tmp_path)
+    values(forest)
+    generator = random.Random(3)
+    for step in range(40):
+        item = findItem(forest, generator.choice(Entries)[0])
+        item.changeFieldContent("amount", generator.choice(["", "0", "1", "-4", "2.5", "1e300", "x"]))
+        if step % 8 == 7:
+            assert values(forest) == freshValues(forest, tmp_path)
+
+
+@pytest.mark.parametrize("amounts", [[1, 2, 3, 4, 5, 6, 7], [1.5, "", 0.25, -3, "x", 6, 0],
+                                     [1e300, 1, -1e300, 2, 3, 4, 5]])
+def testBranchAggregatesMatchNodeValues(tmp_path, amounts):
+    pytest.importorskip("numpy")
+    forest = numberForest(tmp_path)
+    tree = forest.children[0]
+    for (name, amount, tag, path), content in zip(Entries, amounts):
+        findItem(forest, name).fields["amount"]["content"] = content
+    branches = BranchAggregates(tree)
+    tree.clearFieldCache()
+    for name in ("Total", "Avg", "Lo", "Hi"):
+        calculated = branches.calculate(name, tree.fields[name])
+        expected = [node.fields[name].getValue() for node in branches.nodes]
+        if calculated is not None:
+            assert calculated == expected
+            assert [type(v) for v in calculated] == [type(v) for v in expected]
+        else:
+            assert 1e300 in amounts     # sums that are not exact in floats are left to the aggregates
+
+
+def timerForest(tmp_path):
+    """
+    :return: A forest with one tree: P with the children A and B, each with a timer field "hours", the timer of A
+        running since 10:00
+    """
+    def timer(name, hours, since, path):
+        content = {"type": "timer", "content": hours}
+        if since:
+            content["running_since"] = since
+        return 'item ' + name + '\n    fields ' + json.dumps({"hours": content}) + '\n    trees [' + path + ']\n\n'
+
+    filename = tmp_path / "timer.trt"
+    filename.write_text('--trees--\n\n'
+                        'tree "T"\n' + field("Time", "sum-time", ["hours"], ["Time"]) + '\n'
+                        '--item-types--\n\n'
+                        + timer("Entry", "", None, "[]") +
+                        '--item-pool--\n\n'
+                        + timer("P", 1, None, "[0]") + timer("A", 0.5, "2026-10-18 10:00:00", "[0, 0]")
+                        + timer("B", 2, None, "[0, 1]"))
+    return Forest(str(filename))
+
+
+def testRunningTimersAreRefreshedOncePerTick(tmp_path, monkeypatch):
+    start = datetime.datetime(2026, 10, 18, 10).timestamp()
+    monkeypatch.setattr(time, "time", lambda: start + 3600)
+    forest = timerForest(tmp_path)
+    top = forest.children[0].children[0]
+    assert [item.name for item, name in forest.timers.running] == ["A"]
+    assert top.fields["Time"].getValue() == pytest.approx(1 + 0.5 + 1 + 2)
+    sent = []
+    top.registerFieldChangeCallback(lambda name, content: sent.append(name))
+    monkeypatch.setattr(time, "time", lambda: start + 2 * 3600)
+    forest.timers.tick()
+    assert sent == ["Time"]
+    assert top.fields["Time"].getValue() == pytest.approx(1 + 0.5 + 2 + 2)
+
+    # a stopped timer is dropped at the next tick
+    del findItem(forest, "A").fields["hours"]["running_since"]
+    forest.timers.tick()
+    assert forest.timers.running == {}
+
+
+def testSiblingValuesFromParentTotals(tmp_path):
+    amounts = [4, "", 2.5, -1, "x", 7, 0, 4]
+    entries = [("P", 0, "", [0])] + [(f"C{n}", a, "", [0, n]) for n, a in enumerate(amounts)]
+    fields = (field("Sum", "sum", [], [], ["amount"]) + field("Mean", "mean", [], [], ["amount"])
+              + field("Min", "min", [], [], ["amount"]) + field("Max", "max", [], [], ["amount"])
+              + field("Prod", "product", [], [], ["amount"]))
+    forest = numberForest(tmp_path, fields, entries)
+    parent = forest.children[0].children[0]
+
+    def check():
+        for child in parent.children:
+            others = [c.item.fields["amount"]["content"] for c in parent.children if c is not child]
+            numbers = [v for v in others if isinstance(v, (int, float))]
+            assert child.fields["Sum"].getValue() == sum(numbers)
+            assert child.fields["Mean"].getValue() == (sum(numbers) / len([v for v in others if v])
+                                                       if [v for v in others if v] else None)
+            assert child.fields["Min"].getValue() == min(numbers, default=float("inf"))
+            assert child.fields["Max"].getValue() == max(numbers, default=float("-inf"))
+            assert child.fields["Prod"].getValue() == math.prod(numbers)
+
+    check()
+    findItem(forest, "C3").changeFieldContent("amount", "12")
+    check()
+    findItem(forest, "C5").changeFieldContent("amount", "")
+    check()
+    new = forest.itemPool.copyItem(forest.itemTypes.items[0])
+    new.name = "N"
+    new.fields["amount"]["content"] = -6
+    parent.addItemAsChild(new)
+    check()
+    forest.itemPool.deleteItem(findItem(forest, "C0"))
+    check()
+
+
+def testBatchSendsEachFieldOnce(tmp_path):
+    forest = numberForest(tmp_path)
+    values(forest)
+    top = forest.children[0].children[0]
+    sent = []
+    top.registerFieldChangeCallback(lambda name, content: sent.append((name, content)))
+    with forest.batch():
+        for amount in range(10):
+            findItem(forest, "A1").changeFieldContent("amount", str(amount))
+            findItem(forest, "B1").changeFieldContent("amount", str(amount))
+            with forest.batch():
+                findItem(forest, "A2").changeFieldContent("amount", "1")
+        assert sent == []
+    names = [name for name, content in sent]
+    assert sorted(names) == sorted(set(names))
+    assert ("Total", top.fields["Total"].getString()) in sent
+    assert top.fields["Total"].getValue() == 1 + 2 + 9 + 1 + 5 + 9
+    assert values(forest) == freshValues(forest, tmp_path)
+
+
+def testBatchSendsChangesAfterError(tmp_path):
+    forest = numberForest(tmp_path)
+    values(forest)
+    top = forest.children[0].children[0]
+    sent = []
+    top.registerFieldChangeCallback(lambda name, content: sent.append(name))
+    with pytest.raises(RuntimeError):
+        with forest.batch():
+            findItem(forest, "A1").changeFieldContent("amount", "30")
+            raise RuntimeError()
+    assert "Total" in sent
+    sent.clear()
+    findItem(forest, "A1").changeFieldContent("amount", "31")
+    assert "Total" in sent
+
+
+def testHiddenFieldsAreOnlyCalculatedWhenRead(tmp_path):
+    fields = (field("Total", "sum", ["amount"], ["Total"])
+              + field("Secret", "product", ["amount"], ["Secret"], hidden=True)
+              + field("Helper", "sum", ["amount"], ["Helper"], hidden=True) + field("Copy", "max", ["Helper"]))
+    forest = numberForest(tmp_path, fields)
+    tree = forest.children[0]
+    top = tree.children[0]
+    assert tree.fieldOrder == ["Total", "Copy"]
+    assert top.fields["Copy"].getValue() == 21
+    sent = []
+    top.registerFieldChangeCallback(lambda name, content: sent.append(name))
+    findItem(forest, "A1").changeFieldContent("amount", "10")
+    assert sorted(sent) == ["Copy", "Total"]
+    assert top.fields["Secret"].dirty
+    assert top.fields["Copy"].getValue() == 28
+    assert top.fields["Secret"].getValue() == 1 * 2 * 10 * 4 * 5 * 6
+
+
+def testNumbersAreReadWhenLoading(tmp_path, capsys):
+    amounts = ["12", "2.5", "", "abc", "inf", 3, "1_000", None]
+    entries = [("P", 0, "", [0])] + [(f"C{n}", a, "", [0, n]) for n, a in enumerate(amounts)]
+    forest = numberForest(tmp_path, field("Total", "sum", ["amount"], ["Total"]), entries)
+    contents = [c.item.fields["amount"]["content"] for c in forest.children[0].children[0].children]
+    assert contents == [12, 2.5, None, None, None, 3, None, None]
+    assert "3 values of number and timer fields are not numbers" in capsys.readouterr().out
+    assert forest.children[0].children[0].fields["Total"].getValue() == 17.5
+
+
+def testStringFieldsReferenceChildValues(tmp_path):
+    fields = field("Text", "string", ["tag"], ["Text"]) + field("Tags", "set", ["tag"], ["Tags"])
+    forest = numberForest(tmp_path, fields)
+    top = forest.children[0].children[0]
+    first = top.children[0]
+    assert top.fields["Text"].getString() == "raxybx"
+    assert top.fields["Text"].getValue().parts[1] is first.fields["Text"].getValue()
+    assert top.fields["Tags"].getValue() == {"r", "a", "x", "y", "b"}
+    findItem(forest, "B1").changeFieldContent("tag", "y")
+    assert top.fields["Text"].getString() == "raxyby"
+    assert top.fields["Tags"].getValue() == {"r", "a", "x", "y", "b"}
+    findItem(forest, "A1").changeFieldContent("tag", "")
+    assert top.fields["Tags"].getValue() == {"r", "a", "y", "b"}
+    assert values(forest) == freshValues(forest, tmp_path)
+
+
+class SquareSum(Aggregate):
+    """
+    The sum of the squares of the values, merging the states of the children.
+    """
+
+    partial = True
+
+    def init(self):
+        return 0
+
+    def accumulate(self, state, value):
+        return state + value * value if isinstance(value, int) else state
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Longest(Aggregate):
+    """
+    The longest string, without remove() or merge().
+    """
+
+    def init(self):
+        return ""
+
+    def accumulate(self, state, value):
+        return value if isinstance(value, str) and len(value) > len(state) else state
+
+
+Field.registerAggregate("test-square-sum", SquareSum())
+Field.registerAggregate("test-longest", Longest(), "unchanged")
+
+
+def testRegisteredAggregates(tmp_path):
+    assert not Field.registerAggregate("sum", SquareSum())
+    assert not Field.registerAggregate("test-other", SquareSum(), "no-such-display")
+    fields = (field("Squares", "test-square-sum", ["amount"], ["Squares"])
+              + field("Long", "test-longest", ["tag"], ["Long"]) + field("Count", "count", ["amount"], ["Count"]))
+    forest = numberForest(tmp_path, fields)
+    top = forest.children[0].children[0]
+    assert top.fields["Squares"].getValue() == 1 + 4 + 9 + 16 + 25 + 36
+    assert top.fields["Long"].getString() == "r"
+    assert top.fields["Count"].getValue() == 6
+    findItem(forest, "A2").changeFieldContent("amount", "10")
+    findItem(forest, "B1").changeFieldContent("tag", "long")
+    findItem(forest, "A1").changeFieldContent("amount", "")
+    assert top.fields["Squares"].getValue() == 1 + 4 + 100 + 25 + 36
+    assert top.fields["Long"].getString() == "long"
+    assert top.fields["Count"].getValue() == 5
+    assert values(forest) == freshValues(forest, tmp_path)
+
+
+def testSketchFields(tmp_path):
+    fields = (field("Median", "median", ["amount"], ["Median"]) + '        sketch-size 64\n'
+              + field("High", "p90", ["amount"], ["High"]) + field("Kinds", "count-distinct", ["tag"], ["Kinds"]))
+    forest = numberForest(tmp_path, fields)
+    tree = forest.children[0]
+    top = tree.children[0]
+    assert tree.fields["Median"].sketchSize == 64
+    assert top.fields["Median"].getValue() == 3
+    assert top.fields["High"].getValue() == 6
+    assert top.fields["Kinds"].getValue() == 5
+    findItem(forest, "A2").changeFieldContent("amount", "40")
+    findItem(forest, "B").changeFieldContent("amount", "30")
+    findItem(forest, "A1").changeFieldContent("amount", "50")
+    findItem(forest, "A2").changeFieldContent("tag", "x")
+    assert top.fields["Median"].getValue() == 6
+    assert top.fields["Kinds"].getValue() == 4
+    assert values(forest) == freshValues(forest, tmp_path)
+    assert "sketch-size 64" in (tmp_path / "fresh.trt").read_text()
+
+
+@pytest.mark.parametrize("fields, cycles", [
+    ({"A": {"ownFields": ["B"]}, "B": {"ownFields": ["A"]}}, [["A", "B"]]),
+    ({"A": {"ownFields": ["A"]}}, [["A"]]),
+    ({"A": {"siblingFields": ["A"]}}, [["A"]]),
+    ({"A": {"childFields": ["A"], "parentFields": ["A"]}}, [["A"]]),
+    ({"A": {"childFields": ["B"]}, "B": {"parentFields": ["A"]}}, [["A", "B"]]),
+    ({"A": {"childFields": ["A"]}, "B": {"parentFields": ["B"], "ownFields": ["A"]}}, []),
+    ({"A": {"childFields": ["B"]}, "B": {"childFields": ["A"]}}, []),
+])
+def testCycles(fields, cycles):
+    fields = {name: Field(fieldType="sum", **lists) for name, lists in fields.items()}
+    assert [sorted(group) for group in FieldDependencies(fields).cycles()] == cycles
+
+
+def testCyclicFieldsAreNotCalculated(tmp_path, capsys):
+    fields = (field("Total", "sum", ["amount"], ["Total"]) + field("A", "sum", ["B"]) + field("B", "sum", ["A"]))
+    forest = numberForest(tmp_path, fields)
+    assert 'fields "A", "B" read each other in the same node' in capsys.readouterr().out
+    top = forest.children[0].children[0]
+    assert top.fields["A"].getValue() is None
+    assert top.fields["A"].getString() == "[cycle]"
+    assert top.fields["Total"].getValue() == 21
+
+
+def testCyclicParameterChangeIsRefused(tmp_path):
+    forest = numberForest(tmp_path)
+    tree = forest.children[0]
+    top = tree.children[0]
+    parameters = tree.fields["Total"].ownFields
+    old = list(parameters)
+    parameters += ["Share"]     # Share reads Total in the same node
+    assert not forest.updateTreeFieldParameters("T", "Total", "own-fields")
+    parameters[:] = old         # undone by the caller
+    assert not tree.fields["Total"].cyclic
+    assert top.fields["Total"].getValue() == 21
+    assert values(forest) == freshValues(forest, tmp_path)
+
+    # an acyclic change is made
+    parameters += ["Lo"]
+    assert forest.updateTreeFieldParameters("T", "Total", "own-fields")
+    assert top.fields["Total"].getValue() == 2 * 21     # the minimum of each node is its own amount
+
+
+def testFieldDefinitionsAreShared(tmp_path):
+    forest = numberForest(tmp_path)
+    tree = forest.children[0]
+    definition = tree.fields["Total"].definition
+    nodes = allNodes(tree)
+    assert all(node.fields["Total"].definition is definition for node in nodes)
+    assert len({id(node.fields["Total"]) for node in nodes}) == len(nodes)
+    duplicate = copy.deepcopy(tree.fields["Total"])
+    assert duplicate.definition is definition and duplicate.dirty
+
+    # a change of type in the tree changes all nodes
+    forest.children[0].changeFieldType("Total", "max")
+    forest.children[0].updateFieldContent("Total")
+    assert tree.children[0].fields["Total"].fieldType == "max"
+    assert values(forest) == freshValues(forest, tmp_path)
+
+    # a copied definition is independent
+    other = definition.copy()
+    other.ownFields += ["tag"]
+    assert definition.ownFields == ["amount"]
+    assert other.evaluator is definition.evaluator
+
+
+def testNodesAndFieldsHaveSlots(tmp_path):
+    forest = numberForest(tmp_path)
+    node = forest.children[0].children[0]
+    for instance in (node, node.fields["Total"], node.fields["Total"].definition):
+        assert not hasattr(instance, "__dict__")
+        with pytest.raises(AttributeError):
+            instance.other = 1
+    assert node.children[1].children[0].path == (0, 1, 0)
+
+
+def checkNameIndex(tree):
+    names = {}
+    for node in allNodes(tree):
+        names.setdefault(node.name, set()).add(node)
+        assert tree.findNode(node.path) is node
+    assert tree.names == names
+
+
+def testNodeLookups(tmp_path):
+    forest = numberForest(tmp_path)
+    tree = forest.children[0]
+    checkNameIndex(tree)
+    assert tree.findNode((0, 1, 0)).name == "B1"
+    assert tree.findNode((0, 5)) is None
+    assert tree.findNode(()) is tree
+    findItem(forest, "A2").changeName("B1")
+    checkNameIndex(tree)
+    assert tree.findNodeByName("B1").path == (0, 0, 1)     # the first in depth-first order
+    assert tree.children[0].children[1].findNodeByName("B1").path == (0, 1, 0)
+    moved = findItem(forest, "A")
+    moved.moveInTree(0, [1])
+    checkNameIndex(tree)
+    assert tree.findNodeByName("B1").path == (0, 0, 0)
+    new = forest.itemPool.copyItem(forest.itemTypes.items[0])
+    new.name = "N"
+    tree.findNodeByName("A1").addItemAsChild(new)
+    checkNameIndex(tree)
+    forest.itemPool.deleteItem(findItem(forest, "N"))
+    forest.itemPool.deleteItem(findItem(forest, "B1"))
+    checkNameIndex(tree)
+    assert tree.findNodeByName("N") is None
+
+
+def structure(forest):
+    return sorted((node.path, node.name) for tree in forest.children for node in allNodes(tree))
+
+
+def testItemPathsFollowTheNodes(tmp_path):
+    forest = numberForest(tmp_path)
+    forest.itemPool.deleteItem(findItem(forest, "A1"))
+    assert findItem(forest, "A2").trees == [(0, 0, 0)]
+    moved = findItem(forest, "A")
+    moved.moveInTree(0, [1])
+    assert moved.trees == [(1, 0)]
+    assert findItem(forest, "A2").trees == [(1, 0, 0)]
+    assert findItem(forest, "B1").trees == [(0, 0, 0)]
+    for item in forest.itemPool.items:
+        if item.trees[0]:
+            assert forest.children[0].findNode(item.trees[0]).item is item
+    filename = tmp_path / "moved.trt"
+    forest.writeToFile(str(filename))
+    assert structure(Forest(str(filename))) == structure(forest)
+
+
+def testEmptyNodesAreRemovedWhenLoading(tmp_path):
+    entries = [("R", 1, "", [0]), ("A", 2, "", [0, 2]), ("B", 3, "", [0, 5, 1]), ("S", 4, "", [3])]
+    forest = numberForest(tmp_path, field("Total", "sum", ["amount"], ["Total"]), entries)
+    tree = forest.children[0]
+    assert structure(forest) == [((0,), "R"), ((0, 0), "A"), ((0, 1), ""), ((0, 1, 0), "B"), ((1,), "S")]
+    assert tree.findNode((0, 1)).item is None
+    assert [findItem(forest, name).trees for name in "RABS"] == [[(0,)], [(0, 0)], [(0, 1, 0)], [(1,)]]
+    checkNameIndex(tree)
+
+
+def testFileIsReadBySection():
+    reader = FileReader(io.StringIO("--trees--\n\ntree\n--item-types--\nitem E\n--item-pool--\nitem A\nitem B"), "f")
+    assert list(reader.section("--trees--")) == [(2, ""), (3, "tree")]
+    assert list(reader.section("--item-pool--")) == [(7, "item A"), (8, "item B")]
+    with pytest.raises(KeyError, match="section --item-types-- is missing in f"):
+        list(FileReader(io.StringIO("--trees--\n--item-pool--\n"), "f").section("--item-types--"))
+
+
+def testItemsAreReadLineByLine():
+    lines = ['item A', 'with a line break', '    fields {"n": {"type": "integer", "content": 1}}', '    trees [[0]]',
+             '', 'item B', '    fields {}', '    trees [[1]]']
+    items = list(ItemPool.readItems(enumerate(lines, 1)))
+    assert [(it.name, it.trees) for it in items] == [("A\nwith a line break", [(0,)]), ("B", [(1,)])]
+    with pytest.raises(KeyError, match="Line 1 in the file is not part of an item"):
+        list(ItemPool.readItems(enumerate(["fields {}"], 1)))
+    with pytest.raises(KeyError, match="The item \"B\" in line 3 in the file could not be read"):
+        list(ItemPool.readItems(enumerate(["", "", "item B", "    fields {}"], 1)))
+
+
+@pytest.mark.parametrize("name", ["Tutorial", "Work-Plan", "Countries-of-the-World"])
+def testDataFilesAreReadAgainAsWritten(tmp_path, name):
+    forest = Forest(os.path.join(os.path.dirname(__file__), "..", "data", name + ".trt"))
+    filename = tmp_path / "copy.trt"
+    forest.writeToFile(str(filename))
+    copy = Forest(str(filename))
+    assert structure(copy) == structure(forest)
+    assert [it.name for it in copy.itemPool.items] == [it.name for it in forest.itemPool.items]
+
+
+def testDuplicatePathsAreReported(tmp_path):
+    entries = [("A", 1, "", [0]), ("B", 2, "", [1]), ("C", 3, "", [0])]
+    with pytest.raises(KeyError, match=r"The path \[0\] in the tree 0, used by \"C\" is already in use by \"A\""):
+        numberForest(tmp_path, field("Total", "sum", ["amount"], ["Total"]), entries)
+    pool = ItemPool()
+    pool.readFromString(entry("A", 1, "", [[0], []]) + entry("B", 2, "", [[1], []]) + entry("C", 3, "", [[], []]))
+    assert [it.name for it in pool.items] == ["A", "B", "C"]
+    assert pool.existing_paths[0] == {(0,): pool.items[0], (1,): pool.items[1]}
+    assert pool.existing_paths[1] == {}
+
+
+def testForestIsBuiltInOnePass(tmp_path, monkeypatch):
+    calls = {"createPaths": 0, "notifyFieldChange": 0}
+
+    def counted(function):
+        def call(*args, **kwargs):
+            calls[function.__name__] += 1
+            return function(*args, **kwargs)
+        return call
+
+    monkeypatch.setattr(Forest, "createPaths", counted(Forest.createPaths))
+    monkeypatch.setattr(Node, "notifyFieldChange", counted(Node.notifyFieldChange))
+    forest = numberForest(tmp_path)
+    assert calls == {"createPaths": 1, "notifyFieldChange": 0}
+    tree = forest.children[0]
+    for node in allNodes(tree):
+        assert node.fields.keys() == tree.fields.keys()
+        for name, f in node.fields.items():
+            assert f.sourceNode is node
+            assert f.definition is tree.fields[name].definition
+    loaded = values(forest)
+    totals = [(loaded[("T", path)][0], loaded[("T", path)][1]["Total"]) for path in [(0,), (1,)]]
+    assert totals == [("R", "21"), ("S", "7")]
+    tree.clearFieldCache()
+    assert values(forest) == loaded
+
+
+def testFailedSaveKeepsTheFile(tmp_path, monkeypatch):
+    forest = numberForest(tmp_path)
+    filename = tmp_path / "numbers.trt"
+    original = filename.read_text()
+    os.chmod(filename, 0o640)
+    findItem(forest, "A").changeName("Changed")
+
+    def fail(source, target):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", fail)
+        with pytest.raises(OSError, match="disk full"):
+            forest.writeToFile(str(filename))
+    assert filename.read_text() == original
+    assert sorted(os.listdir(tmp_path)) == ["numbers.trt"]
+    forest.writeToFile(str(filename))
+    assert "item Changed\n" in filename.read_text()
+    assert os.stat(filename).st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(tmp_path)) == ["numbers.trt"]
+
+
+def testItemsAreSavedInTreeOrder(tmp_path):
+    forest = numberForest(tmp_path)
+    findItem(forest, "A").moveInTree(0, [1])
+    findItem(forest, "S").moveInTree(0, [0, 0])
+    ordered = list(forest.orderedItems())
+    assert ordered != forest.itemPool.items
+    assert ordered == sorted(forest.itemPool.items, key=lambda it: it.trees)
+    filename = tmp_path / "ordered.trt"
+    forest.writeToFile(str(filename))
+    pool = filename.read_text().split("--item-pool--")[1]
+    names = [line[5:] for line in pool.split("\n") if line.startswith("item ")]
+    assert names == [it.name for it in ordered]
+    assert [it.name for it in Forest(str(filename)).itemPool.items] == names
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(filename).st_mode & 0o777 == 0o666 & ~umask
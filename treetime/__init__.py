@@ -1,4 +1,4 @@
 
-__all__ = ['item', 'tree', 'treetime', 'mainwindow']
+__all__ = ['aggregate', 'expression', 'item', 'tree', 'treetime', 'mainwindow']
 
-from treetime import item, tree, treetime
+from treetime import aggregate, expression, item, tree, treetime
@@ -0,0 +1,800 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+from collections import Counter
+from copy import deepcopy
+from fractions import Fraction
+from hashlib import blake2b
+from heapq import heapify, heappush, heappop
+from math import ceil, inf, isfinite, log
+
+
+def isNumber(value):
+    """
+    :param value: Any field value
+    :return: True if the value takes part in calculations (int, float, or bool), False otherwise
+    """
+    return isinstance(value, (int, float))
+
+
+class Aggregate:
+    """
+    Reduces the values a tree field reads from its related fields into one value.
+    The aggregate itself holds no data, the values are reduced into a state object that is kept by the field. This way
+    one aggregate object serves all fields of a type.
+    An aggregate can remove values from a state again. When a single value changes, the field then removes the old value
+    and adds the new value, instead of reducing all values again.
+    New field types are made by deriving from this class, implementing at least init(), accumulate(), and finalize(),
+    and registering an object with Field.registerAggregate(). Implementing remove() and merge() makes the field cheaper
+    to update, and allows it to combine partial results.
+    """
+
+    ordered = False     # if True, the first value has a special role, and the state can only be built in order
+    invertible = False  # if True, values can be removed from a copy of the state cheaply (see copy() and remove())
+    selective = False   # if True, the result is one of the values, so some values can be replaced by their result
+    partial = False     # if True, a field reading a field of the same type from its children merges the children's
+                        # states (see merge()) instead of accumulating their values, the result is then the reduction
+                        # over all values in the branch
+    size = None         # the size of the state, for aggregates that can be made more exact at the cost of space
+
+    def withSize(self, size):
+        """
+        :param size: The size of the state, see resize()
+        :return: An aggregate like this one, with the given size. Aggregates of the same size are the same object, so
+            the fields of a tree with the same size can merge their states.
+        """
+        if self.size is None or size == self.size:
+            return self
+        self.sizes = getattr(self, 'sizes', {})
+        if size not in self.sizes:
+            self.sizes[size] = self.resize(size)
+        return self.sizes[size]
+
+    def resize(self, size):
+        """
+        :param size: The size of the state
+        :return: A new aggregate like this one, with the given size
+        """
+        raise NotImplementedError
+
+    def init(self):
+        """
+        :return: A new, empty state
+        """
+        return None
+
+    def accumulate(self, state, value):
+        """
+        Adds a value to the state.
+        :param state: The state
+        :param value: The value
+        :return: The new state
+        """
+        return state
+
+    def copy(self, state):
+        """
+        :param state: The state
+        :return: A copy of the state, that can be changed without changing the original
+        """
+        return deepcopy(state)
+
+    def remove(self, state, value):
+        """
+        Removes a value that was added before.
+        :param state: The state
+        :param value: The value
+        :return: The new state
+        """
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        """
+        Adds all values reduced into another state. The other state is not changed, and not referenced by the result.
+        :param state: The state
+        :param other: The other state
+        :return: The new state
+        """
+        raise NotImplementedError
+
+    def finalize(self, state):
+        """
+        :param state: The state
+        :return: The value of the field
+        """
+        return state
+
+
+class ExactSum:
+    """
+    Sum of numbers that can be updated without rounding errors. Ints are added as ints, finite floats as integer
+    multiples of 2**-1074 (the smallest float, every float is an exact multiple of it), infinite floats are kept aside.
+    Removing a value leaves exactly the sum of the remaining values, so an empty or cancelled sum is always exactly
+    zero.
+    """
+
+    Shift = 1074
+
+    def __init__(self):
+        self.integers = 0
+        self.scaled = 0     # sum of the finite floats, in multiples of 2**-1074
+        self.floats = 0     # number of floats in the sum, the sum is an int if there are none
+        self.specials = None
+
+    def copy(self):
+        """
+        :return: A copy of the sum
+        """
+        result = ExactSum()
+        result.integers = self.integers
+        result.scaled = self.scaled
+        result.floats = self.floats
+        result.specials = self.specials and self.specials.copy()
+        return result
+
+    def add(self, value, count=1):
+        """
+        :param value: An int or float
+        :param count: 1 to add the value, -1 to remove it
+        """
+        if isinstance(value, float):
+            self.floats += count
+            if isfinite(value):
+                numerator, denominator = value.as_integer_ratio()
+                self.scaled += count * (numerator << (ExactSum.Shift + 1 - denominator.bit_length()))
+            else:
+                self.specials = self.specials or Counter()
+                self.specials[value] += count
+        else:
+            self.integers += count * value
+
+    def merge(self, other):
+        """
+        :param other: Another sum, whose values are added to this one
+        """
+        self.integers += other.integers
+        self.scaled += other.scaled
+        self.floats += other.floats
+        if other.specials:
+            self.specials = self.specials or Counter()
+            self.specials.update(other.specials)
+
+    def value(self):
+        """
+        :return: The sum, an int if no floats were added, a float otherwise
+        """
+        if not self.floats:
+            return self.integers
+        result = ((self.integers << ExactSum.Shift) + self.scaled) / (1 << ExactSum.Shift)
+        for value, count in (self.specials or {}).items():
+            if count:
+                result += value
+        return result
+
+
+class Rope:
+    """
+    A string made of other strings and ropes. The parts are referenced, not copied, so a field that concatenates the
+    values of its children only holds its children's results, instead of a copy of their characters. The characters
+    are put together whenever the rope is converted to str, and are not kept.
+    """
+
+    def __init__(self, parts):
+        """
+        :param parts: A list of non-empty strings and ropes
+        """
+        self.parts = parts
+        self.length = sum(len(p) for p in parts)
+
+    def __str__(self):
+        pieces = []
+        stack = [self]
+        while stack:
+            part = stack.pop()
+            if isinstance(part, Rope):
+                stack.extend(reversed(part.parts))
+            else:
+                pieces.append(part)
+        return ''.join(pieces)
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __add__(self, other):
+        return Rope([self, other]) if other else self
+
+    def __radd__(self, other):
+        return Rope([other, self]) if other else self
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        return isinstance(other, (str, Rope)) and str(self) == str(other)
+
+    def __lt__(self, other):
+        return str(self) < str(other)
+
+    def __le__(self, other):
+        return str(self) <= str(other)
+
+    def __gt__(self, other):
+        return str(self) > str(other)
+
+    def __ge__(self, other):
+        return str(self) >= str(other)
+
+
+class Sum(Aggregate):
+    """
+    The sum of all values. Values that are not numbers are ignored.
+    """
+
+    invertible = True
+
+    def init(self):
+        return ExactSum()
+
+    def copy(self, state):
+        return state.copy()
+
+    def accumulate(self, state, value):
+        if value and isNumber(value):
+            state.add(value)
+        return state
+
+    def remove(self, state, value):
+        if value and isNumber(value):
+            state.add(value, -1)
+        return state
+
+    def merge(self, state, other):
+        state.merge(other)
+        return state
+
+    def finalize(self, state):
+        return state.value()
+
+
+class Difference(Aggregate):
+    """
+    The difference a - b - c - ... of the values a, b, c, ... The first value is positive, all others negative.
+    """
+
+    ordered = True
+    invertible = True
+
+    def init(self):
+        return [False, ExactSum(), ExactSum()]    # first value seen, first value, sum of the others
+
+    def copy(self, state):
+        return [state[0], state[1].copy(), state[2].copy()]
+
+    def accumulate(self, state, value):
+        if not state[0]:
+            state[0] = True
+            if value and isNumber(value):
+                state[1].add(value)
+        elif value and isNumber(value):
+            state[2].add(value)
+        return state
+
+    def remove(self, state, value):
+        if value and isNumber(value):
+            state[2].add(value, -1)
+        return state
+
+    def finalize(self, state):
+        return state[1].value() - state[2].value()
+
+
+class Mean(Aggregate):
+    """
+    The mean of all values that are set. Values that are not set (zero or empty) are not counted.
+    """
+
+    invertible = True
+
+    def init(self):
+        return [0, ExactSum()]    # number of values, sum
+
+    def copy(self, state):
+        return [state[0], state[1].copy()]
+
+    def accumulate(self, state, value):
+        if value:
+            state[0] += 1
+            if isNumber(value):
+                state[1].add(value)
+        return state
+
+    def remove(self, state, value):
+        if value:
+            state[0] -= 1
+            if isNumber(value):
+                state[1].add(value, -1)
+        return state
+
+    def merge(self, state, other):
+        state[0] += other[0]
+        state[1].merge(other[1])
+        return state
+
+    def finalize(self, state):
+        if state[0] > 0:
+            return float(state[1].value()) / state[0]
+        else:
+            return None
+
+
+class Product(Aggregate):
+    """
+    The product of all values. Values that are not numbers are ignored. Zeros are counted separately, so they can be
+    removed again.
+    """
+
+    invertible = True
+
+    def init(self):
+        return [0, Fraction(1), Counter()]     # number of zeros, product of finite non-zero values, other values
+
+    def copy(self, state):
+        return [state[0], state[1], state[2].copy()]
+
+    def accumulate(self, state, value):
+        if isNumber(value):
+            if not value:
+                state[0] += 1
+            elif isfinite(value):
+                state[1] *= Fraction(value)
+            else:
+                state[2][value] += 1
+        return state
+
+    def remove(self, state, value):
+        if isNumber(value):
+            if not value:
+                state[0] -= 1
+            elif isfinite(value):
+                state[1] /= Fraction(value)
+            else:
+                state[2][value] -= 1
+        return state
+
+    def merge(self, state, other):
+        state[0] += other[0]
+        state[1] *= other[1]
+        state[2].update(other[2])
+        return state
+
+    def finalize(self, state):
+        try:
+            result = float(state[1])
+        except OverflowError:
+            result = state[1] > 0 and inf or -inf
+        if state[0]:
+            result *= 0.0
+        for value, count in state[2].items():
+            result *= value ** count
+        return result
+
+
+class Minimum(Aggregate):
+    """
+    The smallest value, or inf if there are no values. Values that are not numbers are ignored. The values are kept in
+    a heap, removed values are only dropped from the heap when they reach the top, or when the heap has grown to twice
+    the number of values.
+    """
+
+    sign = 1
+    selective = True
+
+    def init(self):
+        return [[], Counter(), 0]    # heap, number of occurrences of each value, number of values
+
+    def accumulate(self, state, value):
+        if isNumber(value) and value == value:
+            heappush(state[0], self.sign * value)
+            state[1][value] += 1
+            state[2] += 1
+            if len(state[0]) > 2 * state[2] + 16:
+                state[0] = [self.sign * v for v, count in state[1].items() for n in range(count)]
+                heapify(state[0])
+        return state
+
+    def remove(self, state, value):
+        if isNumber(value) and value == value:
+            state[1][value] -= 1
+            state[2] -= 1
+        return state
+
+    def merge(self, state, other):
+        for value, count in other[1].items():
+            for n in range(count):
+                state = self.accumulate(state, value)
+        return state
+
+    def finalize(self, state):
+        heap, counts = state[0], state[1]
+        while heap and counts[self.sign * heap[0]] <= 0:
+            counts.pop(self.sign * heappop(heap), None)
+        if heap:
+            return self.sign * heap[0]
+        else:
+            return self.sign * inf
+
+
+class Maximum(Minimum):
+    """
+    The largest value, or -inf if there are no values. Values that are not numbers are ignored.
+    """
+
+    sign = -1
+
+
+class Union(Aggregate):
+    """
+    The union of all values. Sets are joined, other values that are set (not zero or empty) are added as elements. Each
+    element is counted, so the values of a related node can be removed again without collecting all other values.
+    """
+
+    invertible = True
+
+    def init(self):
+        return Counter()    # number of values each element came from
+
+    def copy(self, state):
+        return state.copy()
+
+    def accumulate(self, state, value):
+        if isinstance(value, set):
+            state.update(value)
+        elif value:
+            state[value] += 1
+        return state
+
+    def remove(self, state, value):
+        if isinstance(value, set):
+            elements = value
+        elif value:
+            elements = [value]
+        else:
+            elements = []
+        for element in elements:
+            state[element] -= 1
+            if state[element] <= 0:
+                del state[element]
+        return state
+
+    def merge(self, state, other):
+        state.update(other)
+        return state
+
+    def finalize(self, state):
+        return set(state)
+
+
+class Count(Aggregate):
+    """
+    The number of values that are set (not None or empty). A field counting the values of its own fields and itself in
+    the children counts all values in the branch.
+    """
+
+    invertible = True
+    partial = True
+
+    def init(self):
+        return 0
+
+    def copy(self, state):
+        return state
+
+    def accumulate(self, state, value):
+        if value is not None and value != "":
+            state += 1
+        return state
+
+    def remove(self, state, value):
+        if value is not None and value != "":
+            state -= 1
+        return state
+
+    def merge(self, state, other):
+        return state + other
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of numbers, in the form of a KLL sketch (Karnin, Lang, Liberty: Optimal Quantile
+    Approximation in Streams, 2016). The values are kept in levels, an item in level h stands for 2**h values. When the
+    sketch is full, the lowest full level is sorted, and every other item is moved up one level. The capacity of the
+    levels shrinks by 2/3 from the top level down, so the sketch holds about 3*size items, with a rank error of roughly
+    1/size. As long as fewer than size values have been added, the quantiles are exact.
+    The items to be moved up are chosen alternately (odd or even positions) instead of randomly, so the same values
+    added in the same order always give the same sketch.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: The capacity of the top level
+        """
+        self.size = size
+        self.levels = [[]]
+        self.count = 0      # number of values added
+        self.items = 0      # number of items in all levels
+        self.odd = False
+
+    def copy(self):
+        """
+        :return: A copy of the sketch
+        """
+        result = QuantileSketch(self.size)
+        result.levels = [list(level) for level in self.levels]
+        result.count = self.count
+        result.items = self.items
+        result.odd = self.odd
+        return result
+
+    def capacity(self, level):
+        """
+        :param level: A level
+        :return: The number of items the level may hold
+        """
+        return max(2, ceil(self.size * (2 / 3) ** (len(self.levels) - level - 1)))
+
+    def add(self, value):
+        """
+        :param value: A number
+        """
+        self.levels[0].append(value)
+        self.count += 1
+        self.items += 1
+        self.compress()
+
+    def merge(self, other):
+        """
+        :param other: Another sketch, whose values are added to this one
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self.count += other.count
+        self.items += other.items
+        self.compress()
+
+    def compress(self):
+        """
+        Moves items up until the sketch is not full anymore.
+        """
+        while self.items > sum(self.capacity(h) for h in range(len(self.levels))):
+            for h, level in enumerate(self.levels):
+                if len(level) >= self.capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append([])
+                    level.sort()
+                    kept = len(level) % 2 and [level.pop()] or []     # an odd item out stays
+                    self.odd = not self.odd
+                    moved = level[self.odd::2]
+                    self.levels[h + 1].extend(moved)
+                    self.levels[h] = kept
+                    self.items -= len(level) - len(moved)
+                    break
+
+    def quantile(self, q):
+        """
+        :param q: A number between 0 and 1
+        :return: The smallest value with at least a fraction q of all values at or below it, None if there are no
+            values
+        """
+        items = sorted((value, 1 << h) for h, level in enumerate(self.levels) for value in level)
+        if not items:
+            return None
+        target = q * sum(weight for value, weight in items)
+        rank = 0
+        for value, weight in items:
+            rank += weight
+            if rank >= target:
+                return value
+        return items[-1][0]
+
+
+class Quantile(Aggregate):
+    """
+    A quantile of all values, approximated by a sketch (see QuantileSketch). Values that are not numbers are ignored.
+    A field reading itself in the children merges the children's sketches, so it gives the quantile over all values in
+    the branch, with each node keeping a sketch of fixed size.
+    """
+
+    partial = True
+
+    def __init__(self, quantile, size=200):
+        """
+        :param quantile: The quantile, 0.5 for the median
+        :param size: The size of the sketch, the rank error is about 1/size
+        """
+        self.quantile = quantile
+        self.size = size
+
+    def resize(self, size):
+        return Quantile(self.quantile, size)
+
+    def init(self):
+        return QuantileSketch(self.size)
+
+    def copy(self, state):
+        return state.copy()
+
+    def accumulate(self, state, value):
+        if isNumber(value) and value == value:
+            state.add(value)
+        return state
+
+    def merge(self, state, other):
+        state.merge(other)
+        return state
+
+    def finalize(self, state):
+        return state.quantile(self.quantile)
+
+
+class DistinctSketch:
+    """
+    Approximate number of distinct values, in the form of a HyperLogLog sketch (Flajolet et al.: HyperLogLog: the
+    analysis of a near-optimal cardinality estimation algorithm, 2007). The hash of each value selects one of m
+    registers, which keeps the largest number of leading zeros seen in the rest of the hash. The relative error is
+    about 1.04/sqrt(m). As long as there are few values (up to m/4), their hashes are kept instead, and counted
+    exactly.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: The number of registers, a power of two
+        """
+        self.size = size
+        self.bits = size.bit_length() - 1
+        self.hashes = set()
+        self.registers = None
+
+    def copy(self):
+        """
+        :return: A copy of the sketch
+        """
+        result = DistinctSketch(self.size)
+        result.hashes = set(self.hashes) if self.hashes is not None else None
+        result.registers = bytearray(self.registers) if self.registers is not None else None
+        return result
+
+    @staticmethod
+    def hash(value):
+        """
+        :param value: A value
+        :return: A 64 bit hash of the value, the same in every session. Numbers of equal value have equal hashes.
+        """
+        if isNumber(value) and isfinite(value) and value == int(value):
+            value = int(value)
+        return int.from_bytes(blake2b(repr(value).encode(), digest_size=8).digest(), 'big')
+
+    def add(self, value):
+        """
+        :param value: A hashable value
+        """
+        if self.registers is None:
+            self.hashes.add(DistinctSketch.hash(value))
+            if len(self.hashes) > self.size // 4:
+                self.spill()
+        else:
+            self.insert(DistinctSketch.hash(value))
+
+    def insert(self, h):
+        """
+        :param h: A hash, entered into the registers
+        """
+        rest = h & ((1 << (64 - self.bits)) - 1)
+        rank = 64 - self.bits - rest.bit_length() + 1
+        index = h >> (64 - self.bits)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def spill(self):
+        """
+        Moves from exact counting to the registers.
+        """
+        self.registers = bytearray(self.size)
+        for h in self.hashes:
+            self.insert(h)
+        self.hashes = None
+
+    def merge(self, other):
+        """
+        :param other: Another sketch, whose values are added to this one
+        """
+        if self.registers is None and other.registers is None:
+            self.hashes |= other.hashes
+            if len(self.hashes) > self.size // 4:
+                self.spill()
+            return
+        if self.registers is None:
+            self.spill()
+        if other.registers is None:
+            for h in other.hashes:
+                self.insert(h)
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """
+        :return: The (estimated) number of distinct values
+        """
+        if self.registers is None:
+            return len(self.hashes)
+        m = self.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(m / zeros)     # small range correction
+        return round(estimate)
+
+
+class DistinctCount(Aggregate):
+    """
+    The number of distinct values that are set, approximated by a sketch (see DistinctSketch). Elements of sets are
+    counted separately. A field reading itself in the children merges the children's sketches, so it counts the
+    distinct values in the branch.
+    """
+
+    partial = True
+
+    def __init__(self, size=1024):
+        """
+        :param size: The number of registers of the sketch, rounded down to a power of two (at least 16), the relative
+            error is about 1/sqrt(size)
+        """
+        self.size = 1 << max(4, size.bit_length() - 1)
+
+    def resize(self, size):
+        return DistinctCount(size)
+
+    def init(self):
+        return DistinctSketch(self.size)
+
+    def copy(self, state):
+        return state.copy()
+
+    def accumulate(self, state, value):
+        if isinstance(value, set):
+            for element in value:
+                state.add(element)
+        elif value is not None and value != "":
+            state.add(value)
+        return state
+
+    def merge(self, state, other):
+        state.merge(other)
+        return state
+
+    def finalize(self, state):
+        return state.count()
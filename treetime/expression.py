@@ -0,0 +1,275 @@
+#
+# Tis file is part of TreeTime, a tree editor and data analyser
+#
+# Copyright (C) GPLv3, 2015, Jacob Kanev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# -*- coding:utf-8 -*-
+
+import ast
+import keyword
+from .aggregate import isNumber
+
+
+def numbers(values):
+    """
+    :param values: A list of values, or a single value
+    :return: The values that are numbers (int, float, or bool), as a list
+    """
+    if not isinstance(values, list):
+        values = [values]
+    return [v for v in values if isNumber(v)]
+
+
+def exprSum(values):
+    return sum(numbers(values))
+
+
+def exprMean(values):
+    values = numbers(values)
+    return float(sum(values)) / len(values) if values else None
+
+
+def exprMin(*values):
+    values = numbers(values[0] if len(values) == 1 else list(values))
+    return min(values) if values else None
+
+
+def exprMax(*values):
+    values = numbers(values[0] if len(values) == 1 else list(values))
+    return max(values) if values else None
+
+
+def exprCount(values):
+    if not isinstance(values, list):
+        values = [values]
+    return len([v for v in values if v])
+
+
+def exprAbs(value):
+    return abs(value) if value is not None else None
+
+
+def exprRound(value, digits=0):
+    return round(value, digits) if value is not None else None
+
+
+MaxBits = 10000         # the largest integer results, in bits, larger ones are calculated as floats
+MaxLength = 100000      # the longest strings and lists made by repetition
+
+
+def exprPower(base, exponent):
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 1 and abs(base) > 1 \
+            and base.bit_length() * exponent > MaxBits:
+        base = float(base)     # keep huge integer powers from eating up time and memory, floats overflow instead
+    elif isinstance(exponent, int) and abs(exponent) > 1024:
+        base = float(base)
+    return base ** exponent
+
+
+def exprMultiply(left, right):
+    for sequence, times in ((left, right), (right, left)):
+        if isinstance(sequence, (str, list)) and isinstance(times, int) and len(sequence) * times > MaxLength:
+            raise ValueError(f"result longer than {MaxLength}")
+    if isinstance(left, int) and isinstance(right, int) and left.bit_length() + right.bit_length() > MaxBits:
+        return float(left) * float(right)
+    return left * right
+
+
+def exprModulo(left, right):
+    if isinstance(left, str):
+        raise ValueError("string formatting is not allowed in expressions")
+    return left % right
+
+
+class Expression:
+    """
+    A formula over the values of the related fields, used by the tree field type "expression". The formula is written
+    in Python syntax, restricted to arithmetic, comparisons, conditional expressions, and a few functions. Field values
+    are read with:
+        name or own("name")     the value of a field of the node itself (bare names only for names that are identifiers)
+        children("name")        the list of values of a field in all children
+        siblings("name")        the list of values of a field in all siblings
+        parent("name")          the value of a field in the parent
+    The functions sum(), mean(), min(), max(), and count() take such a list (or single values), and ignore values that
+    are not numbers (count() counts the values that are set); abs() and round() work on single values. Example:
+        planned * rate - sum(children("spent"))
+    The formula is parsed and checked once, and compiled into a code object. Evaluating it per node only looks up the
+    values and runs the code. Expressions are kept in a cache, so all fields with the same formula share one object.
+    Integer results are limited to MaxBits, larger ones are calculated as floats (and may overflow), repeated strings
+    and lists to MaxLength.
+    """
+
+    Cache = {}
+    CacheSize = 1000
+    Relations = {"own": "_own", "children": "_children", "siblings": "_siblings", "parent": "_parent"}
+    Functions = {"sum": exprSum, "mean": exprMean, "min": exprMin, "max": exprMax, "count": exprCount, "abs": exprAbs,
+                 "round": exprRound}
+    Operators = {ast.Pow: "_power", ast.Mult: "_multiply", ast.Mod: "_modulo"}
+    Nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call, ast.Name,
+             ast.Constant, ast.Load, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub,
+             ast.UAdd, ast.Not, ast.And, ast.Or, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+    @staticmethod
+    def compiled(text):
+        """
+        :param text: The formula
+        :return: The compiled expression, from the cache if the formula was compiled before
+        """
+        if text not in Expression.Cache:
+            if len(Expression.Cache) >= Expression.CacheSize:
+                del Expression.Cache[next(iter(Expression.Cache))]     # drop the oldest formula
+            Expression.Cache[text] = Expression(text)
+        return Expression.Cache[text]
+
+    def __init__(self, text):
+        """
+        Parses, checks, and compiles the formula. If the formula cannot be used, the error is kept in self.error, and
+        the expression evaluates to None.
+        :param text: The formula
+        """
+        self.text = text
+        self.error = None
+        self.code = None
+        self.own = []           # the names of the fields read from each relation, in order of appearance
+        self.children = []
+        self.siblings = []
+        self.parent = []
+        if not text.strip():
+            return
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+            tree = self.transform(tree)
+            self.code = compile(ast.fix_missing_locations(tree), '<expression>', 'eval')
+        except SyntaxError as e:
+            self.error = f'syntax error ({e.msg})'
+        except ValueError as e:
+            self.error = str(e)
+        if self.error:
+            self.own, self.children, self.siblings, self.parent = [], [], [], []
+            print(f'Error in expression "{text}": {self.error}.')
+
+    def transform(self, tree):
+        """
+        Checks the syntax tree and replaces all field references by lookups in the value dicts passed to evaluate(), and
+        powers, products, and remainders by calls of exprPower(), exprMultiply(), and exprModulo(), which keep the
+        results small.
+        :param tree: The syntax tree of the formula
+        :return: The changed syntax tree
+        :raise ValueError: If the formula uses anything not allowed in expressions
+        """
+        for node in ast.walk(tree):
+            if not isinstance(node, Expression.Nodes):
+                raise ValueError(f'"{ast.unparse(node)}" is not allowed in expressions')
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float, str)) \
+                    and node.value is not None:
+                raise ValueError(f'constant {node.value!r} is not allowed in expressions')
+            if isinstance(node, ast.Call):
+                name = isinstance(node.func, ast.Name) and node.func.id
+                if name in Expression.Relations:
+                    if len(node.args) != 1 or node.keywords or not isinstance(node.args[0], ast.Constant) \
+                            or not isinstance(node.args[0].value, str):
+                        raise ValueError(f'{name}() takes one field name in quotes')
+                elif name not in Expression.Functions or node.keywords:
+                    raise ValueError(f'"{ast.unparse(node.func)}()" is not an expression function')
+        expression = self
+
+        class References(ast.NodeTransformer):
+
+            def visit_Call(self, node):
+                name = node.func.id
+                if name in Expression.Relations:
+                    return expression.reference(name, node.args[0].value)
+                node.args = [self.visit(arg) for arg in node.args]
+                return node
+
+            def visit_Name(self, node):
+                return expression.reference("own", node.id)
+
+            def visit_BinOp(self, node):
+                node = self.generic_visit(node)
+                function = Expression.Operators.get(type(node.op))
+                if function:
+                    return ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[node.left, node.right],
+                                    keywords=[])
+                return node
+
+        return References().visit(tree)
+
+    def reference(self, relation, name):
+        """
+        Registers a field reference.
+        :param relation: One of 'own', 'children', 'siblings', 'parent'
+        :param name: The field name
+        :return: The syntax tree node looking up the value
+        """
+        names = getattr(self, relation)
+        if name not in names:
+            names += [name]
+        return ast.Subscript(value=ast.Name(id=Expression.Relations[relation], ctx=ast.Load()),
+                             slice=ast.Constant(value=name), ctx=ast.Load())
+
+    def evaluate(self, own, children, siblings, parent):
+        """
+        :param own: Dict field name: value of the fields of the node (None if the node has no such field)
+        :param children: Dict field name: list of values of the fields of the children
+        :param siblings: Dict field name: list of values of the fields of the siblings
+        :param parent: Dict field name: value of the fields of the parent (None if the parent has no such field)
+        :return: The value of the formula, or None if the formula is invalid, or cannot be calculated with these values
+        """
+        if self.code is None:
+            return None
+        values = {"__builtins__": {}, "_own": own, "_children": children, "_siblings": siblings, "_parent": parent,
+                  "_power": exprPower, "_multiply": exprMultiply, "_modulo": exprModulo}
+        values.update(Expression.Functions)
+        try:
+            return eval(self.code, values)
+        except (TypeError, ValueError, ArithmeticError, MemoryError):
+            return None
+
+    @staticmethod
+    def rename(text, oldName, newName):
+        """
+        :param text: A formula
+        :param oldName: A field name
+        :param newName: The new name of the field
+        :return: The formula with all references to the field renamed, or the formula unchanged if it does not refer to
+            the field or is invalid
+        """
+        expression = Expression.compiled(text)
+        if expression.error or oldName not in expression.own + expression.children + expression.siblings \
+                + expression.parent:
+            return text
+
+        class Renaming(ast.NodeTransformer):
+
+            def visit_Call(self, node):
+                if isinstance(node.func, ast.Name) and node.func.id in Expression.Relations:
+                    if node.args[0].value == oldName:
+                        node.args[0] = ast.Constant(value=newName)
+                    return node
+                node.args = [self.visit(arg) for arg in node.args]
+                return node
+
+            def visit_Name(self, node):
+                if node.id != oldName:
+                    return node
+                elif newName.isidentifier() and not keyword.iskeyword(newName) \
+                        and newName not in Expression.Functions and newName not in Expression.Relations:
+                    return ast.Name(id=newName, ctx=ast.Load())
+                else:
+                    return ast.Call(func=ast.Name(id="own", ctx=ast.Load()), args=[ast.Constant(value=newName)],
+                                    keywords=[])
+
+        return ast.unparse(Renaming().visit(ast.parse(text.strip(), mode='eval')))
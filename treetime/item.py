@@ -18,28 +18,44 @@
 # -*- coding:utf-8 -*-
 
 import copy
+import io
 import json
+import math
 from threading import Timer
 
 
+class ItemView:
+    """
+    The link of an item to one tree: the node showing the item in the tree, and the callbacks registered by the node.
+    """
+    __slots__ = ('node', 'nameChange', 'fieldChange', 'fieldNameChange', 'deletion', 'move', 'selection')
+
+    def __init__(self):
+        self.node = None
+        self.nameChange = None
+        self.fieldChange = None
+        self.fieldNameChange = None
+        self.deletion = None
+        self.move = None
+        self.selection = None
+
+
 class Item:
     """
-    The list/forest item containing the actual data
+    The list/forest item containing the actual data. The links to the nodes in the trees are kept as one ItemView per
+    tree. The position of the item in each tree is a tuple of child indices (empty if the item is not in the tree), see
+    trees. Items use slots instead of an attribute dict. The memory budget of an item is about 150 bytes, plus about 100
+    bytes per tree (the ItemView and the path), plus the data fields.
     """
     FieldTypes = ('string', 'text', 'longtext', 'url', 'integer', 'timer')
+    __slots__ = ('name', 'parentNames', 'fields', 'paths', 'views')
 
     def __init__(self, name, fieldstring='{}', treestring='[]'):
         self.name = name
         self.parentNames = []
         self.fields = json.loads(fieldstring)
-        self.trees = json.loads(treestring)
-        self.viewNodes = []
-        self.nameChangeCallbacks = []
-        self.fieldChangeCallbacks = []
-        self.fieldNameChangeCallbacks = []
-        self.deletionCallbacks = []
-        self.moveCallbacks = []
-        self.selectionCallbacks = []
+        self.paths = [tuple(path) for path in json.loads(treestring)]
+        self.views = []
         self.clearCallbacks()
 
     def __deepcopy__(self, memo):
@@ -51,21 +67,16 @@ class Item:
         itemType = self.__class__
         newItem = itemType.__new__(itemType)
         
-        # fields and trees are complex
+        # fields are complex, paths are tuples
         newItem.fields = copy.deepcopy(self.fields)
-        newItem.trees = copy.deepcopy(self.trees)
+        newItem.paths = self.trees
+        newItem.views = []
         
         # names are simple
         newItem.name = self.name
         newItem.parentNames = self.parentNames
         
         # everything else should be blank
-        newItem.viewNodes = []
-        newItem.nameChangeCallbacks = []
-        newItem.fieldChangeCallbacks = []
-        newItem.deletionCallbacks = []
-        newItem.moveCallbacks = []
-        newItem.selectionCallbacks = []
         newItem.clearCallbacks()
         
         memo[id(newItem)] = newItem
@@ -77,23 +88,73 @@ class Item:
                                                             json.dumps(self.trees))
         return string
 
+    @property
+    def trees(self):
+        """
+        :return: The paths of the item in all trees, as a list of tuples of child indices (empty if the item is not in
+            the tree). In the trees it is shown in, the path of the item is the path of its node (see Node.path), and
+            only computed here. The paths kept in self.paths are the ones read from the file, used to build the trees,
+            and the target of a move (see moveInTree).
+        """
+        paths = list(self.paths)
+        for t, view in enumerate(self.views):
+            if view.node is not None:
+                paths[t] = view.node.path
+        return paths
+
+    @property
+    def viewNodes(self):
+        """
+        :return: The list of the nodes showing the item, one per tree (None if the item is not in the tree)
+        """
+        return [view.node for view in self.views]
+
     def clearCallbacks(self):
-        self.viewNodes = []
-        self.nameChangeCallbacks = []
-        self.fieldChangeCallbacks = []
-        self.fieldNameChangeCallbacks = []
-        self.deletionCallbacks = []
-        self.moveCallbacks = []
-        self.selectionCallbacks = []
-        for t in self.trees:
-            for p in (self.viewNodes,
-                      self.nameChangeCallbacks,
-                      self.fieldChangeCallbacks,
-                      self.fieldNameChangeCallbacks,
-                      self.deletionCallbacks,
-                      self.moveCallbacks,
-                      self.selectionCallbacks):
-                p += [None]
+        self.paths = self.trees     # keep the current paths, the nodes are unlinked
+        self.views = [ItemView() for t in self.paths]
+
+    @staticmethod
+    def numericContent(content):
+        """
+        Brings the content of an integer or timer field into its canonical form: an int, a float, or None if the field
+        is empty. Numbers written as strings are read, everything else is not a number. Infinite values and NaN are
+        not numbers either, nor are strings with digit separators ("1_000").
+        :param content: The content, as read from a file or converted from another field type
+        :return: A pair (value, valid), valid is False if the content was not empty but could not be read as a number
+        """
+        if content is None or content == "":
+            return None, True
+        elif isinstance(content, bool):
+            return int(content), True
+        elif isinstance(content, int):
+            return content, True
+        elif isinstance(content, float):
+            if math.isfinite(content):
+                return content, True
+        elif isinstance(content, str) and "_" not in content:
+            for number in (int, float):
+                try:
+                    value = number(content)
+                except ValueError:
+                    continue
+                if math.isfinite(value):
+                    return value, True
+                break
+        return None, False
+
+    def coerceNumbers(self):
+        """
+        Brings the content of all integer and timer fields into canonical form (see numericContent()).
+        :return: A list of (field name, content) of all fields whose content was not a number and has been removed
+        """
+        invalid = []
+        for name, field in self.fields.items():
+            if field.get("type") in ("integer", "timer") and "content" in field:
+                content, valid = Item.numericContent(field["content"])
+                if not valid:
+                    invalid += [(name, field["content"])]
+                field["content"] = content
+        return invalid
 
     def addField(self, name, content):
         self.fields[name] = content
@@ -102,15 +163,8 @@ class Item:
         """ Appends a new tree at the end of the tree list
         :return: void
         """
-        self.trees += [[]]
-        for p in (self.viewNodes,
-                  self.nameChangeCallbacks,
-                  self.fieldChangeCallbacks,
-                  self.fieldNameChangeCallbacks,
-                  self.deletionCallbacks,
-                  self.moveCallbacks,
-                  self.selectionCallbacks):
-            p += [None]
+        self.paths += [()]
+        self.views += [ItemView()]
 
     def deleteField(self, name):
         self.fields.pop(name)
@@ -121,15 +175,8 @@ class Item:
         :param n: The tree index
         :return:
         """
-        self.trees.pop(n)
-        for p in (self.viewNodes,
-                  self.nameChangeCallbacks,
-                  self.fieldChangeCallbacks,
-                  self.fieldNameChangeCallbacks,
-                  self.deletionCallbacks,
-                  self.moveCallbacks,
-                  self.selectionCallbacks):
-            p.pop(n)
+        self.paths.pop(n)
+        self.views.pop(n)
 
     def writeToString(self):
         string = self.name + "\n"
@@ -137,14 +184,6 @@ class Item:
         string += "    trees " + json.dumps(self.trees) + "\n"
         return string
 
-    def readFromString(self, string):
-        s = string.split("\n    fields ")
-        self.name = s[0]
-        s = s[1].split("\n    trees ")
-        self.fields = json.loads(s[0])
-        self.trees = json.loads(s[1])
-        self.clearCallbacks()
-
     def printitem(self):
         print(self.name)
         for key in self.fields:
@@ -153,36 +192,36 @@ class Item:
                 print("        ", subkey, ":", self.fields[key][subkey])
 
     def registerViewNode(self, tree, node):
-        self.viewNodes[tree] = node
+        self.views[tree].node = node
 
     def registerNameChangeCallback(self, tree, callback):
-        self.nameChangeCallbacks[tree] = callback
+        self.views[tree].nameChange = callback
 
     def registerSelectionCallback(self, tree, callback):
-        self.selectionCallbacks[tree] = callback
+        self.views[tree].selection = callback
 
     def registerFieldChangeCallback(self, tree, callback):
-        self.fieldChangeCallbacks[tree] = callback
+        self.views[tree].fieldChange = callback
 
     def registerFieldNameChangeCallback(self, tree, callback):
-        self.fieldNameChangeCallbacks[tree] = callback
+        self.views[tree].fieldNameChange = callback
 
     def registerDeletionCallback(self, tree, callback):
-        self.deletionCallbacks[tree] = callback
+        self.views[tree].deletion = callback
 
     def registerMoveCallback(self, tree, callback):
-        self.moveCallbacks[tree] = callback
+        self.views[tree].move = callback
 
     def changeName(self, newName):
         self.name = newName
-        for c in self.nameChangeCallbacks:
-            if c is not None:
-                c(newName)
+        for view in self.views:
+            if view.nameChange is not None:
+                view.nameChange(newName)
     
     def select(self, select):
-        for c in self.selectionCallbacks:
-            if c is not None:
-                c(select)
+        for view in self.views:
+            if view.selection is not None:
+                view.selection(select)
 
     def changeFieldContent(self, fieldName, fieldContent):
         """
@@ -205,7 +244,7 @@ class Item:
                 # changing the content of a number - read the string into a value
                 elif type == "integer":
                     try:
-                        field["content"] = json.loads(fieldContent)
+                        field["content"] = Item.numericContent(json.loads(fieldContent))[0]
                     except json.JSONDecodeError:
                         field["content"] = None
 
@@ -215,7 +254,7 @@ class Item:
                     try:
                         # standard content change, indicated by a tuple
                         if len(fieldContent) == 2:
-                            field["content"] = json.loads(fieldContent[0])
+                            field["content"] = Item.numericContent(json.loads(fieldContent[0]))[0]
                             field["running_since"] = fieldContent[1]
 
                         # just send an empty update message if a timer is running
@@ -239,9 +278,9 @@ class Item:
         """
         notify GUI of field change
         """
-        for f in self.fieldChangeCallbacks:
-            if f is not None:
-                f(fieldName)
+        for view in self.views:
+            if view.fieldChange is not None:
+                view.fieldChange(fieldName)
 
     def changeFieldName(self, oldName, newName):
         """
@@ -259,34 +298,37 @@ class Item:
 
     def changeFieldType(self, field, newType):
         """
-        Change the type of a field
+        Change the type of a field. Numbers and timers are brought into canonical form (see numericContent()).
+        :return: True, or a message if the field does not exist or its content could not be converted
         """
 
         if field not in self.fields:
             return "A field with name " + field + " does not exist in node " + self.name + "."
         else:
             # update field content
+            result = True
             self.fields[field]['type'] = newType
             if newType in ('string', 'text', 'longtext', 'url'):
                 self.fields[field]['content'] = str(self.fields[field]['content'])
             elif newType in ('integer', 'timer'):
-                try:
-                    self.fields[field]['content'] = float(self.fields[field]['content'])
-                except ValueError:
-                    self.fields[field]['content'] = 0.0
+                content, valid = Item.numericContent(self.fields[field]['content'])
+                if not valid:
+                    result = "The content {} of field {} in node {} is not a number and was removed.".format(
+                        json.dumps(self.fields[field]['content']), field, self.name)
+                self.fields[field]['content'] = content
             if newType == 'timer':
                 self.fields[field]['running_since'] = None
             elif 'running_since' in self.fields[field].keys():
                 self.fields[field].pop('running_since')
-        return True
+        return result
 
     def notifyFieldNameChange(self, oldName, newName):
         """
         Notify the tree that a field name has changed. The tree will then re-define the fields that contain this field.
         """
-        for f in self.fieldNameChangeCallbacks:
-            if f is not None:
-                f(oldName, newName)
+        for view in self.views:
+            if view.fieldNameChange is not None:
+                view.fieldNameChange(oldName, newName)
 
     def removeFromTree(self, treeIndex):
         """
@@ -296,7 +338,7 @@ class Item:
         """
 
         # set tree data to None
-        self.trees[treeIndex] = []
+        self.paths[treeIndex] = ()
         self.registerMoveCallback(treeIndex, None)
         self.registerFieldChangeCallback(treeIndex, None)
         self.registerNameChangeCallback(treeIndex, None)
@@ -304,8 +346,8 @@ class Item:
         self.registerSelectionCallback(treeIndex, None)
 
         # Notify own node and view node of deletion
-        if self.deletionCallbacks[treeIndex] is not None:
-            self.deletionCallbacks[treeIndex]()
+        if self.views[treeIndex].deletion is not None:
+            self.views[treeIndex].deletion()
             self.registerDeletionCallback(treeIndex, None)
 
         # Update nodes in other trees
@@ -315,9 +357,9 @@ class Item:
         """
         Move this item to a different parent at the new path
         """
-        self.trees[treeIndex] = parentPath + [0]
-        if self.moveCallbacks[treeIndex] is not None:
-            self.moveCallbacks[treeIndex]()
+        self.paths[treeIndex] = tuple(parentPath) + (0,)
+        if self.views[treeIndex].move is not None:
+            self.views[treeIndex].move()
 
 
 class ItemPool:
@@ -325,66 +367,126 @@ class ItemPool:
     A pool of items. Used to store all the tree nodes (items). The tree-related information is handled in the node
     classes.
     """
+    NextPart = {"item": "fields", "fields": "trees"}     # the parts of an item in the file, and the part following each
 
     def __init__(self):
         """
         Construct
         """
         self.items = []
-        self.existing_paths = []     # all existing paths for each tree, used during loading to check for duplicates
+        self.existing_paths = []     # the items by path for each tree, as dicts path: item, used during loading to check
+                                     # for duplicates
 
     def writeToString(self):
         """
         Writes the whole pool to a re-loadable string
         """
-        string = ""
-        for it in sorted(self.items, key=lambda e: e.trees):
-            string += "item " + it.writeToString() + "\n"
-        return string
+        string = io.StringIO()
+        self.write(string)
+        return string.getvalue()
+
+    def write(self, file, items=None):
+        """
+        Writes the pool to a file, one item at a time
+        :param file: The file, opened for writing
+        :param items: The items in the order they are written, all items sorted by their paths if None (see
+            Forest.orderedItems, which gives this order without sorting)
+        :return: void
+        """
+        if items is None:
+            items = sorted(self.items, key=lambda e: e.trees)
+        for it in items:
+            file.write("item " + it.writeToString() + "\n")
         
     def readFromString(self, string):
         """
         Reads the pool from a string
         """
-
-        # split string and iterate over all parts
-        string = string.split("\n\nitem ")     # items are separated by empty lines and the keyword "item"
-        for s in string:
-            if s != "":
-
-                # read single item
-                it = Item("")
-                try:
-                    it.readFromString(s)
-                except json.decoder.JSONDecodeError as e:
+        self.readFromLines(enumerate(string.split("\n"), 1))
+
+    @staticmethod
+    def readItems(lines):
+        """
+        Reads items, as written by writeToString(), line by line. Each item is returned as soon as it is read:
+            item <name>
+                fields <json>
+                trees <json>
+        followed by an empty line. Lines that don't start a new part continue the current one, as in names with line
+        breaks, or data edited by hand.
+        :param lines: The lines, as pairs (line number, line)
+        :return: A generator of the items
+        :raise KeyError: If an item cannot be read
+        """
+        first = None        # the line number of the current item, None between items
+        parts = {}          # the lines of the current item, as dict part: list of lines
+        part = None
+        for lineNumber, line in lines:
+            if first is None:
+                if line.startswith("item "):
+                    first, parts, part = lineNumber, {"item": [line[5:]]}, "item"
+                elif line.strip():
                     raise KeyError("Corrupt data file. "
-                                   "The item defined by {} in the file could not be read. "
-                                   "Problem: {} when reading {}. "
+                                   "Line {} in the file is not part of an item: \"{}\". "
                                    "Please correct manually in a text editor and then reload the file. "
-                                   "".format(s, e.msg, e.doc))
-
-                # sanity check: look for duplicated paths
-                for i, t in enumerate(it.trees):
-                    if len(self.existing_paths) <= i:
-                        self.existing_paths.append([])
-                    if t:
-
-                        # if we found a duplicated path, raise an exception
-                        if t in self.existing_paths[i]:
-                            found_item = None
-                            for f in self.items:
-                                if f.trees[i] == t:
-                                    found_item = f
-                                    break
-                            raise KeyError("Corrupt data file. "
-                                           "The path {} in the tree {}, used by \"{}\" is already in use by \"{}\". "
-                                           "Please correct manually in a text editor and then reload the file. "
-                                           "".format(t, i, it.name, found_item.name))
-
-                        # if all is fine, add item and proceed
-                        else:
-                            self.existing_paths[i].append(t)
-                self.items += [it]
+                                   "".format(lineNumber, line))
+            elif not line.strip() and part == "trees":
+                yield ItemPool.readItem(first, parts)
+                first = None
+            elif part != "trees" and line.startswith("    " + ItemPool.NextPart[part] + " "):
+                part = ItemPool.NextPart[part]
+                parts[part] = [line[len(part) + 5:]]
+            else:
+                parts[part] += [line]
+        if first is not None:
+            yield ItemPool.readItem(first, parts)
+
+    @staticmethod
+    def readItem(lineNumber, parts):
+        """
+        :param lineNumber: The line number of the item in the file, for error messages
+        :param parts: The lines of the item, as dict part: list of lines
+        :return: The item
+        :raise KeyError: If the item cannot be read
+        """
+        try:
+            if "trees" not in parts:
+                raise ValueError("fields or trees missing")
+            return Item("\n".join(parts["item"]), "\n".join(parts["fields"]), "\n".join(parts["trees"]))
+        except ValueError as e:
+            raise KeyError("Corrupt data file. "
+                           "The item \"{}\" in line {} in the file could not be read. "
+                           "Problem: {}. "
+                           "Please correct manually in a text editor and then reload the file. "
+                           "".format(parts["item"][0], lineNumber, e))
+
+    def readFromLines(self, lines):
+        """
+        Reads the pool line by line (see readItems)
+        :param lines: The lines, as pairs (line number, line)
+        """
+        invalid = []
+        for it in ItemPool.readItems(lines):
+
+            # sanity check: look for duplicated paths, raise an exception if one is found
+            while len(self.existing_paths) < len(it.paths):
+                self.existing_paths.append({})
+            for i, t in enumerate(it.paths):
+                if t:
+                    found_item = self.existing_paths[i].setdefault(t, it)
+                    if found_item is not it:
+                        raise KeyError("Corrupt data file. "
+                                       "The path {} in the tree {}, used by \"{}\" is already in use by \"{}\". "
+                                       "Please correct manually in a text editor and then reload the file. "
+                                       "".format(list(t), i, it.name, found_item.name))
+            invalid += [(it.name, name, content) for name, content in it.coerceNumbers()]
+            self.items += [it]
+
+        # report numbers that could not be read
+        if invalid:
+            print(f"... warning: {len(invalid)} values of number and timer fields are not numbers, they are read as "
+                  f"empty:")
+            for name, field, content in invalid[:10]:
+                print(f"...     {name}, field {field}: {json.dumps(content)}")
 
     def printpool(self):
         """
@@ -398,7 +500,6 @@ class ItemPool:
         Adds a copy of an item to the list and returns a reference to it
         """
         newitem = copy.deepcopy(item)
-        newitem.viewNodes = []
         newitem.clearCallbacks()
         self.items += [newitem]
         return newitem
@@ -426,8 +527,12 @@ class ItemPool:
         :param newType: New field type
         :return: void
         """
-        for it in self.items:
-            it.changeFieldType(field, newType)
+        messages = [it.changeFieldType(field, newType) for it in self.items]
+        messages = [m for m in messages if m is not True]
+        if messages:
+            print(f"... warning: {len(messages)} values could not be converted to {newType}:")
+            for m in messages[:10]:
+                print(f"...     {m}")
         for it in self.items:
             it.notifyFieldChange(field)     # necessary because some changes might cause errors
 
@@ -440,8 +545,7 @@ class ItemPool:
         :return: void
         """
         for it in self.items:
-            it.addTree()
-            it.clearCallbacks()
+            it.addTree()    # keeps the nodes linked to the item in the other trees
 
     def deleteField(self, name):
         for it in self.items:
@@ -18,38 +18,197 @@
 # -*- coding:utf-8 -*-
 
 from .item import *
+from .aggregate import *
+from .expression import *
 from textwrap import wrap
 import datetime
-from math import floor, ceil, inf
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from math import floor, ceil, inf, isfinite
 import graphviz as gv
 from PyQt6 import QtCore, QtWidgets
+try:
+    import numpy
+except ImportError:     # numpy is optional, it is only used to calculate branch aggregates in bulk
+    numpy = None
 
-class Field:
+class FieldDefinition:
     """
-    A set of instructions to view/display the content of data items.
-    Fields are part of nodes, and are stored in templates.
+    The definition of a tree field: its type, the names of the fields it reads, and how it is evaluated and displayed.
+    A definition is shared by the fields of the same name in all nodes of a tree (and by the template in the tree), the
+    fields themselves only hold the values of their node. Changing the definition changes the field in all nodes at
+    once, the cached values then have to be dropped (see Node.clearFieldCache).
     """
-    Types = ("string", "url", "text", "sum", "set", "sum-time", "difference", "difference-time", "mean", "mean-percent",
-             "min", "max", "min-string", "max-string", "product", "reciprocal", "ratio", "ratio-percent", "node-name",
-             "node-path")
+    __slots__ = ('fieldType', 'ownFields', 'childFields', 'siblingFields', 'parentFields', 'hidden', 'expression',
+                 'sketchSize', 'cyclic', 'aggregate', 'formula', 'evaluator', 'stringer')
+
+    def __init__(self, fieldType=None, ownFields=False, childFields=False, siblingFields=False, parentFields=False,
+                 expression="", sketchSize=None):
+        """Initialises the definition, and sets the evaluation and display methods for the field type."""
 
-    def __init__(self, node=None, ownFields=False, childFields=False, siblingFields=False, parentFields=False,
-                 fieldType=None):
-        """Initialises the class, links the source node, field type, and sets the evaluation method."""
-        
-        self.cache = None
         self.ownFields = ownFields or []
         self.siblingFields = siblingFields or []
         self.childFields = childFields or []
         self.parentFields = parentFields or []
-        self.sourceNode = node
-        self.getValue = None
-        self.getString = None
         self.hidden = False
+        self.expression = expression
+        self.sketchSize = sketchSize
+        self.cyclic = False
+        self.aggregate = None
+        self.formula = None
+        self.evaluator = None   # the Field method calculating the value
+        self.stringer = None    # the Field method converting the value to a string
         self.fieldType = fieldType
         if (self.fieldType != ""):
             self.initFieldType()
 
+    def copy(self):
+        """
+        :return: An independent copy of the definition, with copies of the parameter lists
+        """
+        definition = FieldDefinition(None, list(self.ownFields), list(self.childFields), list(self.siblingFields),
+                                     list(self.parentFields), self.expression, self.sketchSize)
+        definition.hidden = self.hidden
+        definition.cyclic = self.cyclic
+        definition.fieldType = self.fieldType
+        definition.initFieldType()
+        return definition
+
+    def initFieldType(self):
+
+        self.aggregate = None
+        self.evaluator = None
+        self.stringer = None
+        if self.fieldType == "string":
+            self.evaluator = Field.getValueString
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "url":
+            self.evaluator = Field.getValueString
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "text":
+            self.evaluator = Field.getValueString
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "sum":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["sum"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "set":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["set"]
+            self.stringer = Field.getStringSet
+        elif self.fieldType == "sum-time":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["sum-time"]
+            self.stringer = Field.getStringTime
+        elif self.fieldType == "difference":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["difference"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "difference-time":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["difference-time"]
+            self.stringer = Field.getStringTime
+        elif self.fieldType == "mean":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["mean"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "mean-percent":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["mean-percent"]
+            self.stringer = Field.getStringPercent
+        elif self.fieldType == "min":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["min"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "max":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["max"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "min-string":
+            self.evaluator = Field.getValueMinString
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "max-string":
+            self.evaluator = Field.getValueMaxString
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "product":
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates["product"]
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "reciprocal":
+            self.evaluator = Field.getValueReciprocal
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "ratio":
+            self.evaluator = Field.getValueRatio
+            self.stringer = Field.getStringRounded
+        elif self.fieldType == "ratio-percent":
+            self.evaluator = Field.getValueRatio
+            self.stringer = Field.getStringPercent
+        elif self.fieldType == "node-name":
+            self.evaluator = Field.getValueNodeName
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType == "node-path":
+            self.evaluator = Field.getValueNodePath
+            self.stringer = Field.getStringUnchanged
+        elif self.fieldType in Field.Displays:
+            self.evaluator = Field.getValueAggregate
+            self.aggregate = Field.Aggregates[self.fieldType]
+            if self.sketchSize:
+                self.aggregate = self.aggregate.withSize(self.sketchSize)
+            self.stringer = getattr(Field, Field.Displays[self.fieldType])
+        elif self.fieldType == "expression":
+            self.formula = Expression.compiled(self.expression)
+            if self.formula.code is not None:
+                # the fields read by the formula, the lists are changed in place (meta nodes keep pointers to them)
+                self.ownFields[:] = self.formula.own
+                self.childFields[:] = self.formula.children
+                self.siblingFields[:] = self.formula.siblings
+                self.parentFields[:] = self.formula.parent
+            self.evaluator = Field.getValueExpression
+            self.stringer = Field.getStringExpression
+        else:
+            if self.fieldType:
+                print(f'... error: field type {self.fieldType} does not exist.')
+        if self.cyclic:
+            self.evaluator = Field.getValueCyclic
+            self.stringer = Field.getStringCyclic
+
+
+class Field:
+    """
+    A set of instructions to view/display the content of data items.
+    Fields are part of nodes, and are stored in templates. The instructions are kept in the definition (see
+    FieldDefinition), which is shared by the fields of all nodes, the field itself holds the value in its node.
+    """
+    Types = ("string", "url", "text", "sum", "set", "sum-time", "difference", "difference-time", "mean", "mean-percent",
+             "min", "max", "min-string", "max-string", "product", "reciprocal", "ratio", "ratio-percent", "node-name",
+             "node-path", "expression")
+    Aggregates = {"sum": Sum(), "sum-time": Sum(), "difference": Difference(), "difference-time": Difference(),
+                  "mean": Mean(), "mean-percent": Mean(), "min": Minimum(), "max": Maximum(), "product": Product(),
+                  "set": Union()}
+    Displays = {}     # the display of the field types registered with registerAggregate()
+    __slots__ = ('definition', 'cache', 'dirty', 'state', 'contributions', 'pending', 'firstKey', 'shared', 'sourceNode',
+                 'evaluating')
+
+    def __init__(self, node=None, ownFields=False, childFields=False, siblingFields=False, parentFields=False,
+                 fieldType=None, expression="", sketchSize=None, definition=None):
+        """Initialises the class, links the source node, and creates the definition (unless one is given to share)."""
+        
+        self.definition = definition or FieldDefinition(fieldType, ownFields, childFields, siblingFields,
+                                                        parentFields, expression, sketchSize)
+        self.cache = None
+        self.dirty = True
+        self.state = None
+        self.contributions = None   # the values read, set when the aggregate state is built (see getValueAggregate)
+        self.pending = None
+        self.firstKey = None
+        self.shared = False
+        self.sourceNode = node
+        self.evaluating = False
+
     def __deepcopy__(self, memo):
         ''' Overload of the deepcopy function, to avoid copying the node recursively.'''
 
@@ -59,27 +218,44 @@ class Field:
         fieldType = self.__class__
         newField = fieldType.__new__(fieldType)
         
-        # cache doesn't get copied
+        # cache and aggregate state don't get copied
         newField.cache = None
-        
-        # simple fields are copies
-        newField.ownFields = copy.deepcopy(self.ownFields)
-        newField.siblingFields = copy.deepcopy(self.siblingFields)
-        newField.childFields = copy.deepcopy(self.childFields)
-        newField.parentFields = copy.deepcopy(self.parentFields)
-        newField.fieldType = copy.deepcopy(self.fieldType)
-        newField.hidden = copy.deepcopy(self.hidden)
-
-        # the source node is a link
+        newField.dirty = True
+        newField.state = None
+        newField.contributions = None
+        newField.pending = None
+        newField.firstKey = None
+        newField.shared = False
+        newField.evaluating = False
+
+        # the definition is shared, the source node is a link
+        newField.definition = self.definition
         newField.sourceNode = self.sourceNode
         
-        # functions are set
-        if (newField.fieldType != ""):
-            newField.initFieldType()
-        
         memo[id(self)] = newField
         return newField
 
+    def definitionProperty(name):
+        """
+        :param name: The name of an attribute of FieldDefinition
+        :return: A property reading and writing the attribute in the definition of the field
+        """
+        return property(lambda self: getattr(self.definition, name),
+                        lambda self, value: setattr(self.definition, name, value))
+
+    fieldType = definitionProperty("fieldType")
+    ownFields = definitionProperty("ownFields")
+    childFields = definitionProperty("childFields")
+    siblingFields = definitionProperty("siblingFields")
+    parentFields = definitionProperty("parentFields")
+    hidden = definitionProperty("hidden")
+    expression = definitionProperty("expression")
+    sketchSize = definitionProperty("sketchSize")
+    cyclic = definitionProperty("cyclic")
+    aggregate = definitionProperty("aggregate")
+    formula = definitionProperty("formula")
+    del definitionProperty
+
     @staticmethod
     def getFieldValue(field):
         """
@@ -90,135 +266,188 @@ class Field:
         if field["type"] == "timer":
             running_since = field.get("running_since")
             partial = field["content"]
-            running_since = running_since and datetime.datetime.strptime(running_since,
-                                                                      "%Y-%m-%d %H:%M:%S")
             if running_since:
-                elapsed = datetime.datetime.now() - running_since
-                return partial \
-                       + elapsed.days * 24.0 \
-                       + elapsed.seconds / 60.0 / 60.0 \
-                       + elapsed.microseconds / 60.0 / 60.0 / 1000000.0
+                return (partial or 0) + TimerService.elapsed(running_since)
             else:
                 return partial
         else:
             return field["content"]
 
-    def getFieldValues(self, sort=False):
-        """ Gets all values of all related fields in a list.
+    def readFields(self, relation):
+        """
+        :param relation: One of 'own', 'child', 'sibling', 'parent'
+        :return: The names of the fields this field reads from the given relation
+        """
+        if relation == 'own':
+            return self.ownFields
+        elif relation == 'child':
+            return self.childFields
+        elif relation == 'sibling':
+            return self.siblingFields
+        elif self.fieldType in ('node-name', 'node-path'):
+            return []   # node names and paths use the parent list for tree indices
+        else:
+            return self.parentFields
+
+    @staticmethod
+    def findValue(node, name):
+        """
+        Looks up a field value in a node. Tree fields of the node have precedence over item fields of the same name.
+        :param node: The node
+        :param name: The field name
+        :return: A pair (True, value) if the field exists, (False, None) otherwise
+        """
+        if name in node.fields:
+            return True, node.fields[name].getValue()
+        elif node.item and name in node.item.fields:
+            return True, Field.getFieldValue(node.item.fields[name])
+        return False, None
+
+    def getFieldContributions(self, sort=False, siblings=True):
+        """ Gets all values of all related fields, each together with a key telling where the value comes from.
         Order is: own fields first, then child fields, then sibling fields, then parent fields.
-        Item fields of the same name have precedence over tree fields.
+        :param sort: Whether to sort children and siblings by name
+        :param siblings: Whether to include the sibling fields
+        :return: Generator of (key, value) pairs, the key is a pair (index in parameter list, node)
         """
 
-        values = []
-        
         # look in own fields
+        definition = self.definition
         node = self.sourceNode
         if node.item is not None: # don't try to get values from the root node
-            for f in self.ownFields:
+            for n, f in enumerate(definition.ownFields):
                 if f in node.fields:
-                    values += [node.fields[f].getValue()]
+                    yield (n, node), node.fields[f].getValue()
                 elif f in node.item.fields:
-                    values += [Field.getFieldValue(node.item.fields[f])]
-        
+                    yield (n, node), Field.getFieldValue(node.item.fields[f])
+
         # look in child fields
-        node = self.sourceNode
-        for f in self.childFields:
-            for c in sort and sorted(node.children, key=lambda n: n.name) or node.children:
-                if f in c.fields:
-                    values += [c.fields[f].getValue()]
-                elif c.item and c.item.fields and f in c.item.fields:
-                    values += [Field.getFieldValue(c.item.fields[f])]
+        if definition.childFields:
+            children = sort and sorted(node.children, key=lambda n: n.name) or node.children
+            for n, f in enumerate(definition.childFields):
+                for c in children:
+                    if f in c.fields:
+                        yield (n, c), c.fields[f].getValue()
+                    elif c.item and f in c.item.fields:
+                        yield (n, c), Field.getFieldValue(c.item.fields[f])
 
         node = self.sourceNode.parent
         if node:
 
             # look in sibling fields
-            for f in self.siblingFields:
-                for c in sort and sorted(node.children, key=lambda n: n.name) or node.children:
-                    if c != self.sourceNode:
-                        if f in c.fields:
-                            values += [c.fields[f].getValue()]
-                        elif f in c.item.fields:
-                            values += [Field.getFieldValue(c.item.fields[f])]
-
-            # look in parent fields
-            for f in self.parentFields:
-                if f in node.fields:
-                    values += [node.fields[f].getValue()]
-                elif f in node.item.fields:
-                    values += [Field.getFieldValue(node.item.fields[f])]
-        
-        # return
-        return values
+            if definition.siblingFields and siblings:
+                children = sort and sorted(node.children, key=lambda n: n.name) or node.children
+                for n, f in enumerate(definition.siblingFields):
+                    for c in children:
+                        if c != self.sourceNode:
+                            if f in c.fields:
+                                yield (n, c), c.fields[f].getValue()
+                            elif c.item and f in c.item.fields:
+                                yield (n, c), Field.getFieldValue(c.item.fields[f])
+
+            # look in parent fields (don't try to get values from the tree node, it only holds the field templates)
+            if node.item is not None:
+                for n, f in enumerate(definition.parentFields):
+                    if f in node.fields:
+                        yield (n, node), node.fields[f].getValue()
+                    elif f in node.item.fields:
+                        yield (n, node), Field.getFieldValue(node.item.fields[f])
 
-    def initFieldType(self):
-        
-        if self.fieldType == "string":
-            self.getValue = self.getValueString
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "url":
-            self.getValue = self.getValueString
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "text":
-            self.getValue = self.getValueString
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "sum":
-            self.getValue = self.getValueSum
-            self.getString = self.getStringRounded
-        elif self.fieldType == "set":
-            self.getValue = self.getValueSet
-            self.getString = self.getStringSet
-        elif self.fieldType == "sum-time":
-            self.getValue = self.getValueSum
-            self.getString = self.getStringTime
-        elif self.fieldType == "difference":
-            self.getValue = self.getValueDifference
-            self.getString = self.getStringRounded
-        elif self.fieldType == "difference-time":
-            self.getValue = self.getValueDifference
-            self.getString = self.getStringTime
-        elif self.fieldType == "mean":
-            self.getValue = self.getValueMean
-            self.getString = self.getStringRounded
-        elif self.fieldType == "mean-percent":
-            self.getValue = self.getValueMean
-            self.getString = self.getStringPercent
-        elif self.fieldType == "min":
-            self.getValue = self.getValueMin
-            self.getString = self.getStringRounded
-        elif self.fieldType == "max":
-            self.getValue = self.getValueMax
-            self.getString = self.getStringRounded
-        elif self.fieldType == "min-string":
-            self.getValue = self.getValueMinString
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "max-string":
-            self.getValue = self.getValueMaxString
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "product":
-            self.getValue = self.getValueProduct
-            self.getString = self.getStringRounded
-        elif self.fieldType == "reciprocal":
-            self.getValue = self.getValueReciprocal
-            self.getString = self.getStringRounded
-        elif self.fieldType == "ratio":
-            self.getValue = self.getValueRatio
-            self.getString = self.getStringRounded
-        elif self.fieldType == "ratio-percent":
-            self.getValue = self.getValueRatio
-            self.getString = self.getStringPercent
-        elif self.fieldType == "node-name":
-            self.getValue = self.getValueNodeName
-            self.getString = self.getStringUnchanged
-        elif self.fieldType == "node-path":
-            self.getValue = self.getValueNodePath
-            self.getString = self.getStringUnchanged
+    def getFieldValues(self, sort=False):
+        """ Gets all values of all related fields in a list, in the order of getFieldContributions().
+        """
+        return [value for key, value in self.getFieldContributions(sort)]
+
+    def updateContributions(self, node):
+        """
+        Updates the aggregate state with the current values of the fields of a related node, by removing the old and
+        adding the new values.
+        :param node: The node whose values have changed
+        :return: True if the state was updated, False if the state has to be built again
+        """
+        definition = self.definition
+        aggregate = definition.aggregate
+        source = self.sourceNode
+        if node is source:
+            params = node.item is not None and definition.ownFields or []
+        elif node.parent is source:
+            params = definition.childFields
+        elif source.parent is not None and node is source.parent:
+            params = node.item is not None and definition.parentFields or []
+        elif source.parent is not None and node.parent is source.parent:
+            if self.shared:
+                return False    # the values of the siblings are kept by the parent, see SiblingTotals
+            params = definition.siblingFields
         else:
-            if self.fieldType:
-                print(f'... error: field type {self.fieldType} does not exist.')
+            return False
+        for n, f in enumerate(params):
+            key = (n, node)
+            found, value = Field.findValue(node, f)
+            if found != (key in self.contributions) or (aggregate.ordered and key == self.firstKey):
+                return False    # the order of values has changed
+            if found and self.getPartialState(key) is not None:
+                return False    # the state of the child has been merged, it cannot be removed
+            if found:
+                self.state = aggregate.remove(self.state, self.contributions[key])
+                self.state = aggregate.accumulate(self.state, value)
+                self.contributions[key] = value
+        return True
+
+    def initFieldType(self):
+        """
+        Sets the evaluation and display methods for the field type in the (shared) definition, and drops the value.
+        """
+        self.definition.initFieldType()
+        self.state = None
+        self.pending = None
+        self.dirty = True
+
+    @staticmethod
+    def registerAggregate(fieldType, aggregate, display="rounded"):
+        """
+        Adds a new field type, evaluated by an aggregate (see Aggregate in aggregate.py). Fields of this type are
+        calculated, cached, and updated like the built-in aggregate types.
+        :param fieldType: The name of the field type
+        :param aggregate: An object of a class derived from Aggregate
+        :param display: How the values are displayed, one of 'rounded', 'time', 'percent', 'set', 'unchanged'
+        :return: True if the type was added, False if the name or the display is not available
+        """
+        displays = {"rounded": "getStringRounded", "time": "getStringTime", "percent": "getStringPercent",
+                    "set": "getStringSet", "unchanged": "getStringUnchanged"}
+        if fieldType in Field.Types or display not in displays:
+            print(f'... error: field type {fieldType} cannot be registered, the name is in use or the display '
+                  f'{display} does not exist.')
+            return False
+        Field.Types += (fieldType,)
+        Field.Aggregates[fieldType] = aggregate
+        Field.Displays[fieldType] = displays[display]
+        return True
+
+    def getValue(self):
+        """
+        Returns the value of the field. The value is calculated on first access and then cached until the field is
+        marked as dirty again by the node (see Node.invalidateFields).
+        """
+        if self.dirty:
+            if self.evaluating:
+                return None     # the field reads itself, see FieldDependencies.cycles()
+            self.evaluating = True
+            try:
+                self.cache = self.definition.evaluator(self)
+            finally:
+                self.evaluating = False
+            self.dirty = False
+        return self.cache
+
+    def getString(self):
+        """
+        :return: The value of the field as it is displayed, depending on the field type
+        """
+        stringer = self.definition.stringer
+        return stringer(self) if stringer else "[undefined]"
 
     def getStringPercent(self):
-        if self.sourceNode and self.getValue:
+        if self.sourceNode and self.definition.evaluator:
             v = self.getValue()
             try:
                 if v:
@@ -238,13 +467,13 @@ class Field:
             return ""
 
     def getStringSet(self):
-        if self.sourceNode and self.getValue:
+        if self.sourceNode and self.definition.evaluator:
             return ', '.join(sorted([str(n) for n in self.getValue()]))
         else:
             return "[undefined]"
 
     def getStringTime(self):
-        if self.sourceNode and self.getValue:
+        if self.sourceNode and self.definition.evaluator:
             v = self.getValue()
             try:
                 if v:
@@ -266,14 +495,29 @@ class Field:
         else:
             return ""
 
+    def getStringExpression(self):
+        if self.sourceNode and self.definition.evaluator:
+            value = self.getValue()
+            if value is None:
+                return ""
+            elif isinstance(value, float):
+                return str(round(value, 3))
+            else:
+                return str(value)
+        else:
+            return "[undefined]"
+
+    def getStringCyclic(self):
+        return "[cycle]"
+
     def getStringUnchanged(self):
-        if self.sourceNode and self.getValue:
+        if self.sourceNode and self.definition.evaluator:
             return str(self.getValue())
         else:
             return "[undefined]"
 
     def getStringRounded(self):
-        if self.sourceNode and self.getValue:
+        if self.sourceNode and self.definition.evaluator:
             value = self.getValue()
             if value:
                 try:
@@ -287,133 +531,155 @@ class Field:
         else:
             return "[undefined]"
 
+    def getValueCyclic(self):
+        """
+        Fields that read themselves endlessly (see FieldDependencies.cycles) are not calculated.
+        """
+        return None
+
+    def otherNode(self, item, t):
+        """
+        Finds the node of an item in another tree. This is the node linked in the item's view, or, if the item is not
+        linked there, the node at the item's path in the tree.
+        :param item: The item
+        :param t: The index of the tree
+        :return: The node, or None if the item is not in the tree
+        """
+        node = item.views[t].node
+        if node is None and item.paths[t]:
+            forest = self.sourceNode
+            while forest.parent is not None:
+                forest = forest.parent
+            if type(forest) == Forest and t < len(forest.children):
+                node = forest.children[t].findNode(item.paths[t])
+                if node is not None and node.item is not item:
+                    node = None
+        return node
+
     def getValueNodeName(self):
-        if self.cache is not None:
-            return self.cache
-        else:
-            s = ""
-            item = self.sourceNode.item
-            if item is None:
-                return s
-            for t in self.parentFields:
-
-                # find tree
-                tree = self.sourceNode
-                while tree.parent is not None:
-                    tree = tree.parent
-                if type(tree) == Forest:
-                    tree = tree.children[t]
-
-                # find node in tree
-                if type(tree) == Tree:
-                    path = item.trees[t]
-                    node = tree.findNode(path)
-                    if node is not None:
-                        parent = node.parent
-                        if parent is not None:
-                            s += parent.name
+        s = ""
+        item = self.sourceNode.item
+        if item is None:
             return s
+        for t in self.parentFields:
+
+            # the node of the item in the other tree
+            node = self.otherNode(item, t)
+            if node is not None and node.parent is not None:
+                s += node.parent.name
+        return s
 
     def getValueNodePath(self):
-        if self.cache is not None:
-            return self.cache
-        else:
-            s = ""
-            item = self.sourceNode.item
-            if item is None:
-                return s
-            for t in self.parentFields:
-
-                # find tree
-                tree = self.sourceNode
-                while tree.parent is not None:
-                    tree = tree.parent
-                if type(tree) == Forest:
-                    tree = tree.children[t]
-
-                # find node in tree
-                if type(tree) == Tree:
-                    path = item.trees[t]
-                    node = tree.findNode(path)
-                    if node and node.parent:
-                        parent = node.parent
-                        s += parent.name
-                        while parent.parent and parent.parent.parent and parent.parent.parent.parent : # don't display forest or tree names
-                            parent = parent.parent
-                            s = parent.name + " | " + s
+        s = ""
+        item = self.sourceNode.item
+        if item is None:
             return s
-
-    def getValueString(self):
-        values = self.getFieldValues(sort=True)
-        s = ''
-        for v in values:
-            if v:     # either sum up using the value
-                s += v
-            else:     # or the neutral element for addition ('')
-                s += ''
+        for t in self.parentFields:
+
+            # the node of the item in the other tree, the path of its parent is cached there
+            node = self.otherNode(item, t)
+            if node is not None and node.parent is not None:
+                parent = node.parent
+                if parent.parent and parent.parent.parent and parent.parent.parent.parent:  # don't display forest or tree names
+                    s = parent.parent.getNamePath() + " | " + s + parent.name
+                else:
+                    s += parent.name
         return s
 
-    def getValueSet(self):
+    def getValueString(self):
+        """
+        Concatenates the field values. The result references the values (see Rope) instead of copying them, a single
+        value is passed on as it is.
+        """
         values = self.getFieldValues(sort=True)
-        result_set = set()
+        parts = []
         for v in values:
-            if isinstance(v, set):
-                result_set = result_set | v
-            elif v:     # either sum up using the value
-                result_set.add(v)
-        return result_set
-
-    def getValueSum(self):
-        values = self.getFieldValues()
-        sum = 0
-        for v in values:
-            if v:     # either sum up using the value
-                try:
-                    sum += v
-                except:
-                    pass
-            else:     # or the neutral element for addition (0)
-                sum += 0
-        return sum
+            if v:     # skip the neutral element for addition ('')
+                parts.append(v if isinstance(v, Rope) else '' + v)
+        if len(parts) > 1:
+            return Rope(parts)
+        return parts and parts[0] or ''
 
-    def getValueDifference(self):
+    def getValueExpression(self):
         """
-        Calculates different a - b - c - d of values a,b,c,d
+        Evaluates the compiled formula of an expression field (see Expression) with the values of the fields it reads.
         """
-        values = self.getFieldValues()
-        difference = 0
-        first = True
-        for v in values:
-            if first:
-                if v:
-                    try:
-                        difference += v     # first element is positive
-                    except:
-                        pass
-                first = False
+        formula = self.formula
+        if formula.code is None:
+            return None
+        node = self.sourceNode
+        parentNode = node.parent
+
+        # fields that do not exist in a node are None, the root node and the tree have no values
+        own = {f: Field.findValue(node, f)[1] if node.item is not None else None for f in formula.own}
+        children = {f: [v for found, v in (Field.findValue(c, f) for c in node.children) if found]
+                    for f in formula.children}
+        others = [c for c in parentNode.children if c is not node] if parentNode is not None else []
+        siblings = {f: [v for found, v in (Field.findValue(c, f) for c in others) if found] for f in formula.siblings}
+        hasParent = parentNode is not None and parentNode.item is not None
+        parent = {f: Field.findValue(parentNode, f)[1] if hasParent else None for f in formula.parent}
+        return formula.evaluate(own, children, siblings, parent)
+
+    def getValueAggregate(self):
+        """
+        Evaluates the aggregate field types. The values read from the related fields are kept together with the state
+        of the aggregate. If only the values of some related nodes have changed since the last evaluation (these are
+        collected in self.pending by Node.markFieldsDirty), only their old values are removed from the state and their
+        new values added. Otherwise all values are reduced again.
+        """
+        aggregate = self.definition.aggregate
+        if self.state is not None and self.pending is not None:
+            try:
+                updated = all(self.updateContributions(node) for node in self.pending)
+            except NotImplementedError:
+                updated = False     # the aggregate cannot remove values
+            if updated:
+                self.pending = set()
+                return aggregate.finalize(self.state)
+
+        totals = self.getSiblingTotals()
+        self.shared = totals is not None
+        self.state = self.shared and totals.without(self.sourceNode) or aggregate.init()
+        self.contributions = {}
+        self.firstKey = None
+        for key, value in self.getFieldContributions(siblings=not self.shared):
+            if self.firstKey is None:
+                self.firstKey = key
+            self.contributions[key] = value
+            partial = self.getPartialState(key)
+            if partial is None:
+                self.state = aggregate.accumulate(self.state, value)
             else:
-                if v:
-                    try:
-                        difference -= v     # all other elements are negative
-                    except:
-                        pass
-        return difference
-
-    def getValueMin(self):
-        values = self.getFieldValues()
-        minValue = inf
-        for v in values:
-            if v < minValue:     # either sum up using the value
-                minValue = v
-        return minValue
+                self.state = aggregate.merge(self.state, partial)
+        self.pending = set()
+        return aggregate.finalize(self.state)
+
+    def getPartialState(self, key):
+        """
+        :param key: The key of a contribution (see getFieldContributions)
+        :return: The state of the related field, if the aggregate merges partial results (see Aggregate.partial) and
+            the related field is a field of a child with the same aggregate, None otherwise
+        """
+        n, node = key
+        definition = self.definition
+        if definition.aggregate.partial and node.parent is self.sourceNode:
+            field = node.fields.get(definition.childFields[n])
+            if field is not None and field.definition.aggregate is definition.aggregate:
+                return field.state
+        return None
 
-    def getValueMax(self):
-        values = self.getFieldValues()
-        maxValue = -inf
-        for v in values:
-            if v > maxValue:     # either sum up using the value
-                maxValue = v
-        return maxValue
+    def getSiblingTotals(self, aggregate=None):
+        """
+        :param aggregate: The aggregate to reduce the sibling values with, the aggregate of the field by default
+        :return: The totals over all siblings, kept by the parent (see SiblingTotals), if this field reads sibling fields
+            and the aggregate supports them, None otherwise
+        """
+        aggregate = aggregate or self.aggregate
+        parent = self.sourceNode.parent
+        if self.siblingFields and parent is not None and not aggregate.ordered \
+                and (aggregate.invertible or aggregate.selective):
+            return parent.siblingTotal(aggregate, self.siblingFields)
+        return None
 
     def getValueMinString(self):
         values = self.getFieldValues()
@@ -432,36 +698,6 @@ class Field:
                 maxValue = v
         return maxValue
 
-    def getValueMean(self):
-        values = self.getFieldValues()
-        sum = 0.0
-        n = 0.0
-        for v in values:
-            if v:     # in case of 'None', use neutal elements of 0 for addition, and 1 for multiplication
-                try:
-                    n += 1.0
-                    sum += v
-                except:
-                    pass
-        if n > 0.0:
-            sum = sum/n
-        else:
-            sum = None
-        return sum
-
-    def getValueProduct(self):
-        """
-        Returns the product a*b*c*d*... of field values a,b,c,d...
-        """
-        values = self.getFieldValues()
-        prod = 1.0
-        for v in values:
-            try:
-                prod *= v
-            except:
-                pass    # same as: prod *= 1.0
-        return prod
-
     def getValueReciprocal(self):
         """
         Returns the reciprocal 1/(a+b+c+d+...) of field values a,b,c,d...
@@ -469,20 +705,34 @@ class Field:
         values = self.getFieldValues()
         rec = 0.0
         for v in values:
-            try:
+            if rec is not None and isNumber(v):
                 rec += v
-            except:
-                pass    # same as: prod *= 1.0
-            try:
-                rec = 1.0/rec
-            except:
-                rec = None
+            rec = 1.0/rec if rec else None
         return rec
 
     def getValueRatio(self):
         """
         Returns the ratio a/(b+c+d+e+...) of field values a,b,c,d,e,...
-        """
+        If the numerator comes from the own or child fields, the sum of the sibling fields is taken from the totals
+        kept by the parent, instead of adding up all siblings for each node.
+        """
+        totals = self.siblingFields and self.getSiblingTotals(Field.Aggregates["sum"])
+        if totals:
+            source = self.sourceNode
+            contributions = list(self.getFieldContributions(siblings=False))
+            if contributions and (contributions[0][0][1] is source or contributions[0][0][1].parent is source):
+                siblings = len(totals.contributions) \
+                           - len([n for n in range(len(self.siblingFields)) if (n, source) in totals.contributions])
+                if len(contributions) + siblings < 2:
+                    return None
+                state = totals.without(source)
+                for key, value in contributions[1:]:
+                    state = totals.aggregate.accumulate(state, value)
+                denominator = totals.aggregate.finalize(state)
+                if denominator != 0:
+                    return contributions[0][1]/denominator
+                else:
+                    return None
         values = self.getFieldValues()
         if len(values) < 2:
             return None
@@ -490,11 +740,8 @@ class Field:
             denom = values[0]
             sum = 0
             for v in values[1:]:
-                if v:
-                    try:
-                        sum += v
-                    except:
-                        pass
+                if v and isNumber(v):
+                    sum += v
             if sum != 0:
                 return denom/sum
             else:
@@ -506,69 +753,660 @@ class Field:
         string += "        child-fields " + json.dumps(self.childFields) + "\n"
         string += "        sibling-fields " + json.dumps(self.siblingFields) + "\n"
         string += "        parent-fields " + json.dumps(self.parentFields) + "\n"
+        if self.fieldType == "expression":
+            string += "        expression " + json.dumps(self.expression) + "\n"
+        if self.sketchSize:
+            string += "        sketch-size " + json.dumps(self.sketchSize) + "\n"
         if self.hidden:
             string += "        hidden\n"
         return string
 
-    def readFromString(self, string):
-        
-        s = string.split("\n        field-type ")
-        name = json.loads(s[0])
-        s = s[1].split("\n        own-fields ")
-        try:
-            self.fieldType = json.loads(s[0])
-        except:
-            self.printReadError(name, "field-type", s[0])
-        s = s[1].split("\n        child-fields ")
-        try:
-            self.ownFields = json.loads(s[0])
-        except:
-            self.printReadError(name, "own-fields", s[0])
-        s = s[1].split("\n        sibling-fields ")
-        try:
-            self.childFields = json.loads(s[0])
-        except:
-            self.printReadError(name, "child-fields", s[0])
-        s = s[1].split("\n        parent-fields ")
-        try:
-            self.siblingFields = json.loads(s[0])
-        except:
-            self.printReadError(name, "sibling-fields", s[0])
-        s = s[1].split("\n        hidden")
-        try:
-            self.parentFields = json.loads(s[0])
-        except:
-            self.printReadError(name, "parent-fields", s[0])
-        if len(s) == 2:
+    Parameters = {"field-type": "fieldType", "own-fields": "ownFields", "child-fields": "childFields",
+                  "sibling-fields": "siblingFields", "parent-fields": "parentFields", "expression": "expression",
+                  "sketch-size": "sketchSize"}     # the keywords written by writeToString(), and the attributes
+
+    def readParameter(self, name, line, lineNumber):
+        """
+        Reads one line of the definition, as written by writeToString(). Call initFieldType() when all lines are read.
+        :param name: The name of the field, for error messages
+        :param line: The line, without indentation
+        :param lineNumber: The number of the line in the file, for error messages
+        :return: void
+        """
+        keyword, _, value = line.partition(" ")
+        if keyword == "hidden" and not value:
             self.hidden = True
-        self.initFieldType()
-        
-        return name
+        elif keyword not in Field.Parameters:
+            self.printReadError(name, keyword, value, lineNumber)
+        else:
+            try:
+                setattr(self, Field.Parameters[keyword], json.loads(value))
+            except ValueError:
+                self.printReadError(name, keyword, value, lineNumber)
 
-    def printReadError(self, name, parameter, string):
-        print('error reading field parameter "' + parameter + '" of field "' + name + '": definition string "' + string + '" cannot be parsed.')
+    def printReadError(self, name, parameter, string, lineNumber):
+        print(f'error reading field parameter "{parameter}" of field "{name}" in line {lineNumber}: definition string '
+              f'"{string}" cannot be parsed.')
+
+
+Field.registerAggregate("count", Count())
+Field.registerAggregate("count-distinct", DistinctCount())
+Field.registerAggregate("median", Quantile(0.5))
+Field.registerAggregate("p90", Quantile(0.9))
+
+
+class FieldDependencies:
+    """
+    The field definitions of a tree, compiled into a dependency graph. Edges point from a field name (tree field or
+    data field) to the tree fields reading it, separately for each relation between the reading node and the node
+    holding the field: 'own' (same node), 'child' (the reader is the parent), 'sibling', and 'parent' (the reader is a
+    child). Used to find the fields that have to be recalculated after a change, and in which order.
+    """
+    Relations = ('own', 'child', 'sibling', 'parent')
+    Depths = {'own': 0, 'child': 1, 'sibling': 0, 'parent': -1}    # depth of the node read, relative to the reader
+
+    def __init__(self, fields):
+        """
+        Compiles the graph.
+        :param fields: The field templates of the tree, as dict name: Field
+        """
+        self.readers = {relation: {} for relation in FieldDependencies.Relations}
+        for name, field in fields.items():
+            for relation in FieldDependencies.Relations:
+                for source in field.readFields(relation):
+                    self.readers[relation].setdefault(source, [])
+                    if name not in self.readers[relation][source]:
+                        self.readers[relation][source] += [name]
+        self.nameFields = [name for name, field in fields.items() if field.fieldType in ('node-name', 'node-path')]
+
+        # the fields joining the values of children or siblings in the order of their names (see getValueString), these
+        # change when a child or sibling is renamed
+        ordered = [name for name, field in fields.items() if field.definition.evaluator is Field.getValueString]
+        self.childOrderFields = tuple(name for name in ordered if fields[name].childFields)
+        self.siblingOrderFields = tuple(name for name in ordered if fields[name].siblingFields)
+        self.sources = {name: [(source, FieldDependencies.Depths[relation]) for relation in FieldDependencies.Relations
+                               for source in field.readFields(relation) if source in fields]
+                        for name, field in fields.items()}
+
+        # the fields shown in the columns, and the fields these read, directly or indirectly
+        self.visible = {name for name, field in fields.items() if not field.hidden}
+        self.needed = set(self.visible)
+        changed = list(self.visible)
+        while changed:
+            field = fields[changed.pop()]
+            for relation in FieldDependencies.Relations:
+                for source in field.readFields(relation):
+                    if source in fields and source not in self.needed:
+                        self.needed.add(source)
+                        changed += [source]
+
+        # topological order of the own-field dependencies, fields within a cycle are appended in definition order
+        pending = {name: [f for f in field.ownFields if f in fields and f != name] for name, field in fields.items()}
+        self.order = []
+        while pending:
+            ready = [name for name, sources in pending.items() if not [f for f in sources if f in pending]]
+            ready = ready or list(pending)
+            for name in ready:
+                pending.pop(name)
+            self.order += ready
+        self.rank = {name: n for n, name in enumerate(self.order)}
+        self.ownSources = {name: field.ownFields for name, field in fields.items()}
+        self.affectedFields = {}
+        self.changedFields = {}
+
+    def affected(self, names, relation):
+        """
+        Lists the fields of a node that are affected by a change in a related node.
+        :param names: Tuple of the changed field names, or None if any field may have changed
+        :param relation: Where the change happened, seen from the node: 'own' (in the node itself, the fields in
+            names are affected themselves), 'child' (in a child), 'sibling' (in a sibling), 'parent' (in the parent)
+        :return: A tuple of names of all fields that read one of the changed fields, directly or through other fields
+            of the same node, in topological order
+        """
+        key = (names, relation)
+        if key not in self.affectedFields:
+            self.compileChange(names, relation)
+        return self.affectedFields[key]
+
+    def changes(self, names, relation):
+        """
+        Like affected(), but tells for each field how it is affected.
+        :return: A tuple of triples (name, direct, indirect): direct is True if the field reads one of the changed
+            fields from the related node, indirect is True if it reads an affected field of its own node. If the field
+            is affected in any other way, direct and indirect are None.
+        """
+        key = (names, relation)
+        if key not in self.changedFields:
+            self.compileChange(names, relation)
+        return self.changedFields[key]
+
+    def compileChange(self, names, relation):
+        """
+        Finds the fields affected by a change, see affected() and changes().
+        """
+        if names is None:
+            if relation == 'own':
+                direct = set(self.order)
+            else:
+                direct = {f for readers in self.readers[relation].values() for f in readers}
+            found = set(direct)
+        else:
+            direct = {f for name in names for f in self.readers[relation].get(name, [])}
+            found = set(direct)
+            if relation == 'own':
+                found |= {name for name in names if name in self.rank}
+        changed = list(found)
+        while changed:
+            for f in self.readers['own'].get(changed.pop(), []):
+                if f not in found:
+                    found.add(f)
+                    changed += [f]
+        order = tuple(sorted(found, key=self.rank.get))
+        changes = ()
+        for name in order:
+            if names is None or (relation == 'own' and name in names):
+                changes += ((name, None, None),)
+            else:
+                changes += ((name, name in direct, bool(found.intersection(self.ownSources[name]))),)
+        self.affectedFields[(names, relation)] = order
+        self.changedFields[(names, relation)] = changes
+
+    def dependents(self, name):
+        """
+        :param name: A field name
+        :return: A tuple of the given field (if it is a tree field) and all tree fields reading it, directly or
+            indirectly, in any relation, in topological order
+        """
+        found = {name} if name in self.rank else set()
+        changed = [name]
+        while changed:
+            source = changed.pop()
+            for relation in FieldDependencies.Relations:
+                for f in self.readers[relation].get(source, []):
+                    if f not in found:
+                        found.add(f)
+                        changed += [f]
+        return tuple(sorted(found, key=self.rank.get))
+
+
+    def cycles(self):
+        """
+        Finds the tree fields that can never be calculated, because they end up reading themselves in the same node.
+        This is the case for a field that reads itself (or a field reading it) as own field or sibling field, or as
+        child field and parent field. A field reading itself only in the children (or only in the parent) is fine,
+        the recursion ends at the leaves (or at the root).
+        A group of fields reading each other in a circle is endless if a walk around the circle can come back to the
+        starting field at the same depth in the tree. Each group is checked by walking the fields with their relative
+        depth, the depth never has to go beyond n² for n fields in the group (a circle going down can be combined with
+        a circle going up, each of length up to n).
+        :return: A list of lists of field names, one for each group of fields reading each other endlessly
+        """
+        reachable = {}
+        for name in self.sources:
+            found = set()
+            changed = [name]
+            while changed:
+                for source, depth in self.sources[changed.pop()]:
+                    if source not in found:
+                        found.add(source)
+                        changed += [source]
+            reachable[name] = found
+        result = []
+        grouped = set()
+        for name in self.sources:
+            group = [f for f in self.sources if f in reachable[name] and name in reachable[f]]
+            if not group or name in grouped:
+                continue
+            grouped.update(group)
+            limit = len(group) * len(group) + len(group)
+            for start in group:
+                found = set()
+                changed = [(start, 0)]
+                while changed and (start, 0) not in found:
+                    field, offset = changed.pop()
+                    for source, depth in self.sources[field]:
+                        state = (source, offset + depth)
+                        if source in group and abs(offset + depth) <= limit and state not in found:
+                            found.add(state)
+                            changed += [state]
+                if (start, 0) in found:
+                    result += [group]
+                    break
+        return result
+
+
+class BranchAggregates:
+    """
+    Calculates the values of simple aggregate fields for all nodes of a tree at once, using numpy. This works for
+    fields of type sum, sum-time, min and max that read numeric data fields from their own node and their children, and
+    optionally themselves from their children (the usual "total of a branch" definition), and for mean fields that
+    read numeric data fields only.
+    The nodes are listed in depth-first order, and the data fields copied into numpy columns in this order. The columns
+    are then reduced level by level from the leaves up, with one vectorised operation per tree level.
+    Sums are only calculated in bulk if every intermediate sum is exact in a float, so the values are the same as the
+    ones the aggregates in aggregate.py calculate. Otherwise the field is left to the usual calculation.
+    """
+    Types = ("sum", "sum-time", "mean", "mean-percent", "min", "max")
+    Exact = 2**52   # sums below this size (in units of the smallest step) are exact in a float
+
+    def __init__(self, tree):
+        """
+        Lists the nodes of the tree in depth-first order and groups them by depth.
+        :param tree: The tree
+        """
+        self.nodes = []
+        parents = []
+        depths = []
+        stack = [(c, -1, 0) for c in reversed(tree.children)]
+        while stack:
+            node, parent, depth = stack.pop()
+            stack += [(c, len(self.nodes), depth + 1) for c in reversed(node.children)]
+            self.nodes += [node]
+            parents += [parent]
+            depths += [depth]
+        self.parents = numpy.array(parents, dtype=numpy.int64)
+        depths = numpy.array(depths, dtype=numpy.int64)
+        self.levels = [numpy.flatnonzero(depths == d) for d in range(depths.max(initial=0), 0, -1)]
+        self.columns = {}
+
+    @staticmethod
+    def eligible(name, field, dataFields, treeFields):
+        """
+        :param name: The name of a tree field
+        :param field: The field
+        :param dataFields: Names of the numeric data fields
+        :param treeFields: Names of the tree fields, these have precedence over data fields of the same name
+        :return: True if the field can be calculated in bulk
+        """
+        def data(f):
+            return f in dataFields and f not in treeFields
+        recursive = field.fieldType not in ("mean", "mean-percent")
+        return field.fieldType in BranchAggregates.Types and not field.siblingFields and not field.parentFields \
+            and all(data(f) for f in field.ownFields) \
+            and all(data(f) or (recursive and f == name) for f in field.childFields)
+
+    def column(self, name):
+        """
+        :param name: Name of a data field
+        :return: Tuple (value, number, truthy, isFloat, exponent, magnitude). The first four are numpy arrays over all
+            nodes: the value as float (0 if it is not a number), whether it is a number, whether it is set, and whether
+            it is a float. The exponent is the smallest k so that all values are multiples of 2**-k, the magnitude is
+            the sum of the absolute values, in multiples of 2**-k.
+        """
+        if name not in self.columns:
+            values = [Field.getFieldValue(node.item.fields[name]) if name in node.item.fields else None
+                      for node in self.nodes]
+            numbers = [isNumber(v) for v in values]
+            exponent = 0
+            magnitude = 0
+            for v, n in zip(values, numbers):
+                if n and isfinite(v):
+                    numerator, denominator = v.as_integer_ratio()
+                    exponent = max(exponent, denominator.bit_length() - 1)
+            for v, n in zip(values, numbers):
+                if n and isfinite(v):
+                    numerator, denominator = abs(v).as_integer_ratio()
+                    magnitude += numerator << (exponent + 1 - denominator.bit_length())
+            self.columns[name] = (numpy.array([n and v or 0.0 for v, n in zip(values, numbers)], dtype=numpy.float64),
+                                  numpy.array(numbers, dtype=bool),
+                                  numpy.array([bool(v) for v in values], dtype=bool),
+                                  numpy.array([isinstance(v, float) for v in values], dtype=bool),
+                                  exponent, magnitude)
+        return self.columns[name]
+
+    def calculate(self, name, field):
+        """
+        :param name: The name of the field
+        :param field: The field template
+        :return: A list of the values of the field in all nodes, in depth-first order, or None if they cannot be
+            calculated exactly
+        """
+        own = [self.column(f) for f in field.ownFields]
+        child = [self.column(f) for f in field.childFields if f != name]
+        recursive = name in field.childFields
+        if field.fieldType in ("min", "max"):
+            if max([c[5] for c in own + child if not c[4]], default=0) >= BranchAggregates.Exact:
+                return None
+            return self.calculateMinimum(own, child, recursive, field.fieldType == "min" and 1 or -1)
+        exponent = max([c[4] for c in own + child], default=0)
+        if sum(c[5] << (exponent - c[4]) for c in own + child) >= BranchAggregates.Exact:
+            return None
+        if field.fieldType in ("sum", "sum-time"):
+            return self.calculateSum(own, child, recursive)
+        else:
+            return self.calculateMean(own, child)
+
+    def calculateSum(self, own, child, recursive):
+        """
+        :return: The sums of the given columns, over the node itself (own) and its children (child), and over the sums
+            of the children if the field is recursive
+        """
+        size = len(self.nodes)
+
+        def add(columns):
+            total = numpy.zeros(size)
+            floats = numpy.zeros(size, dtype=bool)
+            for value, number, truthy, isFloat, exponent, magnitude in columns:
+                total += numpy.where(number & truthy, value, 0.0)
+                floats |= number & truthy & isFloat
+            return total, floats
+
+        total, floats = add(own)
+        childTotal, childFloats = add(child)
+        for level in self.levels:
+            parents = self.parents[level]
+            values, isFloat = childTotal[level], childFloats[level]
+            if recursive:
+                values = values + total[level]
+                isFloat = isFloat | (floats[level] & (total[level] != 0))
+            numpy.add.at(total, parents, values)
+            numpy.logical_or.at(floats, parents, isFloat)
+        return [t if f else int(t) for t, f in zip(total.tolist(), floats.tolist())]
+
+    def calculateMean(self, own, child):
+        """
+        :return: The means of the given columns, over the node itself (own) and its children (child)
+        """
+        size = len(self.nodes)
+
+        def add(columns):
+            total = numpy.zeros(size)
+            count = numpy.zeros(size, dtype=numpy.int64)
+            for value, number, truthy, isFloat, exponent, magnitude in columns:
+                total += numpy.where(number & truthy, value, 0.0)
+                count += truthy
+            return total, count
+
+        total, count = add(own)
+        childTotal, childCount = add(child)
+        for level in self.levels:
+            numpy.add.at(total, self.parents[level], childTotal[level])
+            numpy.add.at(count, self.parents[level], childCount[level])
+        return [t / n if n else None for t, n in zip(total.tolist(), count.tolist())]
+
+    def calculateMinimum(self, own, child, recursive, sign):
+        """
+        :param sign: 1 for the minimum, -1 for the maximum
+        :return: The minima of the given columns, ints and floats are kept apart so ints stay ints
+        """
+        size = len(self.nodes)
+
+        def minimum(columns):
+            integers = numpy.full(size, inf)
+            floats = numpy.full(size, inf)
+            for value, number, truthy, isFloat, exponent, magnitude in columns:
+                number = number & (value == value)
+                integers = numpy.where(number & ~isFloat, numpy.minimum(integers, sign * value), integers)
+                floats = numpy.where(number & isFloat, numpy.minimum(floats, sign * value), floats)
+            return integers, floats
+
+        integers, floats = minimum(own)
+        childIntegers, childFloats = minimum(child)
+        for level in self.levels:
+            parents = self.parents[level]
+            levelIntegers, levelFloats = childIntegers[level], childFloats[level]
+            if recursive:
+                levelIntegers = numpy.minimum(levelIntegers, integers[level])
+                levelFloats = numpy.minimum(levelFloats, floats[level])
+            numpy.minimum.at(integers, parents, levelIntegers)
+            numpy.minimum.at(floats, parents, levelFloats)
+        return [sign * int(i) if i != inf and i <= f else sign * f for i, f in zip(integers.tolist(), floats.tolist())]
+
+
+class SiblingTotals:
+    """
+    The values a sibling field reads from all children of a node, reduced once for all children. Each child derives the
+    reduction over its siblings from it: with invertible aggregates (sums, means, products) by removing its own values
+    from a copy of the total, with selective ones (minima, maxima) from the reductions over the children before and
+    after it. This way the sibling fields of all k children of a node are evaluated in O(k) instead of O(k²).
+    The totals are kept by the parent node (see Node.siblingTotal), one for each aggregate and list of sibling fields.
+    """
+
+    def __init__(self, aggregate, fields):
+        """
+        :param aggregate: The aggregate, either invertible or selective
+        :param fields: The names of the fields read from the siblings
+        """
+        self.aggregate = aggregate
+        self.fields = fields
+        self.state = None           # invertible aggregates: the state over all children
+        self.contributions = {}     # the values of all children, keyed by (index in fields, child)
+        self.index = {}             # position of each child
+        self.excluded = []          # selective aggregates: for each child the reduction over all other children
+        self.pending = None         # children whose values have changed, None if all values are to be read again
+
+    def changed(self, child):
+        """
+        Remembers that the values of a child have changed.
+        :param child: The child
+        """
+        if self.pending is not None:
+            self.pending.add(child)
+
+    def update(self, parent):
+        """
+        Brings the totals up to date. With invertible aggregates, the old values of changed children are removed and
+        the new ones added, otherwise all values are reduced again.
+        :param parent: The node holding the totals
+        """
+        if self.pending is not None:
+            if not self.pending:
+                return
+            if self.aggregate.invertible:
+                try:
+                    updated = all(self.updateContributions(c) for c in self.pending)
+                except NotImplementedError:
+                    updated = False
+                if updated:
+                    self.pending = set()
+                    return
+        self.rebuild(parent)
+
+    def updateContributions(self, child):
+        """
+        :param child: A child whose values have changed
+        :return: True if the state was updated, False if it has to be built again
+        """
+        for n, f in enumerate(self.fields):
+            key = (n, child)
+            found, value = Field.findValue(child, f)
+            if found != (key in self.contributions):
+                return False
+            if found:
+                self.state = self.aggregate.remove(self.state, self.contributions[key])
+                self.state = self.aggregate.accumulate(self.state, value)
+                self.contributions[key] = value
+        return True
+
+    def rebuild(self, parent):
+        """
+        Reads the values of all children again and reduces them.
+        :param parent: The node holding the totals
+        """
+        aggregate = self.aggregate
+        self.state = aggregate.init()
+        self.contributions = {}
+        self.index = {}
+        reductions = []
+        for i, c in enumerate(parent.children):
+            self.index[c] = i
+            values = []
+            for n, f in enumerate(self.fields):
+                found, value = Field.findValue(c, f)
+                if found:
+                    self.contributions[(n, c)] = value
+                    values += [value]
+            if aggregate.invertible:
+                for value in values:
+                    self.state = aggregate.accumulate(self.state, value)
+            else:
+                reductions += [self.reduce(values)]
+
+        # reduce the children before and the children after each child
+        if not aggregate.invertible:
+            prefix = [None]
+            for r in reductions[:-1]:
+                prefix += [self.reduce([prefix[-1], r])]
+            suffix = [None]
+            for r in reversed(reductions[1:]):
+                suffix += [self.reduce([suffix[-1], r])]
+            self.excluded = [self.reduce([p, s]) for p, s in zip(prefix, reversed(suffix))]
+        self.pending = set()
+
+    def reduce(self, values):
+        """
+        :param values: List of values, None stands for no value
+        :return: The result of the aggregate over the values, None if there are none
+        """
+        values = [v for v in values if v is not None]
+        if not values:
+            return None
+        state = self.aggregate.init()
+        for value in values:
+            state = self.aggregate.accumulate(state, value)
+        return self.aggregate.finalize(state)
+
+    def without(self, child):
+        """
+        :param child: A child of the node holding the totals
+        :return: A new aggregate state over the values of all other children
+        """
+        if child not in self.index:
+            self.rebuild(child.parent)
+        if self.aggregate.invertible:
+            state = self.aggregate.copy(self.state)
+            for n in range(len(self.fields)):
+                key = (n, child)
+                if key in self.contributions:
+                    state = self.aggregate.remove(state, self.contributions[key])
+        else:
+            state = self.aggregate.init()
+            value = self.excluded[self.index[child]]
+            if value is not None:
+                state = self.aggregate.accumulate(state, value)
+        return state
+
+
+class TimerService:
+    """
+    Keeps the running timers of a forest. Start times are parsed only once, and all timers are evaluated against the
+    same reading of the clock during a tick. A tick notifies all running timers in one batch (see Forest.batch), so
+    each changed field is sent to the GUI only once, however many running timers it depends on.
+    """
+    Format = "%Y-%m-%d %H:%M:%S"
+    starts = {}     # start times in seconds since the epoch, keyed by the running_since string
+    now = None      # the shared clock reading during a tick, None outside of a tick
+
+    def __init__(self, forest):
+        """
+        :param forest: The forest holding the items
+        """
+        self.forest = forest
+        self.running = {}   # (item, field name) pairs of running timers, as a dict to keep the order
+
+    @staticmethod
+    def clock():
+        """
+        :return: The current time in seconds since the epoch, the same value for all timers during a tick
+        """
+        return TimerService.now or time.time()
+
+    @staticmethod
+    def elapsed(runningSince):
+        """
+        :param runningSince: The start time of a timer, as written in the "running_since" key of a timer field
+        :return: The time passed since then, in hours
+        """
+        start = TimerService.starts.get(runningSince)
+        if start is None:
+            start = datetime.datetime.strptime(runningSince, TimerService.Format).timestamp()
+            TimerService.starts[runningSince] = start
+        return (TimerService.clock() - start) / 3600.0
+
+    def adjust(self, item, fieldName):
+        """
+        Adds a timer to the running timers if it is running, or removes it if it is not.
+        :param item: The item
+        :param fieldName: The name of the field
+        """
+        field = item.fields.get(fieldName)
+        if field and field["type"] == "timer" and field.get("running_since"):
+            self.running[(item, fieldName)] = True
+        else:
+            self.running.pop((item, fieldName), None)
+
+    def scan(self, items):
+        """
+        Finds all running timers.
+        :param items: The items to look through
+        """
+        self.running = {}
+        for item in items:
+            for fieldName in item.fields:
+                self.adjust(item, fieldName)
+
+    def tick(self):
+        """
+        Reads the clock once, marks all fields depending on running timers as stale, and sends their new values to
+        the GUI. Timers that have been stopped or removed in the meantime are dropped.
+        """
+        for item, fieldName in list(self.running):
+            self.adjust(item, fieldName)
+        TimerService.now = time.time()
+        try:
+            with self.forest.batch():
+                for item, fieldName in self.running:
+                    item.notifyFieldChange(fieldName)
+        finally:
+            TimerService.now = None
 
 
 class Node:
     """
     A tree structure consisting of nodes that are parents of nodes etc. A node is a view-object to display one item.
+    A node only stores its index in the children of its parent, the path is computed when needed (see path), so adding
+    or removing a node only renumbers its siblings. Nodes and fields use slots instead of attribute dicts. The memory
+    budget of a node is about 250 bytes, plus about 150 bytes for each tree field (the field and its entry in the
+    fields dict); cached values and aggregate states come on top. See Item for the budget of the items.
     """
-    
-    def __init__(self, parent, tree, path):
+    queue = None    # during a batch (see Forest.batch) the fields to display, as dict node: dict of names, else None
+
+    __slots__ = ('parent', 'children', 'item', 'name', 'fields', 'tree', 'index', 'viewNode', 'nameChangeCallback',
+                 'fieldChangeCallback', 'deletionCallback', 'moveCallback', 'selectionCallback',
+                 'fieldNameChangeCallback', 'fieldOrderChangeCallback', 'siblingTotals', 'namePath')
+
+    def __init__(self, parent, tree, index):
         self.parent = parent
         self.children = []
         self.item = None
         self.name = ""
         self.fields = {}
         self.tree = tree
-        self.path = path
+        self.index = index      # the index in the children of the parent, None for trees and the forest
         self.viewNode = None
         self.nameChangeCallback = None
         self.fieldChangeCallback = None
         self.deletionCallback = None
         self.moveCallback = None
+        self.selectionCallback = None
         self.fieldNameChangeCallback = None
         self.fieldOrderChangeCallback = None
+        self.siblingTotals = None    # created when needed, see siblingTotal()
+        self.namePath = None
+
+    @property
+    def path(self):
+        """
+        :return: The path of the node in its tree, as a tuple of child indices from the top of the tree down to the
+            node. It is computed from the indices of the node and its parents (the path of trees and the forest is
+            empty).
+        """
+        path = []
+        node = self
+        while node.index is not None:
+            path.append(node.index)
+            node = node.parent
+        return tuple(reversed(path))
 
     @staticmethod
     def _wrap_lines(raw_lines, chars=70):
@@ -697,16 +1535,7 @@ class Node:
             csv += '\n'
 
         # add node path
-        field = ''
-        pipe = False
-        if len(self.path) > 1:
-            for n in range(1, len(self.path)):
-                field += pipe and ' | ' or ''
-                field += tree.findNode(self.path[:n]).name
-                pipe = True
-        field += pipe and ' | ' or ''
-        field += self.name
-        csv += clean_field(field) + ','
+        csv += clean_field(self.getNamePath()) + ','
 
         # add node name
         csv += self.name
@@ -782,7 +1611,7 @@ class Node:
         else:
 
             # create id
-            node_id = "{}".format(self.path)
+            node_id = "{}".format(list(self.path))
 
             # create fields string
             if fields_local:
@@ -1124,6 +1953,7 @@ class Node:
                    'div.ratio-percent {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-name {position: relative; float: left; width: 10em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-path {position: relative; float: left; width: 20em; margin: 0.3em; padding: 0.3em; }' \
+                   'div.expression {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    '</style></head><body>'
         elif header and style == 'tiles' and context:
             html = '<!DOCTYPE html><html lang="en">' \
@@ -1163,6 +1993,7 @@ class Node:
                    'div.ratio-percent {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-name {position: relative; float: left; width: 20em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-path {position: relative; float: left; width: 40em; margin: 0.3em; padding: 0.3em; }' \
+                   'div.expression {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    '</style></head><body>'
         elif header and style == 'list':
             html = '<!DOCTYPE html><html lang="en">' \
@@ -1200,6 +2031,7 @@ class Node:
                    'div.ratio-percent {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-name {position: relative; float: left; width: 10em; margin: 0.3em; padding: 0.3em; }' \
                    'div.node-path {position: relative; float: left; width: 20em; margin: 0.3em; padding: 0.3em; }' \
+                   'div.expression {position: relative; float: left; width: 5em; margin: 0.3em; padding: 0.3em; }' \
                    '</style></head><body>'
         elif header and style == 'document':
             html = '<!DOCTYPE html><html lang="en">' \
@@ -1238,6 +2070,7 @@ class Node:
                    'div.ratio-percent {position: relative; float: left; width: 10%; padding: 1%; }' \
                    'div.node-name {position: relative; float: left; width: 25%; padding: 1%; }' \
                    'div.node-path {position: relative; float: left; width: 45%; padding: 1%; }' \
+                   'div.expression {position: relative; float: left; width: 10%; padding: 1%; }' \
                    '</style></head><body>'
         else:
             html = ''
@@ -1334,24 +2167,18 @@ class Node:
         # finished.
         return needed_columns, html
 
-    def createPathTo(self, item, treeindex, nodeindex, viewtemplate):
+    def linkItem(self, item, fields):
         """
-        Links an item into a tree, using the given path. Empty nodes get created on the way.
+        Links an item to the node while the tree is built (see Tree.createPathTo). The fields get their own state, but
+        nothing is calculated or sent, the values are calculated once the whole forest is built.
+        :param item: The item
+        :param fields: The field templates of the tree
+        :return: void
         """
-        
-        # either recurse deeper
-        if nodeindex < len(item.trees[treeindex]):
-            n = item.trees[treeindex][nodeindex]
-            while n >= len(self.children):
-                self.addChild()
-            self.children[n].createPathTo(item,treeindex,nodeindex+1,viewtemplate)
-        
-        # or, if in final node, link item
-        else:
-            self.item = item
-            self.name = item.name
-            self.initFields(viewtemplate)
-            self.registerCallbacks()
+        self.item = item
+        self.findTree().renameNode(self, item.name)
+        self.attachFields(fields)
+        self.registerCallbacks()
 
     def registerCallbacks(self):
         """
@@ -1360,7 +2187,7 @@ class Node:
         """
         if self.item is not None:
             self.item.registerNameChangeCallback(self.tree, self.notifyNameChange)
-            self.item.registerFieldChangeCallback(self.tree, lambda x: self.notifyFieldChange(x, True))
+            self.item.registerFieldChangeCallback(self.tree, self.notifyFieldChange)
             self.item.registerDeletionCallback(self.tree, self.notifyDeletion)
             self.item.registerMoveCallback(self.tree, self.notifyMove)
             self.item.registerSelectionCallback(self.tree, lambda x: self.notifySelection(x))
@@ -1397,8 +2224,10 @@ class Node:
         """
         Add a child to a node. The child is a new copy of the default node.
         """
-        node = Node(self, self.tree, self.path + [len(self.children)])
+        node = Node(self, self.tree, len(self.children))
         self.children += [node]
+        self.siblingTotals = None
+        self.findTree().indexBranch(node)
         return node
 
     def addNodeAsChild(self, node):
@@ -1406,6 +2235,7 @@ class Node:
         Add an existing node to a new parent.
         """
         self.children += [node]
+        self.siblingTotals = None
         node.parent = self
         self.renumberChildren()
         node.item.notifyFieldChange("")
@@ -1414,21 +2244,22 @@ class Node:
     def removeChild(self, child):
         if child in self.children:
             self.children.remove(child)
+            self.siblingTotals = None
             self.renumberChildren()
-            for f in self.fields:
-                self.notifyFieldChange(f, True)
+            changes = self.invalidateFields(None, 'child')
+            for c in self.children:
+                changes += c.invalidateFields(None, 'sibling')     # the remaining children have lost a sibling
+            self.updateFieldDisplay(changes)
             child.parent = None
+            child.index = None
 
     def renumberChildren(self):
         """
-        Correct the paths after children have been removed or added.
+        Correct the indices after children have been removed or added. The paths of the children and their branches,
+        and of their items, follow from the indices (see path, Item.trees).
         """
         for i, c in enumerate(self.children):
-            c.path = self.path + [i]
-            if c.item:
-                # print("{} {}".format(c.path, c.item.name))
-                c.item.trees[self.tree] = self.path + [i]
-                c.renumberChildren()
+            c.index = i
 
     def addItemAsChild(self, item):
         """
@@ -1436,17 +2267,16 @@ class Node:
         """
         node = self.addChild()
         node.item = item
-        node.name = item.name
+        self.findTree().renameNode(node, item.name)
         node.registerCallbacks()
-        item.trees[node.tree] = node.path
         node.initFields(self.fields)
         return node
 
     def addField(self, name, field):
         """ Adds a new field recursively in the entire tree. Silently, no messages sent. After adding, the visibility
         still needs to be adapted, and then update messages sent through the tree. . The first call does not create deep
-        copies, only subsequent recursive calls do. This is to not touch existing references when the top-level fields
-        are changed (meta nodes keep pointers to the parameter lists).
+        copies, only subsequent recursive calls do. The copies share the definition of the field (see FieldDefinition),
+        meta nodes keep pointers to the parameter lists.
         :param name: The field name
         :param field: The field itself
         :return: void
@@ -1458,40 +2288,28 @@ class Node:
 
     def findNodeByName(self, name):
         """
-        Finds the first node of a given name in the tree.
+        Finds the first node of a given name in the branch of this node, in depth-first order. The nodes are looked up
+        in the name index of the tree (see Tree.indexBranch), the branch is not searched.
         """
         if self.name == name:
             return self
-        else:
-            for c in self.children:
-                found = c.findNodeByName(name)
-                if found is not None:
-                    return found
-        return None
+        depth = len(self.path)
+        nodes = [node for node in self.findTree().names.get(name, ()) if node.path[:depth] == self.path]
+        return min(nodes, key=lambda node: node.path, default=None)   # paths sort in depth-first order
 
     def initFields(self, fields):
-        self.fields = copy.deepcopy(fields)
-        
-        # first set all fields to myself
-        for name, field in self.fields.items():
-            field.sourceNode = self
+        self.attachFields(fields)
         
         # and only then send notification
-        for name, field in self.fields.items():
-            self.notifyFieldChange(name, True)
+        self.notifyFieldChange(False)
 
-    def findNodeByName(self, name):
+    def attachFields(self, fields):
         """
-        Finds the first node of a given name in the tree.
+        Gives the node its own fields, sharing the definitions of the templates (see FieldDefinition).
+        :param fields: The field templates, as dict name: field
+        :return: void
         """
-        if self.name == name:
-            return self
-        else:
-            for c in self.children:
-                found = c.findNodeByName(name)
-                if found is not None:
-                    return found
-        return None
+        self.fields = {name: Field(self, definition=field.definition) for name, field in fields.items()}
 
     def registerNameChangeCallback(self, callback):
         self.nameChangeCallback = callback
@@ -1517,43 +2335,203 @@ class Node:
     def notifyNameChange(self, newName):
         """
         Callback used to notify a node of a name change. Changes the name, then
-        recreates strings for the fiels 'node-name' and 'node-path'.
+        recreates strings for the fiels 'node-name' and 'node-path', and for the fields joining the values of children
+        or siblings in name order.
         Recurses down the tree to update the node-path strings of all children by calling the function
         notifyParentNameChange.
         """
 
         # if name is not false, set new name and notify GUI
         if newName:
-            self.name = newName
+            self.findTree().renameNode(self, newName)
             if self.nameChangeCallback is not None:
                 self.nameChangeCallback(newName)
 
-        # always adapt all my fields in all trees (better: call the callback from the item without recursion)
-        if self.item:
-            for v in self.item.viewNodes:
-                v and v.notifyFieldChange(False, False)
+        # collect the nodes of myself and all my children in all trees, their node names and paths depend on me
+        viewNodes = []
+        branch = [self]
+        while branch:
+            node = branch.pop()
+            node.namePath = None
+            branch += node.children
+            if node.item:
+                viewNodes += [v for v in node.item.viewNodes if v]
+
+        # first mark all of them stale, and only then redisplay, so no outdated cached value gets picked up
+        changes = []
+        for v in viewNodes:
+            changes += v.invalidateFields(v.findTree().fieldDependencies().nameFields)
+
+        # the node may have moved among its siblings, fields joining their values in name order change as well
+        if newName and self.parent is not None and self.parent.parent is not None:
+            dependencies = self.findTree().fieldDependencies()
+            if dependencies.childOrderFields:
+                changes += self.parent.invalidateFields(dependencies.childOrderFields)
+            if dependencies.siblingOrderFields:
+                for c in self.parent.children:
+                    if c is not self:
+                        changes += c.invalidateFields(dependencies.siblingOrderFields)
+        self.updateFieldDisplay(changes)
+
+    def getNamePath(self):
+        """
+        :return: The names of the nodes from the top of the tree down to this node, separated by " | ", without the
+            names of the tree and the forest. Cached until the node or one of its parents is renamed or moved (see
+            notifyNameChange).
+        """
+        if self.namePath is None:
+            if self.parent is None or self.parent.parent is None or self.parent.parent.parent is None:
+                self.namePath = self.name
+            else:
+                self.namePath = self.parent.getNamePath() + " | " + self.name
+        return self.namePath
+
+    def notifyFieldChange(self, fieldName):
+        """
+        Callback, called whenever a field in a related item has changed. Recalculates and displays only the fields
+        depending on it, in this node and in all related nodes.
+        :param fieldName: The name of the changed data field, or False if any field may have changed
+        """
+        self.updateFieldDisplay(self.invalidateFields(fieldName and [fieldName] or None))
+
+    def updateFieldDisplay(self, changes):
+        """
+        Sends the current strings of changed fields to the GUI layer.
+        :param changes: List of (node, field names) pairs, as returned by invalidateFields()
+        """
+        if Node.queue is not None:
+            for node, names in changes:
+                Node.queue.setdefault(node, {}).update(dict.fromkeys(names))
+            return
+        for node, names in changes:
+            if node.fieldChangeCallback is not None:
+                for f in names:
+                    node.fieldChangeCallback(f, node.fields[f].getString())
+
+    def findTree(self):
+        """
+        :return: The tree this node belongs to
+        """
+        tree = self
+        while tree.parent.parent is not None:
+            tree = tree.parent
+        return tree
 
-        # notify all children, recursive, but only update their fields
+    def invalidateFields(self, names=None, relation='own'):
+        """
+        Marks cached field values as stale after something in this node has changed, then follows the change through
+        the dependency graph of the tree to all fields that read from it: the fields of the parent (child-fields), of
+        the siblings (sibling-fields), and of the children (parent-fields). Propagation stops at nodes where all
+        affected fields were stale already, since nothing can have read them since.
+        :param names: List of the names of the changed data or tree fields, or None if any field may have changed
+        :param relation: Where the change happened, seen from this node: 'own' for changes in this node, 'child' for
+            changes in the children, 'sibling' for changes in the siblings
+        :return: A list of (node, field names) pairs of all visible fields that were marked stale. Hidden fields are
+            not listed, they are only calculated again when a visible field or an export reads them.
+        """
+        dependencies = self.findTree().fieldDependencies()
+        changes = []
+        visited = set()     # the children of a node only need to be queued once for the same change
+        queue = [(self, None if names is None else tuple(names), relation, self)]
+        while queue:
+            node, names, relation, source = queue.pop()
+            stale = node.markFieldsDirty(dependencies.changes(names, relation), source)
+            shown = tuple(name for name in stale if name in dependencies.visible)
+            if shown:
+                changes += [(node, shown)]
+            if relation == 'own':
+                changed = names and names + stale      # the fields of the change itself are passed on, too
+            else:
+                changed = stale
+            if changed is None or changed:
+                queue += node.fieldReaders(dependencies, changed, visited)
+        return changes
+
+    def markFieldsDirty(self, changes, source):
+        """
+        Marks fields as stale. Aggregate fields also remember which related nodes have changed values, so they can
+        update their state when they are evaluated next.
+        :param changes: Tuple of (name, direct, indirect) triples, as returned by FieldDependencies.changes()
+        :param source: The node where the change happened
+        :return: A tuple of the names of the fields that were clean before
+        """
+        stale = ()
+        for name, direct, indirect in changes:
+            field = self.fields.get(name)
+            if field is None:
+                continue
+            if field.pending is not None:
+                if direct is None:
+                    field.pending = None
+                else:
+                    if direct:
+                        field.pending.add(source)
+                    if indirect:
+                        field.pending.add(self)
+            if not field.dirty:
+                field.dirty = True
+                stale += (name,)
+        return stale
+
+    def fieldReaders(self, dependencies, names, visited):
+        """
+        :param dependencies: The compiled field dependencies of the tree
+        :param names: Tuple of the changed field names in this node, or None for all fields
+        :param visited: A set of (node id, relation, names) of nodes whose readers have already been listed, these
+            are skipped
+        :return: A list of (node, names, relation, source) of all nodes that can read the changed fields, the relation
+            under which they do it, and this node as the source of the change
+        """
+        readers = []
+        if self.parent is not None:
+            if dependencies.affected(names, 'child'):
+                readers += [(self.parent, names, 'child', self)]
+            if dependencies.affected(names, 'sibling') and (id(self), 'sibling', names) not in visited:
+                visited.add((id(self), 'sibling', names))
+                self.parent.markSiblingTotals(names, self)
+                readers += [(c, names, 'sibling', self) for c in self.parent.children if c is not self]
+        if dependencies.affected(names, 'parent') and (id(self), 'parent', names) not in visited:
+            visited.add((id(self), 'parent', names))
+            readers += [(c, names, 'parent', self) for c in self.children]
+        return readers
+
+    def clearFieldCache(self):
+        """
+        Marks the cached values of all fields in this node and in all its children as stale. Used when field
+        definitions change.
+        """
+        for field in self.fields.values():
+            field.dirty = True
+            field.state = None
+            field.pending = None
+        self.siblingTotals = None
         for c in self.children:
-            c.notifyNameChange(False)
+            c.clearFieldCache()
 
-    def notifyFieldChange(self, fieldName, recursion):
+    def siblingTotal(self, aggregate, fields):
         """
-        Callback, called whenever a field in a related item has changed.
+        :param aggregate: An invertible or selective aggregate
+        :param fields: The names of the fields read from the siblings
+        :return: The up-to-date totals over the given fields of all children of this node, see SiblingTotals
         """
+        key = (aggregate, tuple(fields))
+        if self.siblingTotals is None:
+            self.siblingTotals = {}
+        totals = self.siblingTotals.get(key)
+        if totals is None:
+            totals = self.siblingTotals[key] = SiblingTotals(aggregate, fields)
+        totals.update(self)
+        return totals
 
-        if self.fieldChangeCallback is not None:
-            for f in self.fields:
-                self.fieldChangeCallback(f, self.fields[f].getString())
-        
-        if recursion:
-            if self.parent is not None:
-                # notify all siblings, non-recursive
-                for c in self.parent.children:
-                    if c is not self:
-                        c.notifyFieldChange(fieldName, False)
-                # notify all parents, recursive
-                self.parent.notifyFieldChange(fieldName, True)
+    def markSiblingTotals(self, names, child):
+        """
+        Tells the sibling totals kept by this node that fields of a child have changed.
+        :param names: Tuple of the changed field names, or None if any field may have changed
+        :param child: The child
+        """
+        for totals in (self.siblingTotals or {}).values():
+            if names is None or any(f in names for f in totals.fields):
+                totals.changed(child)
 
     def notifyDeletion(self):
         """
@@ -1561,8 +2539,17 @@ class Node:
         Recursion removes the complete child branch in this tree.
         """
 
-        # unlink item
+        # unlink item, and don't send anything to the GUI anymore
         self.item = None
+
+        # drop the branch from the name index of the tree (unless it has been taken out of the tree already)
+        tree = self
+        while tree.index is not None:
+            tree = tree.parent
+        if isinstance(tree, Tree):
+            tree.indexBranch(self, False)
+        if Node.queue is not None:
+            Node.queue.pop(self, None)
         
         # tell the GUI layer to remove my QNode from its parent
         if self.deletionCallback is not None:
@@ -1582,7 +2569,7 @@ class Node:
         tree = self
         while tree.parent.parent is not None:
             tree = tree.parent
-        path = self.item.trees[self.tree]
+        path = self.item.paths[self.tree]     # the new path, set by Item.moveInTree()
         newParent = tree.findNode(path[0:-1])
 
         # move node
@@ -1604,13 +2591,28 @@ class Node:
 
     def removeEmptyNodes(self):
         """
-        Recurse to find nodes that have no items. If found, those nodes are removed and their siblings renumbered.
-        Called after initial loading of the file.
+        Removes all nodes without item from the branch below this node, in one pass. The children of each node are
+        filtered and renumbered once, and no notifications are sent. Called after initial loading of the file, before
+        anything is displayed. Nodes without item that have items below them are kept, so no item gets lost.
+        :return: True if this node or any node below it has an item
         """
+        children = []
+        removed = []
         for c in self.children:
-            c.removeEmptyNodes()
-        if not self.item:
-            self.notifyDeletion()
+            if c.removeEmptyNodes():
+                children.append(c)
+            else:
+                removed.append(c)
+        if removed:
+            tree = self.findTree()
+            for c in removed:
+                tree.indexBranch(c, False)
+                c.parent = None
+                c.index = None
+            self.children = children
+            self.siblingTotals = None
+            self.renumberChildren()
+        return self.item is not None or bool(self.children)
 
     def updateFieldOrderEntry(self, n, newName):
         """ Notifies the QNode of a change in the tree's fieldOrderer in this node (if it is a tree), and in the node's view node, via the
@@ -1649,22 +2651,42 @@ class Node:
 
     def changeFieldType(self, field, newType):
         """
-        Changes the type of a field to the new type, sets the appropriate callbacks, and recurses down all children.
-        Does not update anything (not possible during changing), this has to be done separately by calling the
-        notifyDefinitionChange function.
+        Changes the type of a field to the new type, and sets the appropriate callbacks. The definition of the field is
+        shared by all nodes of the tree (see FieldDefinition), so this changes the field in all of them. Does not update
+        anything (not possible during changing), this has to be done separately by calling updateFieldContent().
         :param field: The field name to update
         :param newType: The new type of the field
         :return: void
         """
         self.fields[field].fieldType = newType
         self.fields[field].initFieldType()
-        for c in self.children:
-            c.changeFieldType(field, newType)
+
+    def changeFieldSketchSize(self, field, size):
+        """
+        Changes the sketch size of a field in all nodes of the tree. Like changeFieldType(), this does not update
+        anything.
+        :param field: The field name to update
+        :param size: The new size, None for the default size of the field type
+        :return: void
+        """
+        self.fields[field].sketchSize = size
+        self.fields[field].initFieldType()
+
+    def changeFieldExpression(self, field, expression):
+        """
+        Changes the formula of an expression field in all nodes of the tree. Like changeFieldType(), this does not
+        update anything.
+        :param field: The field name to update
+        :param expression: The new formula
+        :return: void
+        """
+        self.fields[field].expression = expression
+        self.fields[field].initFieldType()
 
     def changeFieldDefinition(self, fieldName, field):
         """
-        Changing the field definition during meta structure editing. Will apply a deep copy of the field to itself,
-        and recursively, all children.
+        Changing the field definition during meta structure editing. Will apply a copy of the field, sharing its
+        definition, to itself, and recursively, all children.
         """
         self.fields[fieldName] = copy.deepcopy(field)
         self.fields[fieldName].sourceNode = self
@@ -1673,55 +2695,40 @@ class Node:
 
     def changeFieldOwnParameters(self, name, params):
         """
-        Recursively changes the own-fields parameter list in all fields. The first call does not create deep copies,
-        only subsequent recursive calls do. This is to not touch existing references when the top-level fields are
-        changed (meta nodes keep pointers to the parameter lists).
+        Changes the own-fields parameter list of a field in all nodes of the tree (the definition is shared, see
+        FieldDefinition). The list is not copied, meta nodes keep pointers to the parameter lists.
         :param name: Name of the field
         :param params: List of parameters
         :return:
         """
         self.fields[name].ownFields = params
-        for c in self.children:
-            c.changeFieldOwnParameters(name, copy.deepcopy(params))
 
     def changeFieldChildParameters(self, name, params):
         """
-        Recursively changes the own-fields parameter list in all fields. The first call does not create deep copies,
-        only subsequent recursive calls do. This is to not touch existing references when the top-level fields are
-        changed (meta nodes keep pointers to the parameter lists).
+        Changes the child-fields parameter list of a field in all nodes of the tree, see changeFieldOwnParameters().
         :param name: Name of the field
         :param params: List of parameters
         :return:
         """
         self.fields[name].childFields = params
-        for c in self.children:
-            c.changeFieldChildParameters(name, copy.deepcopy(params))
 
     def changeFieldSiblingParameters(self, name, params):
         """
-        Recursively changes the sibling-fields parameter list in all fields. The first call does not create deep copies,
-        only subsequent recursive calls do. This is to not touch existing references when the top-level fields are
-        changed (meta nodes keep pointers to the parameter lists).
+        Changes the sibling-fields parameter list of a field in all nodes of the tree, see changeFieldOwnParameters().
         :param name: Name of the field
         :param params: List of parameters
         :return:
         """
         self.fields[name].siblingFields = params
-        for c in self.children:
-            c.changeFieldSiblingParameters(name, copy.deepcopy(params))
 
     def changeFieldParentParameters(self, name, params):
         """
-        Recursively changes the own-fields parameter list in all fields. The first call does not create deep copies,
-        only subsequent recursive calls do. This is to not touch existing references when the top-level fields are
-        changed (meta nodes keep pointers to the parameter lists).
+        Changes the parent-fields parameter list of a field in all nodes of the tree, see changeFieldOwnParameters().
         :param name: Name of the field
         :param params: List of parameters
         :return:
         """
         self.fields[name].parentFields = params
-        for c in self.children:
-            c.changeFieldParentParameters(name, copy.deepcopy(params))
 
     def updateFieldContent(self, fieldName):
         """
@@ -1730,7 +2737,10 @@ class Node:
         """
         for c in self.children:
             c.updateFieldContent(fieldName)
-        if self.fieldChangeCallback:
+        if self.fieldChangeCallback and fieldName in self.fields:    # nodes without item may have no fields
+            if Node.queue is not None:
+                Node.queue.setdefault(self, {})[fieldName] = None
+                return
             try:
                 self.fieldChangeCallback(fieldName, self.fields[fieldName].getString())
             except:
@@ -1745,31 +2755,83 @@ class Tree(Node):
     def __init__(self, parent, index):
         """Initialise"""
         
-        super().__init__(parent, index, [])
+        super().__init__(parent, index, None)
         self.fieldOrder = []
         self.fields = {}
+        self.dependencies = None
         self.name = ""
+        self.names = {}     # all nodes of the tree by name, as dict name: set of nodes
 
     def createPathTo(self, item, treeindex):
         """
-        Sort the item into the forest, creating existing nodes on the fly if missing.
+        Sort the item into the forest, creating missing nodes on the fly. Used while the forest is built, the path is
+        the one read from the file.
         """
 
-        # per tree: loop over all nodes, creating if necessary
-        # per node: create final node and link it to item
-        if item.trees[treeindex]:
-            n = item.trees[treeindex][0]
-            while n >= len(self.children):
-                self.addChild()
-            self.children[n].createPathTo(item, treeindex, 1, self.fields)
+        # walk down the path, creating nodes if necessary, and link the final node to the item
+        path = item.paths[treeindex]
+        if path:
+            node = self
+            for n in path:
+                while n >= len(node.children):
+                    node.addChild()
+                node = node.children[n]
+            node.linkItem(item, self.fields)
 
     def findNode(self, path):
         """
-        Find the node at a given path. Calls the respective function of the Node class.
+        Find the node at a given path, by following the child indices down the tree.
+        :param path: The path, a sequence of child indices
+        :return: The node, the tree itself for an empty path, None if there is no node at the path
+        """
+        node = self
+        for n in path:
+            if n >= len(node.children):
+                return None
+            node = node.children[n]
+        return node
+
+    def indexBranch(self, node, add=True):
+        """
+        Adds a node and all nodes below it to the name index of the tree, or removes them. The index is kept up to
+        date by Node.addChild(), Node.notifyDeletion(), and renameNode(). Moving a branch (removeChild() and
+        addNodeAsChild()) keeps it in the tree, and in the index.
+        :param node: The top node of the branch
+        :param add: True to add the nodes, False to remove them
+        :return: void
+        """
+        branch = [node]
+        while branch:
+            node = branch.pop()
+            branch += node.children
+            if add:
+                self.names.setdefault(node.name, set()).add(node)
+            else:
+                self.unindexName(node)
+
+    def renameNode(self, node, name):
+        """
+        Sets the name of a node of the tree, and updates the name index.
+        :param node: The node
+        :param name: The new name
+        :return: void
         """
+        if node is not self:
+            self.unindexName(node)
+            self.names.setdefault(name, set()).add(node)
+        node.name = name
 
-        # per tree: loop over all nodes, creating if necessary
-        return super().findNode(path, 0)
+    def unindexName(self, node):
+        """
+        Removes a node from the name index.
+        :param node: The node
+        :return: void
+        """
+        nodes = self.names.get(node.name)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.names[node.name]
 
     def writeToString(self):
         string = "tree " + json.dumps(self.name) + "\n"
@@ -1786,17 +2848,117 @@ class Tree(Node):
                 string += "    " + f.writeToString()
         return string
 
-    def readFromString(self, string):
-        fieldStrings = string.split("\n    field ")
-        for n,fs in enumerate(fieldStrings):
-            if n==0:
-                self.name = json.loads(fs)
-            else:
-                f = Field()
-                name = f.readFromString(fs)
-                self.fields[name] = f
-                if not f.hidden:
-                    self.fieldOrder += [name]
+    def readField(self, name, field):
+        """
+        Adds a field read from the file (see Forest.readFromLines) to the templates.
+        :param name: The name of the field
+        :param field: The field, with all parameters read
+        :return: void
+        """
+        field.initFieldType()
+        self.fields[name] = field
+        if not field.hidden:
+            self.fieldOrder += [name]
+
+    def finishReading(self):
+        """
+        Called when all fields of the tree are read. Drops the compiled dependencies, and reports the fields that cannot
+        be calculated.
+        :return: void
+        """
+        self.dependencies = None
+        for error in self.checkFieldCycles():
+            print(f'... error in tree "{self.name}": {error}, these fields are not calculated.')
+
+    def checkFieldCycles(self):
+        """
+        Marks the fields that read themselves endlessly (see FieldDependencies.cycles), these are not calculated. Fields
+        that are not part of such a cycle anymore are calculated again.
+        :return: A list of error messages, one for each cycle
+        """
+        cycles = FieldDependencies(self.fields).cycles()
+        cyclic = {name for group in cycles for name in group}
+        for name, field in self.fields.items():
+            if field.cyclic != (name in cyclic):
+                field.cyclic = name in cyclic
+                field.initFieldType()   # the definition is shared, this changes the field in all nodes
+        return [Tree.cycleMessage(group) for group in cycles]
+
+    @staticmethod
+    def cycleMessage(group):
+        """
+        :param group: The names of fields reading each other endlessly
+        :return: A message telling the user about it
+        """
+        if len(group) == 1:
+            return f'field "{group[0]}" reads itself in the same node'
+        names = ', '.join(f'"{name}"' for name in group)
+        return f'fields {names} read each other in the same node'
+
+    def updateFieldContent(self, fieldName):
+        """
+        Overrides the function in node. Definitions have changed, so the dependencies are compiled again and all cached
+        values are dropped, before the new values of the field and all visible fields depending on it are sent to the
+        nodes.
+        """
+        self.dependencies = None
+        self.clearFieldCache()
+        self.precomputeFields()
+        dependencies = self.fieldDependencies()
+        for name in dependencies.dependents(fieldName) or (fieldName,):
+            if name in dependencies.visible:
+                super().updateFieldContent(name)
+
+    def addField(self, name, field):
+        """
+        Overrides the function in node, the dependencies have to be compiled again.
+        """
+        self.dependencies = None
+        super().addField(name, field)
+
+    def markFieldsDirty(self, changes, source):
+        """
+        Overrides the function in node. The fields of a tree are only templates, they never hold values.
+        :return: An empty tuple
+        """
+        return ()
+
+    def precomputeFields(self):
+        """
+        Calculates the values of all simple aggregate fields (sums, means, minima, and maxima of data fields, see
+        BranchAggregates) for the whole tree at once and stores them in the fields' caches. Only fields that are shown,
+        or read by shown fields, are calculated. Other fields, and all fields if numpy is not installed, are calculated
+        as usual when they are first needed.
+        """
+        if numpy is None or not self.children:
+            return
+        dataFields = {name for name, f in self.parent.itemTypes.items[0].fields.items()
+                      if f["type"] in ("integer", "timer")}
+        needed = self.fieldDependencies().needed
+        names = [name for name, f in self.fields.items()
+                 if name in needed and BranchAggregates.eligible(name, f, dataFields, self.fields)]
+        if not names:
+            return
+        branches = BranchAggregates(self)
+        if any(node.item is None for node in branches.nodes):
+            return
+        for name in names:
+            values = branches.calculate(name, self.fields[name])
+            if values is not None:
+                for node, value in zip(branches.nodes, values):
+                    field = node.fields[name]
+                    field.cache = value
+                    field.dirty = False
+                    field.state = None
+                    field.pending = None
+
+    def fieldDependencies(self):
+        """
+        :return: The dependency graph of the tree fields, compiled on first use after a change of the definitions
+        """
+        if self.dependencies is None:
+            self.dependencies = FieldDependencies(self.fields)
+        return self.dependencies
 
     def fieldIndexFromName(self, name):
         """
@@ -1806,14 +2968,6 @@ class Tree(Node):
         [index] = [n for n, field in enumerate(self.fieldOrder) if field==name] or [-1]
         return index
 
-    def removeEmptyNodes(self):
-        """
-        Recurse to find nodes that have no items. If found, those nodes are removed and their siblings renumbered.
-        Overrides same function in node, does not remove self (trees have no item anyway).
-        """
-        for c in self.children:
-            c.removeEmptyNodes()
-
     def changeName(self, newName):
         """
         Called by a MetaNode. Changes the tree's name and calls all callbacks to propagate that change through the
@@ -1822,6 +2976,7 @@ class Tree(Node):
         :return: void
         """
         self.name = newName
+        self.namePath = None
 
     def changeFieldName(self, oldName, newName):
         """
@@ -1858,6 +3013,7 @@ class Tree(Node):
             field = self.fields.pop(oldName)
             if newName:
                 self.fields[newName] = field
+        self.dependencies = None
 
         # Build new fields if they use the old name in definition
         changes = []    # list of fields that were changed
@@ -1867,14 +3023,17 @@ class Tree(Node):
             changed |= renameSingle(field.childFields)
             changed |= renameSingle(field.siblingFields)
             changed |= renameSingle(field.parentFields)
+            if field.fieldType == "expression" and newName:
+                expression = Expression.rename(field.expression, oldName, newName)
+                if expression != field.expression:
+                    field.expression = expression
+                    field.initFieldType()
             if changed:
                 changes += [fname]
 
-        # Replace all fields in tree and update their value
+        # Rename the fields in all nodes, the definitions are shared and have been changed already
         for c in self.children:
             c.changeFieldName(oldName, newName)
-            for fname in changes:
-                c.changeFieldDefinition(fname, self.fields[fname])    # this is the renamed field, replace old name
 
         # then (when all fields are replaced) send the definition updates
         for fname in changes:
@@ -1887,14 +3046,43 @@ class Tree(Node):
         :return:
         """
 
-        # Change type of all fields
-        newType = self.fields[fieldName].fieldType
-        for c in self.children:
-            c.changeFieldType(fieldName, newType)
+        # Change type of all fields (the definition is shared by all nodes)
+        self.changeFieldType(fieldName, self.fields[fieldName].fieldType)
 
         # Notify definition change
         self.updateFieldContent(fieldName)
 
+    def updateFieldExpression(self, fieldName):
+        """
+        Called by a MetaNode. The formula of a top-level expression field has changed, set it in all nodes, then update
+        all nodes and redisplay. The parameter lists of the field are set to the fields read by the formula.
+        :param fieldName: The field name
+        :return: None if success, an error message if the formula cannot be used
+        """
+        expression = self.fields[fieldName].expression
+        error = Expression.compiled(expression).error
+        if error:
+            return error
+        fields = dict(self.fields)
+        fields[fieldName] = Field(definition=self.fields[fieldName].definition.copy())    # reads the new formula
+        for group in FieldDependencies(fields).cycles():
+            if fieldName in group:
+                return Tree.cycleMessage(group)
+        self.changeFieldExpression(fieldName, expression)
+        self.checkFieldCycles()
+        self.updateFieldContent(fieldName)
+        return None
+
+    def updateFieldSketchSize(self, fieldName):
+        """
+        Called by a MetaNode. The sketch size of a top-level field has changed, set it in all nodes, then update all
+        nodes and redisplay.
+        :param fieldName: The field name
+        :return: void
+        """
+        self.changeFieldSketchSize(fieldName, self.fields[fieldName].sketchSize)
+        self.updateFieldContent(fieldName)
+
     def updateFieldVisibility(self, name):
         """
         Called by a MetaNode. A top-level field visibility has changed, update the fieldOrder list, then update all
@@ -1931,8 +3119,13 @@ class Tree(Node):
         nodes and redisplay.
         :param name: The field name
         :param hidden: Whether the field is now hidden or not
-        :return: True if success, False if error
+        :return: True if success, False if error (if the field would read itself endlessly the change has to be undone
+            by the caller, nothing has been changed in the nodes)
         """
+        for group in FieldDependencies(self.fields).cycles():
+            if fieldName in group and not self.fields[fieldName].cyclic:
+                print(f'... error in tree "{self.name}": {Tree.cycleMessage(group)}, the change is not possible.')
+                return False
         result = True
         if listName == 'own-fields':
             self.changeFieldOwnParameters(fieldName, self.fields[fieldName].ownFields)
@@ -1947,10 +3140,301 @@ class Tree(Node):
             result = False
 
         # Update all field values
+        self.checkFieldCycles()
         self.updateFieldContent(fieldName)
         return result
 
 
+class FileReader:
+    """
+    Reads a forest file line by line, so only the current line is held in memory. The file is made of the sections
+    "--trees--", "--item-types--", and "--item-pool--", in this order. Iterating over section() yields the lines of one
+    section as pairs (line number, line), without the line end. The sections have to be read in the order of the file,
+    lines before the requested section are skipped.
+    """
+    Sections = ("--trees--", "--item-types--", "--item-pool--")
+
+    def __init__(self, file, filename):
+        """
+        :param file: The file, opened for reading
+        :param filename: The name of the file, for error messages
+        """
+        self.lines = enumerate(file, 1)
+        self.filename = filename
+        self.current = None     # the section of the last line read
+        self.lineNumber = 0
+
+    def nextLine(self):
+        """
+        Reads the next line, and switches to the next section if the line is a section header.
+        :return: The line without the line end, or None at the end of the file
+        """
+        for self.lineNumber, line in self.lines:
+            if line.endswith("\n"):
+                line = line[:-1]
+            if line in FileReader.Sections:
+                self.current = line
+            return line
+        return None
+
+    def section(self, name):
+        """
+        :param name: The section header, one of FileReader.Sections
+        :return: A generator of pairs (line number, line) of all lines in the section
+        :raise KeyError: If the file has no such section after the lines already read
+        """
+        while self.current != name:
+            if self.nextLine() is None:
+                raise KeyError("Corrupt data file. "
+                               "The section {} is missing in {}. "
+                               "Please correct manually in a text editor and then reload the file. "
+                               "".format(name, self.filename))
+        while True:
+            line = self.nextLine()
+            if line is None or self.current != name:
+                return
+            yield self.lineNumber, line
+
+
+class Journal:
+    """
+    The changes of item names and data field contents since the file was last written, kept in a file next to it (the
+    file name with ".journal" appended). Each change is appended as one line of JSON and written to the disk right
+    away, which is much cheaper than writing the whole file. The item is given by its path in the first tree it is in.
+    Paths stay valid only as long as the structure of the forest is the one in the file, so after any other change
+    (moving, adding, or removing nodes, changing fields or trees) no more changes are recorded until the file is
+    written again (see suspend). Writing the file folds the journal into it, and empties it (see compaction). While
+    the file is written, changes go to a second journal (".journal.next"), which afterwards becomes the journal of the
+    new file. When the file is read, the changes in both journals are applied again (see replay). The first line of a
+    journal holds the size and time of the file it belongs to, a journal left from another version of the file is not
+    applied.
+    """
+    Limit = 1000    # the number of changes after which the whole file is written instead
+
+    def __init__(self, filename):
+        """
+        :param filename: The name of the forest file
+        """
+        self.filename = filename
+        self.file = None            # the journal file, opened for appending with the first change
+        self.changes = 0
+        self.active = True
+        self.compacting = False     # True while the file is written, changes go to the second journal then
+        self.lock = threading.Lock()    # the file is written in a timer thread, changes come from the GUI
+
+    def journalName(self):
+        """
+        :return: The name of the journal file
+        """
+        return self.filename + ".journal"
+
+    def segmentName(self):
+        """
+        :return: The name of the journal file used while the forest file is written
+        """
+        return self.filename + ".journal.next"
+
+    def snapshot(self):
+        """
+        :return: The size and modification time of the forest file, identifying the version the journal belongs to
+        """
+        status = os.stat(self.filename)
+        return [status.st_size, status.st_mtime_ns]
+
+    def openFile(self, name):
+        """
+        Opens a journal file for appending, and writes the first line if the file is new.
+        :param name: The name of the journal file
+        :return: The file
+        """
+        header = json.dumps({"snapshot": self.snapshot()}) + "\n"
+        new = not os.path.exists(name)
+        file = open(name, "a")
+        if new:
+            file.write(header)
+        return file
+
+    def close(self):
+        """
+        Closes the journal file, the next change opens it again.
+        :return: void
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, change):
+        """
+        Appends a change to the journal, and writes it to the disk.
+        :param change: The change, as dict
+        :return: True if the change is recorded, False if the whole file needs to be written instead
+        """
+        with self.lock:
+            if not self.active or self.changes >= Journal.Limit:
+                return False
+            try:
+                if self.file is None:
+                    self.file = self.openFile(self.segmentName() if self.compacting else self.journalName())
+                self.file.write(json.dumps(change) + "\n")
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                print(f"Error writing the journal {self.journalName()}: {e}, the file is written instead.")
+                self.active = False
+                return False
+            self.changes += 1
+            return True
+
+    def suspend(self):
+        """
+        Stops recording changes until the file is written again, after a change that is not recorded in the journal.
+        :return: void
+        """
+        self.active = False
+
+    @contextmanager
+    def compaction(self, filename):
+        """
+        Context manager for writing the forest file, see Forest.writeToFile. Changes made meanwhile are appended to the
+        second journal, so the lock is only held to switch between the journals, not while the file is written. When
+        the file is written, the second journal becomes the journal of the file written. If writing fails, it is
+        appended to the journal of the old file again. A journal suspended while the file is written stays suspended.
+        Usage: with journal.compaction(filename): ...
+        :param filename: The name of the file written
+        """
+        with self.lock:
+            active, changes = self.active, self.changes
+            self.active = True
+            self.close()
+            self.compacting = True
+            self.changes = 0
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self.close()
+                self.compacting = False
+                if active:
+                    self.changes += changes
+                    self.merge()
+                else:
+                    self.discard()      # recorded for the forest in memory, which differs from the file
+                self.active = active and self.active
+            raise
+        with self.lock:
+            self.close()
+            self.compacting = False
+            segment = self.segmentName()
+            changes = self.read(segment, anyVersion=True) or []     # the file it belonged to has just been replaced
+            if not self.active:
+                changes = []    # the paths might not match the file written, the changes are written with the file
+            self.filename = filename
+            try:
+                if changes:
+                    temporary = self.journalName() + ".tmp"
+                    with open(temporary, "w") as f:
+                        f.write(json.dumps({"snapshot": self.snapshot()}) + "\n")
+                        for lineNumber, change in changes:
+                            f.write(json.dumps(change) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(temporary, self.journalName())
+                elif os.path.exists(self.journalName()):
+                    os.remove(self.journalName())
+                if os.path.exists(segment):
+                    os.remove(segment)
+            except OSError as e:
+                print(f"Error writing the journal {self.journalName()}: {e}, the file is written instead.")
+                self.active = False
+            self.changes = len(changes)
+
+    def merge(self):
+        """
+        Appends the changes in the second journal to the journal, and removes the second journal. Called with the lock
+        held, and the journal closed.
+        :return: void
+        """
+        try:
+            changes = self.read(self.segmentName())
+            if changes:
+                with self.openFile(self.journalName()) as f:
+                    for lineNumber, change in changes:
+                        f.write(json.dumps(change) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.discard()
+        except OSError as e:
+            print(f"Error writing the journal {self.journalName()}: {e}, the file is written instead.")
+            self.active = False
+
+    def discard(self):
+        """
+        Removes the second journal.
+        :return: void
+        """
+        if os.path.exists(self.segmentName()):
+            os.remove(self.segmentName())
+
+    def read(self, name, anyVersion=False):
+        """
+        Reads a journal file. A line that cannot be read (the end of a change written when the program stopped) is cut
+        off, with everything after it. A journal that belongs to another version of the forest file is removed.
+        :param name: The name of the journal file
+        :param anyVersion: If True, the version of the forest file is not checked
+        :return: The list of (line number, change) in the journal, None if there is no journal for this version of the
+            forest file
+        """
+        if not os.path.exists(name):
+            return None
+        changes = []
+        with open(name, "rb+") as f:
+            lines = enumerate(f, 1)
+            try:
+                snapshot = json.loads(next(lines, (0, b""))[1]).get("snapshot")
+            except (ValueError, AttributeError):
+                snapshot = None
+            current = snapshot if anyVersion else self.snapshot()
+            if snapshot == current:
+                end = f.tell()
+                for lineNumber, line in lines:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        changes += [(lineNumber, json.loads(line))]
+                    except ValueError:
+
+                        # the end of a change written when the program stopped, cut it off to append after it
+                        print(f"... warning: line {lineNumber} of the journal {name} cannot be read, the changes from "
+                              f"there on are lost.")
+                        f.truncate(end)
+                        break
+                    end += len(line)
+        if snapshot != current:
+            print(f"... warning: the journal {name} does not belong to this version of the file, it is not applied "
+                  f"and removed.")
+            os.remove(name)
+            return None
+        return changes
+
+    def replay(self, forest):
+        """
+        Applies the changes in the journals to the forest, after the file has been read. The changes in the second
+        journal, left if the program stopped while writing the file, are moved to the journal.
+        :param forest: The forest
+        :return: void
+        """
+        changes = [(name, lineNumber, change) for name in (self.journalName(), self.segmentName())
+                   for lineNumber, change in self.read(name) or []]
+        if changes:
+            print(f"... applying the changes in the journal ...")
+        for name, lineNumber, change in changes:
+            if not forest.applyChange(change):
+                print(f"... warning: the change in line {lineNumber} of the journal {name} cannot be applied.")
+        self.changes = len(changes)
+        with self.lock:
+            self.merge()
+
+
 class Forest(Node):
     """
     The trunk node containing trees, that contain the nodes. Also manages the node templates.
@@ -1959,31 +3443,60 @@ class Forest(Node):
     def __init__(self, filename):
         """Initialise"""
         
-        super().__init__(None, None, [])
+        super().__init__(None, None, None)
         self.itemPool = None
         self.itemTypes = None
+        self.timers = TimerService(self)
+        self.journal = Journal(filename)
         self.readFromFile(filename)
 
+    @contextmanager
+    def batch(self):
+        """
+        Context manager for bulk changes. Within a batch, fields are still marked stale right away, but nothing is sent
+        to the GUI. At the end of the batch each changed field is calculated and displayed once, however often it was
+        changed. Batches can be nested, the outermost one sends the changes.
+        Usage: with forest.batch(): ...
+        """
+        if Node.queue is not None:
+            yield
+            return
+        Node.queue = {}
+        try:
+            yield
+        finally:
+            queue, Node.queue = Node.queue, None
+            for node, names in queue.items():
+                try:
+                    node.updateFieldDisplay([(node, names)])
+                except:
+                    print("Error in propagating field change")
+
     def createPaths(self):
         """
         Sort all items from the itempool into the forest,
-        creating the forest structure as defined by the items' node indexes
+        creating the forest structure as defined by the items' node indexes.
+        The items are taken tree by tree from the paths collected while the pool was read (see ItemPool.existing_paths).
         """
-        for item in self.itemPool.items:
-            self.createPathTo(item)
-
-    def createPathTo(self, item):
-        
-        # start: loop over all trees, creating if necessary
-        for b in range(len(item.trees)):
+        for b, paths in enumerate(self.itemPool.existing_paths):
             if b >= len(self.children):
                 self.addTree()
-            if item.trees[b]:
-                self.children[b].createPathTo(item,b)
+            for item in paths.values():
+                self.children[b].createPathTo(item, b)
 
     def addTree(self):
         self.children += [Tree(self, len(self.children))]
 
+    def findNodeByName(self, name):
+        """
+        Overrides the function in node, looks up the first node of the given name in each tree.
+        """
+        for tree in self.children:
+            found = tree.findNodeByName(name)
+            if found is not None:
+                return found
+        return None
+
     def renumberChildren(self):
         """
         Correct the paths after children have been removed or added.
@@ -1993,8 +3506,8 @@ class Forest(Node):
 
     def removeEmptyNodes(self):
         """
-        Recurse to find nodes that have no items. If found, those nodes are removed and their siblings renumbered.
-        Overrides same function in node, does not remove self (forests have no item anyway).
+        Removes the nodes without item from all trees (see Node.removeEmptyNodes). Overrides same function in node,
+        does not remove trees.
         """
         for c in self.children:
             c.removeEmptyNodes()
@@ -2006,61 +3519,183 @@ class Forest(Node):
         return s
 
     def readFromString(self, string):
-        string = string.split("\n\ntree ")
+        self.readFromLines(enumerate(string.split("\n"), 1))
+
+    def readFromLines(self, lines):
+        """
+        Reads the tree definitions, as written by writeToString(), line by line. Trees are created as needed.
+        :param lines: The lines, as pairs (line number, line)
+        :return: void
+        :raise KeyError: If a line cannot be read
+        """
         n = 0
-        for s in string:
-            if s != "":
-                self.children[n].readFromString(s)
-                n += 1
+        tree = None
+        field = None
+        for lineNumber, line in lines:
+            if line.startswith("        ") and field is not None:
+                field.readParameter(name, line.strip(), lineNumber)
+                continue
+            if field is not None:
+                tree.readField(name, field)
+                field = None
+            if not line.strip():
+                continue
+            try:
+                if line.startswith("    field ") and tree is not None:
+                    name = json.loads(line[10:])
+                    field = Field()
+                elif line.startswith("tree "):
+                    if tree is not None:
+                        tree.finishReading()
+                    if n >= len(self.children):
+                        self.addTree()
+                    tree = self.children[n]
+                    tree.name = json.loads(line[5:])
+                    n += 1
+                else:
+                    raise ValueError("not a tree or field definition")
+            except ValueError as e:
+                raise KeyError("Corrupt data file. "
+                               "Line {} in the file could not be read: {}. "
+                               "Please correct manually in a text editor and then reload the file. "
+                               "".format(lineNumber, e))
+        if field is not None:
+            tree.readField(name, field)
+        if tree is not None:
+            tree.finishReading()
 
     def writeToFile(self, filename):
-        treeString = self.writeToString()
-        typeString = self.itemTypes.writeToString()
-        itemString = self.itemPool.writeToString()
-        with open(filename, "w") as f:
-            f.write("--trees--\n\n")
-            f.write(treeString)
-            f.write("--item-types--\n\n")
-            f.write(typeString)
-            f.write("--item-pool--\n\n")
-            f.write(itemString)
+        """
+        Writes the forest to the file. The sections are written one tree and one item at a time to a temporary file
+        next to it, which replaces the file only once it is complete and on the disk. If saving fails, the file is
+        left as it was. The changes recorded in the journal are now in the file, the journal is emptied.
+        :param filename: The name of the file
+        :return: void
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        with self.journal.compaction(filename):
+            handle, temporary = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(handle, "w") as f:
+                    f.write("--trees--\n\n")
+                    for b in self.children:
+                        f.write(b.writeToString() + "\n")
+                    f.write("--item-types--\n\n")
+                    self.itemTypes.write(f)
+                    f.write("--item-pool--\n\n")
+                    self.itemPool.write(f, self.orderedItems())
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.exists(filename):
+                    shutil.copymode(filename, temporary)
+                else:
+                    # temporary files are only readable by the user, new files get the usual mode
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(temporary, 0o666 & ~umask)
+                os.replace(temporary, filename)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+    def journalChange(self, item, fieldName=None):
+        """
+        Records a change of the content of a data field of an item, or of its name, in the journal (see Journal).
+        :param item: The item
+        :param fieldName: The name of the changed field, None if the name of the item has changed
+        :return: True if the change is recorded, False if the whole file needs to be written instead
+        """
+        for b, view in enumerate(item.views):
+            if view.node is not None:
+                change = {"tree": b, "path": list(view.node.path)}
+                if fieldName is None:
+                    change["name"] = item.name
+                else:
+                    change["field"] = fieldName
+                    change["content"] = item.fields[fieldName]
+                return self.journal.append(change)
+        return False
+
+    def applyChange(self, change):
+        """
+        Applies a change read from the journal (see journalChange).
+        :param change: The change, as dict
+        :return: True if the change was applied, False if the item or the field does not exist
+        """
+        try:
+            node = self.children[change["tree"]].findNode(change["path"])
+            if node is None or node.item is None or not change["path"]:
+                return False
+            if "name" in change:
+                node.item.changeName(change["name"])
+            elif change["field"] in node.item.fields:
+                node.item.fields[change["field"]] = change["content"]
+            else:
+                return False
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+
+    def orderedItems(self):
+        """
+        :return: A generator of all items of the pool, in the order of their paths (as sorted by Item.trees), found by
+            walking the trees instead of sorting. Items in no tree come first, then the items whose first tree is the
+            last tree, and so on, up to the items in the first tree. Each group is in the order of its tree, parents
+            before their children.
+        """
+        trees = len(self.children)
+
+        def firstTree(item):
+            return next((b for b, view in enumerate(item.views) if view.node is not None), trees)
+
+        for item in self.itemPool.items:
+            if firstTree(item) == trees:
+                yield item
+        for b in reversed(range(trees)):
+            nodes = list(reversed(self.children[b].children))
+            while nodes:
+                node = nodes.pop()
+                nodes += reversed(node.children)
+                if node.item is not None and firstTree(node.item) == b:
+                    yield node.item
 
     def readFromFile(self, filename):
         print(f"Reading file {filename}...")
+        self.itemTypes = ItemPool()
+        self.itemPool = ItemPool()
         with open(filename, "r") as f:
+            reader = FileReader(f, filename)
 
-            # chop up string into trees, types, and items part
-            s = f.read()
-            s = s.split("--trees--")[1]
-            s = s.split("--item-types--")
-            treeString = s[0]
-            s = s[1].split("--item-pool--")
-            typeString = s[0]
-            itemString = s[1]
-
-        # create item pool
-        print(f"... reading data items ...")
-        self.itemTypes = ItemPool()
-        self.itemTypes.readFromString(typeString)
+            # create trees
+            print(f"... reading tree definitions ...")
+            self.readFromLines(reader.section("--trees--"))
 
-        # create type pool
-        print(f"... reading data type ...")
-        self.itemPool = ItemPool()
-        self.itemPool.readFromString(itemString)
-        self.createPaths()
+            # create type pool
+            print(f"... reading data type ...")
+            self.itemTypes.readFromLines(reader.section("--item-types--"))
 
-        # create trees
-        print(f"... reading tree definitions ...")
-        self.readFromString(treeString)
-        self.createPaths()     # atm we still need this twice. Fix it.
+            # create item pool
+            print(f"... reading data items ...")
+            self.itemPool.readFromLines(reader.section("--item-pool--"))
+        self.createPaths()
 
         # link name change function of default item to all trees
         for t,tree in enumerate(self.children):
-            self.itemTypes.items[0].registerFieldNameChangeCallback(t, lambda old, new: tree.changeFieldName(old, new))
+            self.itemTypes.items[0].registerFieldNameChangeCallback(t, lambda old, new, tree=tree:
+                                                                    tree.changeFieldName(old, new))
 
         # remove empty nodes
         print(f"... removing empty nodes ...")
         self.removeEmptyNodes()
+
+        # apply the changes made since the file was written
+        self.journal.replay(self)
+
+        # calculate simple aggregates in bulk
+        for tree in self.children:
+            tree.precomputeFields()
+        self.timers.scan(self.itemPool.items)
         print(f"... done.")
 
     def treeIndexFromName(self, name):
@@ -2090,8 +3725,10 @@ class Forest(Node):
                 c.changeFieldName(fieldName, newName)
 
     def changeDataFieldName(self, fieldName, newName):
-        self.itemTypes.changeFieldName(fieldName, newName)
-        self.itemPool.changeFieldName(fieldName, newName)
+        # rename in the pool first, the type item notifies the trees, which then recalculate with the new name
+        with self.batch():
+            self.itemPool.changeFieldName(fieldName, newName)
+            self.itemTypes.changeFieldName(fieldName, newName)
 
     def updateDataFieldType(self, fieldName):
         """ Propagets the change of data field type in the governing data item (default type) through the pool
@@ -2099,7 +3736,8 @@ class Forest(Node):
         :return:
         """
         newType = self.itemTypes.items[0].fields[fieldName]['type']
-        self.itemPool.changeFieldType(fieldName, newType)
+        with self.batch():
+            self.itemPool.changeFieldType(fieldName, newType)
 
     def updateTreeFieldType(self, treeName, fieldName):
         """
@@ -2112,6 +3750,28 @@ class Forest(Node):
             if c.name == treeName:
                 c.updateFieldType(fieldName)
 
+    def updateTreeFieldExpression(self, treeName, fieldName):
+        """
+        Propagates the formula that was set in a top-level expression field through the tree and updates the display
+        :param treeName: The name of the tree
+        :param fieldName: The name of the tree field
+        :return: None if success, an error message if the formula cannot be used
+        """
+        for c in self.children:
+            if c.name == treeName:
+                return c.updateFieldExpression(fieldName)
+
+    def updateTreeFieldSketchSize(self, treeName, fieldName):
+        """
+        Propagates the sketch size that was set in a top-level field through the tree and updates the display
+        :param treeName: The name of the tree
+        :param fieldName: The name of the tree field
+        :return:
+        """
+        for c in self.children:
+            if c.name == treeName:
+                c.updateFieldSketchSize(fieldName)
+
     def updateTreeFieldVisibility(self, treeName, fieldName):
         for tree in self.children:
             if tree.name == treeName:
@@ -2190,8 +3850,9 @@ class Forest(Node):
         return tree
 
     def deleteDataField(self, name):
-        self.itemTypes.deleteField(name)
-        self.itemPool.deleteField(name)
+        with self.batch():
+            self.itemTypes.deleteField(name)
+            self.itemPool.deleteField(name)
 
     def deleteTreeField(self, treeName, fieldName):
         """
@@ -2226,9 +3887,9 @@ class Forest(Node):
         :param fieldName: The name of the tree field
         :param listName: The name of the parameter list, one of 'own-fields', 'child-fields', 'sibling-fields',
         'parent-fields'.
-        :return:
+        :return: True if success, False if the change is not possible (see Tree.updateFieldParameters)
         """
         for c in self.children:
             if c.name == treeName:
-                c.updateFieldParameters(fieldName, listName)
+                return c.updateFieldParameters(fieldName, listName)
 
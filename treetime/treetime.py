@@ -302,6 +302,7 @@ class QMetaNode(QtWidgets.QTreeWidgetItem):
             self.source['content'] = newContent     # this is silent, no need to signal anyone
         elif self.nodeType == 'parameter list':
             currentEntries = len(self.source)
+            oldContent = list(self.source)
             if newContent:
                 if index >= currentEntries:
                     self.source += [newContent]
@@ -309,12 +310,52 @@ class QMetaNode(QtWidgets.QTreeWidgetItem):
                     self.source[index] = newContent
             else:
                 self.source.pop(index)
-            self.forest.updateTreeFieldParameters(self.grandParentName, self.parentName, self.name)
+            if not self.forest.updateTreeFieldParameters(self.grandParentName, self.parentName, self.name):
+                self.source[:] = oldContent
+                msgBox = QtWidgets.QMessageBox()
+                msgBox.setText(f'With this parameter the field "{self.parentName}" would read itself in the same '
+                               f'node, directly or through other fields, and could never be calculated.')
+                msgBox.setWindowTitle("Change not possible")
+                msgBox.setStandardButtons(QtWidgets.QMessageBox.StandardButton.Ok)
+                msgBox.exec()
             super().setText(1, f'{self.source}'[1:-1])
         else:
             print(f"Content change to {newContent} at index {index} not implemented yet for type {self.nodeType}.")
         return True
 
+    def changeSketchSize(self, newSize):
+        """ Change the sketch size of a field type with approximate results (like median or count-distinct).
+        :param newSize: The new size
+        :return: True if the size was changed, False otherwise
+        """
+        if newSize == self.source.sketchSize:
+            return False
+        self.source.sketchSize = newSize
+        self.forest.updateTreeFieldSketchSize(self.parentName, self.name)
+        return True
+
+    def changeExpression(self, newExpression):
+        """ Change the formula of an expression field. If the formula cannot be used, the user sees a message box, and
+        the old formula is kept.
+        :param newExpression: The new formula
+        :return: True if the formula was changed, False otherwise
+        """
+        oldExpression = self.source.expression
+        if newExpression == oldExpression:
+            return False
+        self.source.expression = newExpression
+        error = self.forest.updateTreeFieldExpression(self.parentName, self.name)
+        if error:
+            self.source.expression = oldExpression
+            msgBox = QtWidgets.QMessageBox()
+            msgBox.setText(f'The expression cannot be used: {error}.')
+            msgBox.setWindowTitle("Change not possible")
+            msgBox.setStandardButtons(QtWidgets.QMessageBox.StandardButton.Ok)
+            msgBox.exec()
+            return False
+        self.notifyDefinitionChange()
+        return True
+
     def changeVisibility(self, newVisibility):
         """ Change the visibility of a node. Changes the visiblilty in the tree field directly, then notifies the
         forest to update all nodes
@@ -750,7 +791,7 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.write_timer = False
         self.locked = True
         self.export_continuous = False
-        self.auto_updates = []
+        self.forest = None
         self.update_timer = QtCore.QTimer(self)
         self.update_timer.timeout.connect(self.updateTimers)
         self.update_timer.start(1000)
@@ -1643,17 +1684,19 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # remove if the user has confirmed
         if result == QtWidgets.QMessageBox.StandardButton.Ok:
 
-            # move all children to parent node
-            currentNode = self.currentItem.viewNodes[self.currentTree]
-            parent = currentNode.parent
-            while len(currentNode.children):
-                currentNode.children[0].item.moveInTree(self.currentTree, parent.path)
+            with self.forest.batch():
 
-            # delete item and update file
-            item = self.currentItem
-            item.removeFromTree(self.currentTree)
-            if not sum([len(t) for t in item.trees]):
-                self.forest.itemPool.deleteItem(item)
+                # move all children to parent node
+                currentNode = self.currentItem.viewNodes[self.currentTree]
+                parent = currentNode.parent
+                while len(currentNode.children):
+                    currentNode.children[0].item.moveInTree(self.currentTree, parent.path)
+
+                # delete item and update file
+                item = self.currentItem
+                item.removeFromTree(self.currentTree)
+                if not sum([len(t) for t in item.trees]):
+                    self.forest.itemPool.deleteItem(item)
             self.delayedWriteToFile()
 
     def pushButtonDeleteNodeClicked(self):
@@ -1672,21 +1715,23 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # delete if the user has confirmed
         if result == QtWidgets.QMessageBox.StandardButton.Ok:
 
-            # move all children in all trees to parent node
-            for t in range(0, len(self.forest.children)):
-                node = self.currentItem.viewNodes[t]
-                if node:
-                    while len(node.children):
-                        node.children[0].item.moveInTree(t, node.parent.path)
-
-            # remove running timers
-            for f in self.currentItem.fields.keys():
-                if self.currentItem.fields[f]['type'] == 'timer':
-                    self.currentItem.fields[f]['running_since'] = False
-                    self.adjustAutoUpdate(self.currentItem, f)
-
-            # delete item and update file
-            self.forest.itemPool.deleteItem(self.currentItem)
+            with self.forest.batch():
+
+                # move all children in all trees to parent node
+                for t in range(0, len(self.forest.children)):
+                    node = self.currentItem.viewNodes[t]
+                    if node:
+                        while len(node.children):
+                            node.children[0].item.moveInTree(t, node.parent.path)
+
+                # remove running timers
+                for f in self.currentItem.fields.keys():
+                    if self.currentItem.fields[f]['type'] == 'timer':
+                        self.currentItem.fields[f]['running_since'] = False
+                        self.adjustAutoUpdate(self.currentItem, f)
+
+                # delete item and update file
+                self.forest.itemPool.deleteItem(self.currentItem)
             self.delayedWriteToFile()
 
     def pushButtonDeleteBranchClicked(self):
@@ -1740,9 +1785,10 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                             i.fields[f]['running_since'] = False
                             self.adjustAutoUpdate(i, f)
 
-                # delete items and update file
-                for i in to_delete:
-                    self.forest.itemPool.deleteItem(i)
+                # delete items and update file, the remaining nodes are recalculated once at the end
+                with self.forest.batch():
+                    for i in to_delete:
+                        self.forest.itemPool.deleteItem(i)
                 self.delayedWriteToFile()
 
     def pushButtonNewDataFieldClicked(self):
@@ -1960,7 +2006,9 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         If the counter is at zero, a write-to-file is performed. If the counter is > 0, it is counted down and a
         new timer is started.
         When changing cell contents, each cell change calls a delayed write. The file is only written if there has
-        been no change for 5 seconds (otherwise the continuous file writing slows the user input down).
+        been no change for 5 seconds (otherwise the continuous file writing slows the user input down). Changes of
+        item names and field contents are recorded in the journal instead (see Forest.journalChange), and only need a
+        write when the journal is full.
         :param countdown: Whether to count down and trigger a write at zero (=True),
                           or whether to init a new run (=False)
         :return:
@@ -1974,9 +2022,10 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     self.writeToFile()
                 self.write_timer = False
 
-        # We've been called after a cell change, init the counter
+        # We've been called after a cell change, init the counter, the journal cannot follow until the file is written
         else:
             self.write_delay = 5
+            self.forest.journal.suspend()
 
         # The counter is up, start another 2-second timer
         if self.write_delay > 0 and not self.write_timer:
@@ -2340,7 +2389,8 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     widget.setFont(font)
                     widget.addItems(Field.Types)
                     widget.setCurrentText(currentNode.contentType)
-                    widget.currentTextChanged.connect(lambda x: currentNode.changeType(x))
+                    widget.currentTextChanged.connect(lambda x: currentNode.changeType(x)
+                                                                and self.showTreeFieldInDataView())
                     self.tableWidget.setCellWidget(n, 3, widget)
                 else:
                     self.tableWidget.setCellWidget(n, 3, None)
@@ -2371,6 +2421,25 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     self.tableWidget.setCellWidget(n, 3, widget)
                     self._protectCells(n, [0, 1, 2, 3, 4])
                     n += 1
+                    if currentNode.contentType == 'expression':
+                        self.tableWidget.setItem(n, 1, QtWidgets.QTableWidgetItem("Expression"))
+                        widget = QtWidgets.QLineEdit(currentNode.source.expression)
+                        widget.setFont(font)
+                        widget.editingFinished.connect(lambda w=widget: currentNode.changeExpression(w.text()))
+                        self.tableWidget.setCellWidget(n, 3, widget)
+                        self._protectCells(n, [0, 1, 2, 3, 4])
+                        n += 1
+                    aggregate = Field.Aggregates.get(currentNode.contentType)
+                    if aggregate is not None and aggregate.size is not None:
+                        self.tableWidget.setItem(n, 1, QtWidgets.QTableWidgetItem("Sketch size"))
+                        widget = QtWidgets.QSpinBox()
+                        widget.setFont(font)
+                        widget.setRange(16, 1000000)
+                        widget.setValue(currentNode.source.sketchSize or aggregate.size)
+                        widget.editingFinished.connect(lambda w=widget: currentNode.changeSketchSize(w.value()))
+                        self.tableWidget.setCellWidget(n, 3, widget)
+                        self._protectCells(n, [0, 1, 2, 3, 4])
+                        n += 1
                     self.tableWidget.setCellWidget(n, 3, None)     # remove possible leftovers from previous fields
                     self._protectCells(n, [0, 1, 2, 3, 4])
                     n += 1
@@ -2540,6 +2609,7 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         Called when the user wants to change the item name, field content or parent via the grid
         """
 
+        journaled = False
         if not self.locked:
             self.locked = True
             if column == 3:
@@ -2549,6 +2619,7 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     newName = self.tableWidget.item(row, column).text()
                     if self.editMode == 'content':
                         self.currentItem.changeName(newName)
+                        journaled = self.forest.journalChange(self.currentItem)
                     else:
                         changeOk = self.currentMetaNode.changeName(newName)
                         if changeOk:
@@ -2578,6 +2649,8 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                         if result is not True:
                             message = "Couldn't update field content.\n" + str(result)
                             print(message)
+                        else:
+                            journaled = self.forest.journalChange(self.currentItem, fieldName)
 
                         # add/remove timer to list
                         if fieldType == 'timer':
@@ -2590,35 +2663,26 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                             self.showTreeFieldInDataView()
 
             self.locked = False
-            self.delayedWriteToFile()
+
+            # content changes go to the journal, everything else is saved by writing the whole file
+            if not journaled:
+                self.delayedWriteToFile()
 
     def adjustAutoUpdate(self, item, fieldName):
         """ Adds or removes a timer to the list of fields to auto-update.
         """
-        if item.fields[fieldName]['type'] == 'timer':
-            # if timer is running, add it to the list
-            if item.fields[fieldName]['running_since']:
-                if (item, fieldName) not in self.auto_updates:
-                    self.auto_updates.append((item, fieldName))
-
-            # if timer is stopped, remove it from the list
-            else:
-                if (item, fieldName) in self.auto_updates:
-                    del self.auto_updates[self.auto_updates.index((item, fieldName))]
+        self.forest.timers.adjust(item, fieldName)
 
     def initAllAutoUpdates(self):
         """
         Initialise all auto-update fields after loading.
         """
-        for i in self.forest.itemPool.items:
-            for f in i.fields:
-                    self.adjustAutoUpdate(i, f)
+        self.forest.timers.scan(self.forest.itemPool.items)
 
     def updateTimers(self):
-        # update all timers that are running
-        for item, fieldName in self.auto_updates:
-            result = item.changeFieldContent(fieldName, [True])
-        # remove timers that are problematic
+        # update all timers that are running, with one reading of the clock
+        if self.forest is not None:
+            self.forest.timers.tick()
 
     def createNode(self, insertas, copy, recurse = False, srcItem = None, destItem = None):
         
@@ -2651,7 +2715,7 @@ class TreeTimeWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         if copy:
             item = self.forest.itemPool.copyItem(sourceItem)
             for n,t in enumerate(self.forest.children):
-                if n != self.currentTree and item.trees[n] != []:
+                if n != self.currentTree and item.trees[n]:
                     oldNode = t.findNode(item.trees[n])
                     newNode = oldNode.parent.addItemAsChild(item)
                     newQNode = QNode(newNode, self.forest.children[n].fieldOrder)